@@ -29,12 +29,15 @@ some optimization before it can be low-impact enough for this to be an
 improvement.
 """
 
+import re
 import sys
 import weakref
 import time
 
 from cStringIO import StringIO
 from cPickle import dumps, loads
+from bisect import insort
+from collections import OrderedDict, deque
 from itertools import count
 
 from zope.interface import implements
@@ -47,7 +50,7 @@ from twisted.protocols.amp import Boolean
 from twisted.python.failure import Failure
 from twisted.protocols.amp import Argument, String, Command, AMP, Integer
 from twisted.internet import reactor as _reactor
-from twisted.application.service import Service
+from twisted.application.service import MultiService, Service
 from twisted.internet.defer import maybeDeferred
 from twisted.python.components import proxyForInterface
 
@@ -56,12 +59,15 @@ from twisted.internet.defer import succeed
 
 from twext.enterprise.ienterprise import ConnectionError
 from twext.enterprise.ienterprise import IDerivedParameter
+from twext.enterprise.dal.syntax import StatementCache
+from twext.enterprise.dal.syntax import DEFAULT_STATEMENT_CACHE_SIZE
+from twext.enterprise.metrics import PoolMetrics
 
 from twisted.internet.defer import fail
 
 from twext.enterprise.ienterprise import (
-    AlreadyFinishedError, IAsyncTransaction, ICommandBlock,
-    DatabaseType, POSTGRES_DIALECT,
+    AlreadyFinishedError, IAsyncTransaction, ICommandBlock, IRowStream,
+    DatabaseType, POSTGRES_DIALECT, ORACLE_DIALECT, SQLITE_DIALECT,
 )
 
 from twext.python.log import Logger
@@ -146,6 +152,219 @@ def _deriveQueryEnded(cursor, derived):
         arg.postQuery(cursor)
 
 
+DEFAULT_MAX_PREPARED = 100
+
+_PREPARABLE = re.compile(r"^\s*(select|insert|update|delete)\b", re.IGNORECASE)
+
+
+class _StatementPreparer(object):
+    """
+    Keeps track of the statements prepared on a single database connection, so
+    that SQL which is executed repeatedly is only parsed and planned once per
+    connection.  A L{_StatementPreparer} lives exactly as long as the
+    connection it was created for; a new one is created whenever a
+    L{_ConnectedTxn} re-connects.
+
+    Only single C{select}, C{insert}, C{update} and C{delete} statements are
+    prepared; anything else is executed as usual.
+
+    Subclasses decide what a "prepared statement handle" is and how it is
+    executed.  All methods are called on the connection's own thread.
+
+    @ivar _handles: a mapping of SQL text to prepared statement handles, in
+        least-recently-used order.
+    @type _handles: L{OrderedDict}
+    """
+
+    def __init__(self, connection, cursor, paramstyle,
+                 maxPrepared=DEFAULT_MAX_PREPARED):
+        self._connection = connection
+        self._cursor = cursor
+        self._paramstyle = paramstyle
+        self._maxPrepared = maxPrepared
+        self._handles = OrderedDict()
+
+    def preparable(self, sql):
+        """
+        Can the given SQL be prepared?
+
+        @rtype: L{bool}
+        """
+        return _PREPARABLE.match(sql) is not None and ";" not in sql
+
+    def cursorFor(self, sql):
+        """
+        Get the cursor that the given SQL should be executed on.
+
+        @rtype: a DB-API 2.0 cursor
+        """
+        return self._cursor
+
+    def execute(self, cursor, sql, args):
+        """
+        Execute the given SQL with the given arguments on C{cursor}, preparing
+        it first if it has not been prepared on this connection already.
+        """
+        handle = self._lookup(sql)
+        if handle is None:
+            handle = self._remember(sql, self._prepare(cursor, sql))
+        self._executePrepared(cursor, handle, args)
+
+    def _lookup(self, sql):
+        """
+        Find the handle for the given SQL, marking it as most recently used.
+
+        @return: the handle, or C{None} if C{sql} has not been prepared.
+        """
+        handle = self._handles.pop(sql, None)
+        if handle is not None:
+            self._handles[sql] = handle
+        return handle
+
+    def _remember(self, sql, handle):
+        """
+        Record a newly-prepared handle, releasing the least recently used one
+        if there are now too many.
+
+        @return: C{handle}
+        """
+        if self._handles and len(self._handles) >= self._maxPrepared:
+            _ignore_sql, oldest = self._handles.popitem(last=False)
+            self._release(oldest)
+        self._handles[sql] = handle
+        return handle
+
+    def _prepare(self, cursor, sql):
+        """
+        Prepare the given SQL.
+
+        @return: a handle to pass to L{_executePrepared}; must not be C{None}.
+        """
+        raise NotImplementedError()
+
+    def _executePrepared(self, cursor, handle, args):
+        """
+        Execute a previously-prepared statement.
+        """
+        raise NotImplementedError()
+
+    def _release(self, handle):
+        """
+        Discard a prepared statement that is no longer needed.
+        """
+
+
+class _SimulatedPreparer(_StatementPreparer):
+    """
+    Statement preparation for DB-API modules, such as C{sqlite3}, which keep
+    their own per-connection cache of compiled statements keyed on SQL text.
+    The statement is simply executed; the database module's cache does the
+    rest.
+    """
+
+    def _prepare(self, cursor, sql):
+        return sql
+
+    def _executePrepared(self, cursor, handle, args):
+        cursor.execute(handle, args)
+
+
+class _CursorPreparer(_StatementPreparer):
+    """
+    Statement preparation for DB-API modules, such as C{cx_Oracle}, which
+    support C{cursor.prepare(sql)} followed by C{cursor.execute(None, args)}.
+    Each prepared statement gets its own cursor.
+    """
+
+    def cursorFor(self, sql):
+        cursor = self._lookup(sql)
+        if cursor is None:
+            cursor = self._connection.cursor()
+            cursor.prepare(sql)
+            self._remember(sql, cursor)
+        return cursor
+
+    def execute(self, cursor, sql, args):
+        cursor.execute(None, args)
+
+    def _release(self, cursor):
+        cursor.close()
+
+
+class _ServerPreparer(_StatementPreparer):
+    """
+    Statement preparation using SQL C{PREPARE} and C{EXECUTE} statements, as
+    supported by PostgreSQL.  Placeholders in the prepared SQL are re-written
+    to the C{$n} form that C{PREPARE} expects; the arguments themselves are
+    passed to C{EXECUTE} using the connection's paramstyle.
+    """
+
+    _placeholders = {
+        "qmark": re.compile(r"\?"),
+        "numeric": re.compile(r":(\d+)"),
+        "format": re.compile(r"%[s%]"),
+        "pyformat": re.compile(r"%[s%]"),
+    }
+
+    def __init__(self, *args, **kwargs):
+        super(_ServerPreparer, self).__init__(*args, **kwargs)
+        self._names = count(1)
+
+    def preparable(self, sql):
+        return (
+            super(_ServerPreparer, self).preparable(sql) and
+            self._paramstyle in self._placeholders and
+            "%(" not in sql
+        )
+
+    def _prepare(self, cursor, sql):
+        numbers = count(1)
+        highest = [0]
+
+        def renumber(match):
+            text = match.group(0)
+            if text == "%%":
+                return "%"
+            if self._paramstyle == "numeric":
+                number = int(match.group(1))
+            else:
+                number = numbers.next()
+            highest[0] = max(highest[0], number)
+            return "${}".format(number)
+
+        text = self._placeholders[self._paramstyle].sub(renumber, sql)
+        name = "twext_prepared_{}".format(self._names.next())
+        cursor.execute("prepare {} as {}".format(name, text))
+        if self._paramstyle == "numeric":
+            params = [":{}".format(n + 1) for n in range(highest[0])]
+        elif self._paramstyle == "qmark":
+            params = ["?"] * highest[0]
+        else:
+            params = ["%s"] * highest[0]
+        if params:
+            return "execute {} ({})".format(name, ", ".join(params))
+        return "execute {}".format(name)
+
+    def _executePrepared(self, cursor, handle, args):
+        cursor.execute(handle, args)
+
+    def _release(self, handle):
+        self._cursor.execute("deallocate {}".format(handle.split()[1]))
+
+
+_preparers = {
+    POSTGRES_DIALECT: _ServerPreparer,
+    ORACLE_DIALECT: _CursorPreparer,
+    SQLITE_DIALECT: _SimulatedPreparer,
+}
+
+
+# Statements used to check that an idle connection is still alive.
+_PROBE_SQL = {
+    ORACLE_DIALECT: "select 1 from dual",
+}
+
+
 class _ConnectedTxn(object):
     """
     L{IAsyncTransaction} implementation based on a L{ThreadHolder} in the
@@ -163,6 +382,12 @@ class _ConnectedTxn(object):
         self._holder = threadHolder
         self._first = True
         self._label = label
+        self._preparer = pool._createPreparer(connection, cursor)
+        self._streams = []
+        self._streamNames = count(1)
+        self._checkedOut = None
+        self._statementCount = 0
+        self._idleSince = None
 
     def __repr__(self):
         return "_ConnectedTxn({})".format(self._label)
@@ -173,6 +398,59 @@ class _ConnectedTxn(object):
         The dbtype attribute is mirrored from the connection pool.
         """
 
+    @_forward
+    def statementCache(self):
+        """
+        The statementCache attribute is mirrored from the connection pool.
+        """
+
+    def _reconnect(self):
+        """
+        Replace the connection and cursor after the first statement of a
+        transaction has failed, since the connection has probably gone bad in
+        the meanwhile.  Must be called from the C{except} clause that caught the
+        failure, on the connection's thread.
+        """
+        # Report the error before doing anything else, since doing
+        # other things may cause the traceback stack to be eliminated
+        # if they raise exceptions (even internally).
+        log.failure(
+            "Exception from execute() on first statement in "
+            "transaction.  Possibly caused by a database server "
+            "restart.  Automatically reconnecting now.",
+            failure=Failure(),
+        )
+        try:
+            self._connection.close()
+        except:
+            # close() may raise an exception to alert us of an error as
+            # well.  Right now the only type of error we know about is
+            # "the connection is already closed", which obviously
+            # doesn't need to be handled specially. Unfortunately the
+            # reporting of this type of error is not consistent or
+            # predictable across different databases, or even different
+            # bindings to the same database, so we have to do a
+            # catch-all here.  While I can't imagine another type of
+            # error at the moment, bare C{except:}s are notorious for
+            # making debugging surprising error conditions very
+            # difficult, so let's make sure that the error is logged
+            # just in case.
+            log.failure(
+                "Exception from close() while automatically "
+                "reconnecting. (Probably not serious.)",
+                failure=Failure(),
+            )
+
+        # Now, if either of *these* things fail, there's an error here
+        # that we cannot workaround or address automatically, so no
+        # try:except: for them.
+        self._pool.metrics.reconnected()
+        self._connection = self._pool.connectionFactory()
+        self._cursor = self._connection.cursor()
+        self._preparer = self._pool._createPreparer(
+            self._connection, self._cursor
+        )
+
     def _reallyExecSQL(self, sql, args=None, raiseOnZeroRowCount=None):
         """
         Execute the given SQL on a thread, using a DB-API 2.0 cursor.
@@ -234,56 +512,37 @@ class _ConnectedTxn(object):
         if args is None:
             args = []
 
-        # Note: as of this writing, derived parameters are only used to support
-        # cx_Oracle's "host variable" feature (i.e. cursor.var()), and creating
-        # a host variable will never be a connection-oriented error (a
-        # disconnected cursor can happily create variables of all types).
-        # However, this may need to move into the "try" below if other database
-        # features need to compute database arguments based on runtime state.
-        derived = _deriveParameters(self._cursor, args)
+        preparer = self._preparer
+        if preparer is None or not preparer.preparable(sql):
+            preparer = None
 
         try:
-            self._cursor.execute(sql, args)
+            # Getting a cursor for a prepared statement may prepare it, which
+            # talks to the database, so a bad connection can show up here just
+            # as it can in execute().
+            if preparer is None:
+                cursor = self._cursor
+            else:
+                cursor = preparer.cursorFor(sql)
+
+            # Note: as of this writing, derived parameters are only used to
+            # support cx_Oracle's "host variable" feature (i.e. cursor.var()),
+            # and creating a host variable will never be a connection-oriented
+            # error (a disconnected cursor can happily create variables of all
+            # types).
+            derived = _deriveParameters(cursor, args)
+
+            if preparer is None:
+                cursor.execute(sql, args)
+            else:
+                preparer.execute(cursor, sql, args)
         except:
-            # If execute() raised an exception, and this was the first thing to
-            # happen in the transaction, then the connection has probably gone
-            # bad in the meanwhile, and we should try again.
+            # If preparing or executing the statement raised an exception, and
+            # this was the first thing to happen in the transaction, then the
+            # connection has probably gone bad in the meanwhile, and we should
+            # try again.
             if wasFirst:
-                # Report the error before doing anything else, since doing
-                # other things may cause the traceback stack to be eliminated
-                # if they raise exceptions (even internally).
-                log.failure(
-                    "Exception from execute() on first statement in "
-                    "transaction.  Possibly caused by a database server "
-                    "restart.  Automatically reconnecting now.",
-                    failure=Failure(),
-                )
-                try:
-                    self._connection.close()
-                except:
-                    # close() may raise an exception to alert us of an error as
-                    # well.  Right now the only type of error we know about is
-                    # "the connection is already closed", which obviously
-                    # doesn't need to be handled specially. Unfortunately the
-                    # reporting of this type of error is not consistent or
-                    # predictable across different databases, or even different
-                    # bindings to the same database, so we have to do a
-                    # catch-all here.  While I can't imagine another type of
-                    # error at the moment, bare C{except:}s are notorious for
-                    # making debugging surprising error conditions very
-                    # difficult, so let's make sure that the error is logged
-                    # just in case.
-                    log.failure(
-                        "Exception from close() while automatically "
-                        "reconnecting. (Probably not serious.)",
-                        failure=Failure(),
-                    )
-
-                # Now, if either of *these* things fail, there's an error here
-                # that we cannot workaround or address automatically, so no
-                # try:except: for them.
-                self._connection = self._pool.connectionFactory()
-                self._cursor = self._connection.cursor()
+                self._reconnect()
 
                 # Note that although this method is being invoked recursively,
                 # the "_first" flag is re-set at the very top, so we will _not_
@@ -294,17 +553,17 @@ class _ConnectedTxn(object):
                 raise
 
         if derived is not None:
-            _deriveQueryEnded(self._cursor, derived)
+            _deriveQueryEnded(cursor, derived)
 
-        if self._cursor.description:
+        if cursor.description:
             # see test_raiseOnZeroRowCountWithUnreliableRowCount
-            rows = self._cursor.fetchall()
+            rows = cursor.fetchall()
             if not rows:
                 if raiseOnZeroRowCount is not None:
                     raise raiseOnZeroRowCount()
             return rows
         else:
-            if raiseOnZeroRowCount is not None and self._cursor.rowcount == 0:
+            if raiseOnZeroRowCount is not None and cursor.rowcount == 0:
                 raise raiseOnZeroRowCount()
             # Oracle with a return into clause returns an empty set or rows, but
             # we then have to insert the special bind variables for the return into.
@@ -312,7 +571,7 @@ class _ConnectedTxn(object):
             # What we do is always insert a set of empty rows equal to the rowcount. in
             # the case of no result, an empty list is returned. This way we can detect
             # that the additional bind variables are needed (if len(result) != 0).
-            return [[]] * self._cursor.rowcount
+            return [[]] * cursor.rowcount
 
     def _reallyCallSQL(self, sql, args=None):
         """
@@ -358,41 +617,7 @@ class _ConnectedTxn(object):
             # happen in the transaction, then the connection has probably gone
             # bad in the meanwhile, and we should try again.
             if wasFirst:
-                # Report the error before doing anything else, since doing
-                # other things may cause the traceback stack to be eliminated
-                # if they raise exceptions (even internally).
-                log.failure(
-                    "Exception from execute() on first statement in "
-                    "transaction.  Possibly caused by a database server "
-                    "restart.  Automatically reconnecting now.",
-                    failure=Failure(),
-                )
-                try:
-                    self._connection.close()
-                except:
-                    # close() may raise an exception to alert us of an error as
-                    # well.  Right now the only type of error we know about is
-                    # "the connection is already closed", which obviously
-                    # doesn't need to be handled specially. Unfortunately the
-                    # reporting of this type of error is not consistent or
-                    # predictable across different databases, or even different
-                    # bindings to the same database, so we have to do a
-                    # catch-all here.  While I can't imagine another type of
-                    # error at the moment, bare C{except:}s are notorious for
-                    # making debugging surprising error conditions very
-                    # difficult, so let's make sure that the error is logged
-                    # just in case.
-                    log.failure(
-                        "Exception from close() while automatically "
-                        "reconnecting. (Probably not serious.)",
-                        failure=Failure(),
-                    )
-
-                # Now, if either of *these* things fail, there's an error here
-                # that we cannot workaround or address automatically, so no
-                # try:except: for them.
-                self._connection = self._pool.connectionFactory()
-                self._cursor = self._connection.cursor()
+                self._reconnect()
 
                 # Note that although this method is being invoked recursively,
                 # the "_first" flag is re-set at the very top, so we will _not_
@@ -404,11 +629,141 @@ class _ConnectedTxn(object):
         else:
             return returnValue
 
+    def _reallyExecSQLMany(self, sql, argsList):
+        """
+        Execute the given SQL once for each set of arguments, with a single
+        call to the DB-API 2.0 cursor's C{executemany}.  Executed on a thread,
+        like L{_ConnectedTxn._reallyExecSQL}, and re-connects in the same
+        circumstances.
+
+        @param sql: The SQL string to execute.
+        @type sql: C{str}
+
+        @param argsList: The bind parameters for each execution.
+        @type argsList: C{list} of C{list}
+
+        @return: the number of rows affected, as reported by the cursor's
+            C{rowcount}.
+        @rtype: C{int}
+        """
+        wasFirst = self._first
+        self._first = False
+
+        try:
+            self._cursor.executemany(sql, argsList)
+        except:
+            if wasFirst:
+                self._reconnect()
+                return self._reallyExecSQLMany(sql, argsList)
+            else:
+                raise
+        return self._cursor.rowcount
+
+    def _reallyExecSQLStreaming(self, sql, args, batchSize):
+        """
+        Execute the given SQL on a thread, on a cursor of its own, leaving the
+        results to be fetched later by a L{_RowStream}.  Re-connects in the
+        same circumstances as L{_ConnectedTxn._reallyExecSQL}.
+
+        On PostgreSQL the query is run as a server-side cursor (C{DECLARE ...
+        CURSOR}), so the rows stay on the server until they are fetched.  Other
+        dialects (in practice, SQLite) fall back to a plain DB-API cursor, for
+        which C{fetchmany} is the best that can be done; the whole result may
+        be held by the client library as soon as the query is executed.
+
+        @param sql: The SQL string to execute.
+        @type sql: C{str}
+
+        @param args: The bind parameters to pass to adbapi, if any.
+        @type args: C{list} or C{None}
+
+        @param batchSize: The number of rows to fetch at a time.
+        @type batchSize: C{int}
+
+        @rtype: L{_RowStream}
+        """
+        wasFirst = self._first
+        self._first = False
+        if args is None:
+            args = []
+
+        try:
+            cursor = self._connection.cursor()
+            if self._pool.dbtype.dialect == POSTGRES_DIALECT:
+                name = "twext_stream_{}".format(self._streamNames.next())
+                cursor.execute(
+                    "declare {} no scroll cursor for {}".format(name, sql),
+                    args
+                )
+                stream = _DeclaredRowStream(self, cursor, batchSize, name)
+            else:
+                cursor.execute(sql, args)
+                stream = _RowStream(self, cursor, batchSize)
+        except:
+            if wasFirst:
+                self._reconnect()
+                return self._reallyExecSQLStreaming(sql, args, batchSize)
+            else:
+                raise
+        self._streams.append(stream)
+        return stream
+
+    def _reallyExecPipeline(self, commands):
+        """
+        Execute several commands back-to-back on the connection's thread.
+
+        @param commands: a C{list} of 2-C{tuple}s of C{(methodName, args)},
+            where C{methodName} is C{"execSQL"} or C{"execSQLMany"}.
+
+        @return: a C{list} of 2-C{tuple}s of C{(success, result)}, one for each
+            command, as with L{DeferredList}.
+        """
+        results = []
+        for methodName, args in commands:
+            really = {
+                "execSQL": self._reallyExecSQL,
+                "execSQLMany": self._reallyExecSQLMany,
+            }[methodName]
+            try:
+                results.append((True, really(*args)))
+            except:
+                results.append((False, Failure()))
+        return results
+
     def execSQL(self, *args, **kw):
+        self._statementCount += 1
+        return self._submit(self._reallyExecSQL, args, kw)
+
+    def execSQLStreaming(self, sql, args=None, batchSize=100):
+        self._statementCount += 1
+        return self._submit(
+            self._reallyExecSQLStreaming, (sql, args, batchSize), {}
+        )
+
+    def _execPipeline(self, commands):
+        """
+        Execute several commands with a single round trip to the connection's
+        thread.
+
+        @see: L{_ConnectedTxn._reallyExecPipeline}
+        """
+        self._statementCount += len(commands)
+        return self._submit(self._reallyExecPipeline, (commands,), {})
+
+    def execSQLMany(self, *args, **kw):
+        self._statementCount += 1
+        return self._submit(self._reallyExecSQLMany, args, kw)
+
+    def _submit(self, really, args, kw):
+        """
+        Run C{really} with the given arguments on the connection's thread.
+
+        @return: a L{Deferred} firing with the result of C{really}.
+        """
         if self._completed:
             raise RuntimeError("Attempt to use {} transaction.".format(self._completed))
         result = self._holder.submit(
-            lambda: self._reallyExecSQL(*args, **kw)
+            lambda: really(*args, **kw)
         )
         if self.noisy:
             def reportResult(results):
@@ -447,6 +802,8 @@ class _ConnectedTxn(object):
                 """
                 if self._cursor is None or self._first:
                     return
+                while self._streams:
+                    self._streams[0]._abandon()
                 really()
 
             result = self._holder.submit(reallySomething)
@@ -480,6 +837,27 @@ class _ConnectedTxn(object):
         if self._completed != "terminated":
             self._completed = False
         self._first = True
+        self._checkedOut = None
+        self._statementCount = 0
+
+    def _reallyProbe(self):
+        """
+        Execute a trivial statement, on the connection's thread, to check that
+        the connection is still alive.
+        """
+        self._cursor.execute(
+            _PROBE_SQL.get(self._pool.dbtype.dialect, "select 1")
+        )
+        self._cursor.fetchall()
+        self._connection.rollback()
+
+    def _probe(self):
+        """
+        Check that this idle transaction's connection is still alive.
+
+        @return: a L{Deferred} which fails if it is not.
+        """
+        return self._holder.submit(self._reallyProbe)
 
     def _releaseConnection(self):
         """
@@ -500,6 +878,112 @@ class _ConnectedTxn(object):
         return holder.stop()
 
 
+class _RowStream(object):
+    """
+    An L{IRowStream} which fetches rows from a DB-API 2.0 cursor with
+    C{fetchmany}, on the thread of the L{_ConnectedTxn} that executed the
+    query.  The cursor is closed once all the rows have been fetched, when the
+    stream is closed, or when the transaction ends, whichever comes first.
+    Once the transaction has ended, no more rows can be fetched.
+    """
+    implements(IRowStream)
+
+    def __init__(self, txn, cursor, batchSize):
+        self._txn = txn
+        self._cursor = cursor
+        self._batchSize = batchSize
+
+    def nextBatch(self):
+        if self._cursor is None:
+            return succeed([])
+        if self._txn._completed:
+            return fail(AlreadyFinishedError(self._txn._completed))
+        return self._txn._submit(self._reallyNextBatch, (), {})
+
+    def close(self):
+        if self._cursor is None or self._txn._completed:
+            # Ending the transaction closes the cursor.
+            return succeed(None)
+        return self._txn._submit(self._reallyClose, (), {})
+
+    def _fetch(self):
+        """
+        Fetch up to a batch of rows from the cursor.
+        """
+        return self._cursor.fetchmany(self._batchSize)
+
+    def _reallyNextBatch(self):
+        """
+        Fetch the next batch of rows.  Executed on the transaction's thread.
+        """
+        if self._cursor is None:
+            return []
+        rows = self._fetch()
+        if len(rows) < self._batchSize:
+            self._reallyClose()
+        return rows
+
+    def _reallyClose(self):
+        """
+        Close the cursor.  Executed on the transaction's thread.
+        """
+        self._abandon()
+
+    def _abandon(self):
+        """
+        Close the DB-API cursor without any further statements, as the
+        transaction is ending.  Executed on the transaction's thread.
+        """
+        if self._cursor is not None:
+            cursor = self._cursor
+            self._cursor = None
+            self._txn._streams.remove(self)
+            cursor.close()
+
+
+class _DeclaredRowStream(_RowStream):
+    """
+    A L{_RowStream} over a PostgreSQL server-side cursor, created with
+    C{DECLARE}, from which each batch is retrieved with C{FETCH}.  The server
+    closes the cursor itself when the transaction ends.
+    """
+
+    def __init__(self, txn, cursor, batchSize, name):
+        super(_DeclaredRowStream, self).__init__(txn, cursor, batchSize)
+        self._name = name
+
+    def _fetch(self):
+        self._cursor.execute(
+            "fetch forward {} from {}".format(self._batchSize, self._name)
+        )
+        return self._cursor.fetchall()
+
+    def _reallyClose(self):
+        if self._cursor is not None:
+            self._cursor.execute("close {}".format(self._name))
+        self._abandon()
+
+
+class _BufferedRowStream(object):
+    """
+    An L{IRowStream} over rows which have already been retrieved.
+    """
+    implements(IRowStream)
+
+    def __init__(self, rows, batchSize):
+        self._rows = rows if rows is not None else []
+        self._batchSize = batchSize
+
+    def nextBatch(self):
+        batch = self._rows[:self._batchSize]
+        self._rows = self._rows[self._batchSize:]
+        return succeed(batch)
+
+    def close(self):
+        self._rows = []
+        return succeed(None)
+
+
 class _NoTxn(object):
     """
     An L{IAsyncTransaction} that indicates a local failure before we could even
@@ -508,8 +992,11 @@ class _NoTxn(object):
     """
     implements(IAsyncTransaction)
 
+    readOnly = False
+
     def __init__(self, pool, reason, label=None):
         self.dbtype = pool.dbtype
+        self.statementCache = pool.statementCache
         self.reason = reason
         self._label = label
 
@@ -523,6 +1010,9 @@ class _NoTxn(object):
         return fail(ConnectionError(self.reason))
 
     execSQL = _everything
+    execSQLMany = _everything
+    execSQLStreaming = _everything
+    _execPipeline = _everything
     commit = _everything
     abort = _everything
 
@@ -583,6 +1073,15 @@ class _WaitingTxn(object):
     def execSQL(self, *a, **kw):
         return self._enspool("execSQL", a, kw)
 
+    def execSQLMany(self, *a, **kw):
+        return self._enspool("execSQLMany", a, kw)
+
+    def execSQLStreaming(self, *a, **kw):
+        return self._enspool("execSQLStreaming", a, kw)
+
+    def _execPipeline(self, *a, **kw):
+        return self._enspool("_execPipeline", a, kw)
+
     def commit(self):
         return self._enspool("commit")
 
@@ -680,8 +1179,13 @@ class _SingleTxn(_CommitAndAbortHooks,
 
     It's also the only implementor of the C{commandBlock} method for grouping
     commands together.
+
+    @ivar readOnly: Was this transaction created with C{readOnly=True}?  If
+        so, DAL statements which write or lock will refuse to execute on it.
     """
 
+    readOnly = False
+
     def __init__(self, pool, baseTxn):
         super(_SingleTxn, self).__init__()
         self._pool = pool
@@ -699,6 +1203,12 @@ class _SingleTxn(_CommitAndAbortHooks,
         """
         return "_SingleTxn(%r)" % (self._baseTxn,)
 
+    @_forward
+    def statementCache(self):
+        """
+        The statementCache attribute is mirrored from the connection pool.
+        """
+
     def _unspoolOnto(self, baseTxn):
         """
         Replace my C{_baseTxn}, currently a L{_WaitingTxn}, with a new
@@ -713,16 +1223,34 @@ class _SingleTxn(_CommitAndAbortHooks,
     def execSQL(self, sql, args=None, raiseOnZeroRowCount=None):
         return self._execSQLForBlock(sql, args, raiseOnZeroRowCount, None)
 
+    def execSQLMany(self, sql, argsList):
+        return self._execForBlock("execSQLMany", (sql, argsList), None)
+
+    def execSQLStreaming(self, sql, args=None, batchSize=100):
+        return self._execForBlock(
+            "execSQLStreaming", (sql, args, batchSize), None
+        )
+
     def _execSQLForBlock(self, sql, args, raiseOnZeroRowCount, block):
         """
         Execute some SQL for a particular L{CommandBlock}; or, if the given
         C{block} is C{None}, execute it in the outermost transaction context.
         """
+        return self._execForBlock(
+            "execSQL", (sql, args, raiseOnZeroRowCount), block
+        )
+
+    def _execForBlock(self, command, a, block):
+        """
+        Invoke the named L{ISQLExecutor} method for a particular
+        L{CommandBlock}; or, if the given C{block} is C{None}, invoke it in the
+        outermost transaction context.
+        """
         self._checkComplete()
         if block is None and self._blockedQueue is not None:
-            return self._blockedQueue.execSQL(sql, args, raiseOnZeroRowCount)
+            return getattr(self._blockedQueue, command)(*a)
         # "block" should always be _currentBlock at this point.
-        d = super(_SingleTxn, self).execSQL(sql, args, raiseOnZeroRowCount)
+        d = getattr(self._baseTxn, command)(*a)
         self._stillExecuting.append(d)
 
         def itsDone(result):
@@ -822,13 +1350,13 @@ class _SingleTxn(_CommitAndAbortHooks,
         self._checkComplete()
         self._completed = True
 
-    def commandBlock(self):
+    def commandBlock(self, pipeline=False):
         """
         Create a L{CommandBlock} which will wait for all currently spooled
         commands to complete before executing its own.
         """
         self._checkComplete()
-        block = CommandBlock(self)
+        block = CommandBlock(self, pipeline)
         if self._currentBlock is None:
             self._blockedQueue = _WaitingTxn(self._pool, label=self._label)
             # FIXME: test the case where it's ready immediately.
@@ -859,6 +1387,12 @@ class _Unspooler(object):
         """
         return self.orig.execSQL(sql, args, raiseOnZeroRowCount, False)
 
+    def execSQLMany(self, sql, argsList):
+        """
+        Execute some SQL many times, but don't track a new Deferred.
+        """
+        return self.orig.execSQLMany(sql, argsList, False)
+
 
 class CommandBlock(object):
     """
@@ -872,10 +1406,13 @@ class CommandBlock(object):
     """
     implements(ICommandBlock)
 
-    def __init__(self, singleTxn):
+    def __init__(self, singleTxn, pipeline=False):
         self._singleTxn = singleTxn
         self.dbtype = singleTxn.dbtype
+        self.statementCache = singleTxn.statementCache
+        self.readOnly = singleTxn.readOnly
         self._spool = _WaitingTxn(singleTxn._pool, label=singleTxn._label)
+        self._pipeline = [] if pipeline else None
         self._started = False
         self._ended = False
         self._waitingForEnd = []
@@ -884,9 +1421,53 @@ class CommandBlock(object):
 
     def _startExecuting(self):
         self._started = True
-        self._spool._unspool(_Unspooler(self))
+        if self._pipeline is not None:
+            if self._ended:
+                self._flushPipeline()
+        else:
+            self._spool._unspool(_Unspooler(self))
         return self._endDeferred
 
+    def _enpipeline(self, command, a):
+        """
+        Queue a command to be executed when this pipelined block is flushed.
+
+        @return: a L{Deferred} firing with the command's result.
+        """
+        d = Deferred()
+        self._pipeline.append((command, a, d))
+        return d
+
+    def _flushPipeline(self):
+        """
+        Send all the commands queued on this pipelined block to the
+        transaction as a single unit, and deliver each one's result when they
+        have all been executed.
+        """
+        queued = self._pipeline
+        self._pipeline = []
+        if not queued:
+            return
+
+        def deliver(results):
+            for (success, result), (_ignore_c, _ignore_a, d) in zip(
+                results, queued
+            ):
+                if success:
+                    d.callback(result)
+                else:
+                    d.errback(result)
+
+        def failAll(f):
+            for _ignore_c, _ignore_a, d in queued:
+                d.errback(f)
+
+        self._singleTxn._execForBlock(
+            "_execPipeline",
+            ([(command, a) for command, a, _ignore_d in queued],),
+            self
+        ).addCallbacks(deliver, failAll)
+
     def execSQL(self, sql, args=None, raiseOnZeroRowCount=None, track=True):
         """
         Execute some SQL within this command block.
@@ -906,7 +1487,9 @@ class CommandBlock(object):
 
         self._singleTxn._checkComplete()
 
-        if self._singleTxn._currentBlock is self and self._started:
+        if self._pipeline is not None:
+            d = self._enpipeline("execSQL", (sql, args, raiseOnZeroRowCount))
+        elif self._singleTxn._currentBlock is self and self._started:
             d = self._singleTxn._execSQLForBlock(
                 sql, args, raiseOnZeroRowCount, self)
         else:
@@ -917,6 +1500,35 @@ class CommandBlock(object):
 
         return d
 
+    def execSQLMany(self, sql, argsList, track=True):
+        """
+        Execute some SQL once for each set of arguments within this command
+        block.
+
+        @param sql: the SQL string to execute.
+
+        @param argsList: a C{list} of SQL arguments, one for each execution.
+
+        @param track: see L{CommandBlock.execSQL}
+        """
+        if track and self._ended:
+            raise AlreadyFinishedError()
+
+        self._singleTxn._checkComplete()
+
+        if self._pipeline is not None:
+            d = self._enpipeline("execSQLMany", (sql, argsList))
+        elif self._singleTxn._currentBlock is self and self._started:
+            d = self._singleTxn._execForBlock(
+                "execSQLMany", (sql, argsList), self)
+        else:
+            d = self._spool.execSQLMany(sql, argsList)
+
+        if track:
+            self._trackForEnd(d)
+
+        return d
+
     def _trackForEnd(self, d):
         """
         Watch the following L{Deferred}, since we need to watch it to determine
@@ -935,6 +1547,8 @@ class CommandBlock(object):
         if self._ended:
             raise AlreadyFinishedError()
         self._ended = True
+        if self._pipeline is not None and self._started:
+            self._flushPipeline()
 
         # TODO: maybe this should return a Deferred that's a clone of
         # _endDeferred, so that callers can determine when the block is really
@@ -1015,6 +1629,107 @@ def _fork(x):
     return d
 
 
+class _OrderedSet(object):
+    """
+    An insertion-ordered set of transactions, supporting constant-time
+    addition, removal and membership tests.
+    """
+
+    def __init__(self):
+        self._items = OrderedDict()
+
+    def append(self, item):
+        self._items[item] = None
+
+    def remove(self, item):
+        del self._items[item]
+
+    def first(self):
+        """
+        @return: the earliest-added item still in this set.
+        """
+        return next(iter(self._items))
+
+    def __contains__(self, item):
+        return item in self._items
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+
+class _WaitingQueue(object):
+    """
+    The queue of L{_SingleTxn}s waiting for a connection.  Transactions are
+    handed out highest priority first, and in the order they were added within
+    the same priority.  Adding, removing and popping a transaction take
+    constant time for any fixed number of distinct priorities.
+
+    @ivar _levels: a mapping of priority to an L{OrderedDict} whose keys are
+        the transactions waiting at that priority.
+
+    @ivar _priorities: the priorities which currently have a waiting
+        transaction, in ascending order.
+
+    @ivar _priorityOf: a mapping of each waiting transaction to its priority.
+    """
+
+    def __init__(self):
+        self._levels = {}
+        self._priorities = []
+        self._priorityOf = {}
+
+    def append(self, txn, priority=0):
+        """
+        Add a transaction to the end of the queue for the given priority.
+        """
+        level = self._levels.get(priority)
+        if level is None:
+            level = self._levels[priority] = OrderedDict()
+            insort(self._priorities, priority)
+        level[txn] = None
+        self._priorityOf[txn] = priority
+
+    def remove(self, txn):
+        """
+        Remove the given transaction from the queue.
+        """
+        priority = self._priorityOf.pop(txn)
+        level = self._levels[priority]
+        del level[txn]
+        if not level:
+            del self._levels[priority]
+            self._priorities.remove(priority)
+
+    def first(self):
+        """
+        @return: the transaction which would be returned by L{popleft}.
+        """
+        return next(iter(self._levels[self._priorities[-1]]))
+
+    def popleft(self):
+        """
+        Remove and return the next transaction that should be given a
+        connection.
+        """
+        txn = self.first()
+        self.remove(txn)
+        return txn
+
+    def __contains__(self, txn):
+        return txn in self._priorityOf
+
+    def __iter__(self):
+        for priority in reversed(self._priorities):
+            for txn in self._levels[priority]:
+                yield txn
+
+    def __len__(self):
+        return len(self._priorityOf)
+
+
 class ConnectionPool(Service, object):
     """
     This is a central service that has a threadpool and executes SQL statements
@@ -1034,28 +1749,73 @@ class ConnectionPool(Service, object):
 
     @type reactor: L{IReactorTime} and L{IReactorThreads} provider.
 
-    @ivar _free: The list of free L{_ConnectedTxn} objects which are not
+    @ivar metrics: Counters and histograms describing this pool's usage; see
+        L{PoolMetrics.snapshot}.
+    @type metrics: L{PoolMetrics}
+
+    @ivar waitingPriorities: A mapping of transaction labels (or label
+        prefixes) to priorities.  When no connection is free, waiting
+        transactions with a higher priority are given the next connection
+        before those with a lower one; unlisted labels have priority C{0}.
+        When several prefixes match a label the longest one is used.
+    @type waitingPriorities: C{dict} of C{str}: C{int}
+
+    @ivar _free: The queue of free L{_ConnectedTxn} objects which are not
         currently attached to a L{_SingleTxn} object, and have active
         connections ready for processing a new transaction.
+    @type _free: L{deque}
 
-    @ivar _busy: The list of busy L{_ConnectedTxn} objects; those currently
+    @ivar _busy: The set of busy L{_ConnectedTxn} objects; those currently
         servicing an unfinished L{_SingleTxn} object.
+    @type _busy: L{_OrderedSet}
 
-    @ivar _finishing: The list of 2-tuples of L{_ConnectedTxn} objects which
+    @ivar _finishing: The set of 2-tuples of L{_ConnectedTxn} objects which
         have had C{abort} or C{commit} called on them, but are not done
         executing that method, and the L{Deferred} returned from that method
         that will be fired when its execution has completed.
+    @type _finishing: L{_OrderedSet}
 
-    @ivar _waiting: The list of L{_SingleTxn} objects attached to a
+    @ivar _waiting: The queue of L{_SingleTxn} objects attached to a
         L{_WaitingTxn}; i.e. those which are awaiting a connection to become
         free so that they can be executed.
+    @type _waiting: L{_WaitingQueue}
 
     @ivar _stopping: Is this L{ConnectionPool} in the process of shutting down?
         (If so, new connections will not be established.)
+
+    @ivar statementCache: The cache of SQL generated for cacheable DAL
+        statements (see L{twext.enterprise.dal.syntax._Statement.cached})
+        executed on transactions from this pool, or C{None} if caching is
+        disabled.  Its C{hits} and C{misses} attributes count lookups.
+    @type statementCache: L{StatementCache}
+
+    @ivar prepareStatements: Should each connection prepare the statements
+        executed on it, and re-use those prepared statements for later
+        executions of the same SQL?  How statements are prepared depends on
+        the dialect: C{PREPARE}/C{EXECUTE} for PostgreSQL, C{cursor.prepare}
+        for Oracle, and the DB-API module's own statement cache for SQLite.
+    @type prepareStatements: C{bool}
+
+    @ivar minConnections: The number of connections established when the
+        service starts, and below which idle connections are not released.
+    @type minConnections: C{int}
+
+    @ivar idleTimeout: The number of seconds after which a connection which
+        has not been used is released, or C{None} to keep connections open
+        until the service stops.
+    @type idleTimeout: C{float}
+
+    @ivar probeInterval: The number of seconds after which a connection which
+        has not been used is checked, by executing a trivial statement on it,
+        and replaced if it has failed; or C{None} to never check.
+    @type probeInterval: C{float}
     """
 
     reactor = _reactor
 
+    _reapCall = None
+    _probeCall = None
+
     RETRY_TIMEOUT = 10.0
 
     def __init__(
@@ -1063,6 +1823,12 @@ class ConnectionPool(Service, object):
         connectionFactory, maxConnections=10,
         dbtype=None,
         name=None,
+        statementCacheSize=DEFAULT_STATEMENT_CACHE_SIZE,
+        prepareStatements=False,
+        waitingPriorities=None,
+        minConnections=0,
+        idleTimeout=None,
+        probeInterval=None,
     ):
 
         super(ConnectionPool, self).__init__()
@@ -1071,12 +1837,19 @@ class ConnectionPool(Service, object):
         self.dbtype = dbtype if dbtype is not None else DEFAULT_DBTYPE.copyreplace()
         if name is not None:
             self.name = name
-
-        self._free = []
-        self._busy = []
-        self._waiting = []
-        self._finishing = []
+        self.statementCache = StatementCache(statementCacheSize) if statementCacheSize else None
+        self.prepareStatements = prepareStatements
+        self.waitingPriorities = dict(waitingPriorities or {})
+        self.minConnections = min(minConnections, maxConnections)
+        self.idleTimeout = idleTimeout
+        self.probeInterval = probeInterval
+
+        self._free = deque()
+        self._busy = _OrderedSet()
+        self._waiting = _WaitingQueue()
+        self._finishing = _OrderedSet()
         self._stopping = False
+        self.metrics = PoolMetrics(self)
 
     def startService(self):
         """
@@ -1088,6 +1861,12 @@ class ConnectionPool(Service, object):
         super(ConnectionPool, self).startService()
         tp = self.reactor.getThreadPool()
         self.reactor.suggestThreadPoolSize(tp.max + self.maxConnections)
+        for _ignore in xrange(self.minConnections - self._connectionCount()):
+            self._startOneMore()
+        if self.idleTimeout is not None:
+            self._scheduleReap()
+        if self.probeInterval is not None:
+            self._scheduleProbe()
 
     @inlineCallbacks
     def stopService(self):
@@ -1097,25 +1876,29 @@ class ConnectionPool(Service, object):
         """
         super(ConnectionPool, self).stopService()
         self._stopping = True
+        for call in self._reapCall, self._probeCall:
+            if call is not None:
+                call.cancel()
+        self._reapCall = self._probeCall = None
 
         # Phase 1: Cancel any transactions that are waiting so they won't try
         # to eagerly acquire new connections as they flow into the free-list.
         while self._waiting:
-            waiting = self._waiting[0]
+            waiting = self._waiting.first()
             waiting._stopWaiting()
 
         # Phase 2: All of the busy transactions must be terminated first.  As each
         # one is terminated, it will remove itself from the list. Note we terminate
         # and not abort the transaction to ensure they cannot be re-used.
         while self._busy:
-            yield self._busy[0].terminate()
+            yield self._busy.first().terminate()
 
         # Phase 3: Wait for all the Deferreds from the L{_ConnectedTxn}s that
         # have *already* been stopped. Note we do this AFTER clearing out
         # self._busy, to make sure any that were busy have properly finished
         # (been added to self._free) before we clear out the free ones.
         while self._finishing:
-            yield _fork(self._finishing[0][1])
+            yield _fork(self._finishing.first()[1])
 
         # Phase 4: All transactions should now be in the free list, since
         # "abort()" will have put them there.  Shut down all the associated
@@ -1137,12 +1920,49 @@ class ConnectionPool(Service, object):
         """
         return ThreadHolder(self.reactor)
 
-    def connection(self, label="<unlabeled>"):
+    def _createPreparer(self, connection, cursor):
+        """
+        Create a L{_StatementPreparer} for a newly-established connection.
+
+        @return: a L{_StatementPreparer}, or C{None} if statements are not to
+            be prepared.
+        """
+        if not self.prepareStatements:
+            return None
+        preparerType = _preparers.get(self.dbtype.dialect, _SimulatedPreparer)
+        return preparerType(connection, cursor, self.dbtype.paramstyle)
+
+    def _waitingPriority(self, label):
+        """
+        Determine the priority with which a transaction waits for a
+        connection.
+
+        @param label: the transaction's label.
+        @type label: C{str}
+
+        @return: the priority from L{ConnectionPool.waitingPriorities}.
+        @rtype: C{int}
+        """
+        priorities = self.waitingPriorities
+        if not priorities:
+            return 0
+        if label in priorities:
+            return priorities[label]
+        matches = [prefix for prefix in priorities if label.startswith(prefix)]
+        if not matches:
+            return 0
+        return priorities[max(matches, key=len)]
+
+    def connection(self, label="<unlabeled>", readOnly=False):
         """
         Find and immediately return an L{IAsyncTransaction} object.  Execution
         of statements, commit and abort on that transaction may be delayed
         until a real underlying database connection is available.
 
+        @param readOnly: Will the transaction only read?  If so, DAL statements
+            which write or lock will refuse to execute on it.
+        @type readOnly: C{bool}
+
         @return: an L{IAsyncTransaction}
         """
         if self._stopping:
@@ -1151,9 +1971,12 @@ class ConnectionPool(Service, object):
             return _NoTxn(self, "txn created while DB pool shutting down", label=label)
 
         if self._free:
-            basetxn = self._free.pop(0)
+            # Most recently used first, so that the least recently used
+            # connections stay idle long enough to be reaped.
+            basetxn = self._free.pop()
             basetxn._label = label
             self._busy.append(basetxn)
+            self._checkOut(basetxn, 0.0)
             txn = _SingleTxn(self, basetxn)
             log.debug(
                 "ConnectionPool: txn busy '{label}': free={free}, busy={busy}, waiting={waiting}",
@@ -1164,9 +1987,11 @@ class ConnectionPool(Service, object):
             )
         else:
             txn = _SingleTxn(self, _WaitingTxn(self, label=label))
-            self._waiting.append(txn)
+            txn._waitingSince = self.reactor.seconds()
+            self._waiting.append(txn, self._waitingPriority(label))
             blocked = self._activeConnectionCount() >= self.maxConnections
             if blocked:
+                self.metrics.blocked += 1
                 txn._blocked_waiting_time = time.time()
                 log.warn("ConnectionPool: txn blocked '{label}'", label=label)
             log.debug(
@@ -1182,14 +2007,108 @@ class ConnectionPool(Service, object):
             if not blocked:
                 self._startOneMore()
 
+        if readOnly:
+            txn.readOnly = True
         return txn
 
+    def _checkOut(self, txn, waited):
+        """
+        Note that a L{_ConnectedTxn} has been given to a transaction.
+
+        @param waited: how long the transaction waited for it, in seconds.
+        @type waited: C{float}
+        """
+        txn._checkedOut = self.reactor.seconds()
+        self.metrics.checkedOut(waited)
+
     def _activeConnectionCount(self):
         """
         @return: the number of active outgoing connections to the database.
         """
         return len(self._busy) + len(self._finishing)
 
+    def _connectionCount(self):
+        """
+        @return: the number of outgoing connections to the database, whether
+            active or idle.
+        """
+        return len(self._free) + self._activeConnectionCount()
+
+    def _scheduleReap(self):
+        self._reapCall = self.reactor.callLater(
+            self.idleTimeout / 2.0, self._reapIdle
+        )
+
+    def _reapIdle(self):
+        """
+        Release free connections which have been idle for longer than
+        L{ConnectionPool.idleTimeout}, down to
+        L{ConnectionPool.minConnections}.  The free list is kept in the order
+        connections became idle, so those to release are at its start.
+        """
+        self._reapCall = None
+        cutoff = self.reactor.seconds() - self.idleTimeout
+        free = self._free
+        while (
+            free and free[0]._idleSince <= cutoff and
+            self._connectionCount() > self.minConnections
+        ):
+            self.metrics.reaped += 1
+            free.popleft()._releaseConnection()
+        self._scheduleReap()
+
+    def _scheduleProbe(self):
+        self._probeCall = self.reactor.callLater(
+            self.probeInterval, self._probeIdle
+        )
+
+    def _probeIdle(self):
+        """
+        Check that each free connection which has been idle for longer than
+        L{ConnectionPool.probeInterval} is still alive.  While it is being
+        checked a connection is treated as busy.
+        """
+        self._probeCall = None
+        cutoff = self.reactor.seconds() - self.probeInterval
+        free = self._free
+        probing = []
+        while free and free[0]._idleSince <= cutoff:
+            probing.append(free.popleft())
+        for txn in probing:
+            self._busy.append(txn)
+            txn._probe().addCallbacks(
+                self._probeSucceeded, self._probeFailed,
+                callbackArgs=(txn,), errbackArgs=(txn,),
+            )
+        self._scheduleProbe()
+
+    def _probeSucceeded(self, result, txn):
+        """
+        A connection passed its liveness check; make it available again,
+        without changing how long it has been idle for.
+        """
+        if txn not in self._busy:
+            # Terminated by stopService while being checked.
+            return
+        self._busy.remove(txn)
+        self._repoolNow(txn, idle=True)
+
+    def _probeFailed(self, f, txn):
+        """
+        A connection failed its liveness check; release it, and replace it if
+        it is needed.
+        """
+        log.failure("Idle database connection failed liveness check", failure=f)
+        self.metrics.probeFailures += 1
+        if txn not in self._busy:
+            return
+        self._busy.remove(txn)
+        txn._releaseConnection()
+        if not self._stopping and (
+            self._waiting or self._connectionCount() < self.minConnections
+        ):
+            self._startOneMore()
+
     def _startOneMore(self):
         """
         Start one more L{_ConnectedTxn}. What happens here is that we first create a
@@ -1238,6 +2157,11 @@ class ConnectionPool(Service, object):
         fired.
         """
         self._busy.remove(txn)
+        if txn._checkedOut is not None:
+            self.metrics.released(
+                txn._label, self.reactor.seconds() - txn._checkedOut,
+                txn._statementCount,
+            )
         finishRecord = (txn, d)
         self._finishing.append(finishRecord)
 
@@ -1254,14 +2178,22 @@ class ConnectionPool(Service, object):
 
         return d.addCallbacks(repool, discard)
 
-    def _repoolNow(self, txn):
+    def _repoolNow(self, txn, idle=False):
         """
         Recycle a L{_ConnectedTxn} into the free list.
+
+        @param idle: C{True} if C{txn} was taken from the free list without
+            being used (to check that its connection is alive), so it is
+            already reset, and keeps its place among the idle connections
+            if nothing is waiting for it.
+        @type idle: C{bool}
         """
-        txn.reset()
+        if not idle:
+            txn.reset()
         if self._waiting:
-            waiting = self._waiting.pop(0)
+            waiting = self._waiting.popleft()
             self._busy.append(txn)
+            self._checkOut(txn, self.reactor.seconds() - waiting._waitingSince)
             waiting._unspoolOnto(txn)
             if hasattr(waiting, "_blocked_waiting_time"):
                 log.warn(
@@ -1280,7 +2212,10 @@ class ConnectionPool(Service, object):
             # If we are stopping, never add to the free list - release it
             if self._stopping:
                 txn._releaseConnection()
+            elif idle:
+                self._free.appendleft(txn)
             else:
+                txn._idleSince = self.reactor.seconds()
                 self._free.append(txn)
                 log.debug(
                     "ConnectionPool: txn free '{label}': free={free}, busy={busy}, waiting={waiting}",
@@ -1291,12 +2226,180 @@ class ConnectionPool(Service, object):
                 )
 
 
+# Reports how many seconds a PostgreSQL streaming replica is behind its
+# primary: none if it has replayed all the WAL it has received, otherwise the
+# age of the last transaction it replayed.  (Comparing the last replay time
+# with now alone would make an idle primary look like a lagging replica.)
+DEFAULT_REPLICA_LAG_QUERY = (
+    "select case when pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() "
+    "then 0 else coalesce(extract(epoch from "
+    "now() - pg_last_xact_replay_timestamp()), 0) end"
+)
+
+
+class RoutingConnectionPool(MultiService, object):
+    """
+    A service which hands out transactions from a primary L{ConnectionPool}
+    or, for read-only transactions, from one of several replica
+    L{ConnectionPool}s.
+
+    Read-only transactions go to the replica with the fewest busy and waiting
+    transactions, skipping replicas which are too far behind the primary.  If
+    no replica is usable they go to the primary.  Transactions which are not
+    read-only, and so may write or lock, always go to the primary.
+
+    @ivar primary: the pool for the primary database.
+    @type primary: L{ConnectionPool}
+
+    @ivar replicas: the pools for the replica databases.
+    @type replicas: C{list} of L{ConnectionPool}
+
+    @ivar readOnlyLabels: prefixes of transaction labels which are read-only
+        unless C{readOnly} is passed to L{RoutingConnectionPool.connection}
+        explicitly.  This lets existing callers, such as those which only use
+        L{Record.query} or L{Record.count}, be moved to the replicas without
+        being changed.
+    @type readOnlyLabels: C{tuple} of C{str}
+
+    @ivar maxReplicaLag: the number of seconds a replica may be behind the
+        primary and still be used, or C{None} to not check.
+    @type maxReplicaLag: C{float}
+
+    @ivar lagCheckInterval: how often, in seconds, to check replica lag.
+    @type lagCheckInterval: C{float}
+
+    @ivar lagQuery: the SQL which returns a replica's lag, in seconds.
+    @type lagQuery: C{str}
+
+    @ivar _lag: the lag of each replica, as of the last check, or C{None} if
+        the last check failed.
+    @type _lag: C{dict} of L{ConnectionPool}: C{float}
+    """
+
+    reactor = _reactor
+
+    _lagCheckCall = None
+
+    def __init__(
+        self, primary, replicas=(), readOnlyLabels=(), maxReplicaLag=None,
+        lagCheckInterval=10.0, lagQuery=DEFAULT_REPLICA_LAG_QUERY,
+    ):
+        super(RoutingConnectionPool, self).__init__()
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.readOnlyLabels = tuple(readOnlyLabels)
+        self.maxReplicaLag = maxReplicaLag
+        self.lagCheckInterval = lagCheckInterval
+        self.lagQuery = lagQuery
+        self._lag = dict((replica, 0) for replica in self.replicas)
+        for pool in [self.primary] + self.replicas:
+            pool.setServiceParent(self)
+
+    @property
+    def dbtype(self):
+        return self.primary.dbtype
+
+    def startService(self):
+        super(RoutingConnectionPool, self).startService()
+        if self.maxReplicaLag is not None and self.replicas:
+            self._checkLag()
+
+    def stopService(self):
+        if self._lagCheckCall is not None:
+            self._lagCheckCall.cancel()
+            self._lagCheckCall = None
+        return super(RoutingConnectionPool, self).stopService()
+
+    def _isReadOnly(self, label):
+        for prefix in self.readOnlyLabels:
+            if label.startswith(prefix):
+                return True
+        return False
+
+    def _usable(self, replica):
+        """
+        Is the given replica close enough to the primary to be used?
+        """
+        if self.maxReplicaLag is None:
+            return True
+        lag = self._lag[replica]
+        return lag is not None and lag <= self.maxReplicaLag
+
+    def _chooseReplica(self):
+        """
+        Choose the usable replica with the fewest outstanding transactions.
+
+        @return: a L{ConnectionPool}, or C{None} if no replica is usable.
+        """
+        best = None
+        bestOutstanding = None
+        for replica in self.replicas:
+            if not self._usable(replica):
+                continue
+            outstanding = (
+                replica._activeConnectionCount() + len(replica._waiting)
+            )
+            if best is None or outstanding < bestOutstanding:
+                best = replica
+                bestOutstanding = outstanding
+        return best
+
+    def connection(self, label="<unlabeled>", readOnly=None):
+        """
+        Create a transaction on the primary or on a replica.
+
+        @param readOnly: Will the transaction only read?  If C{None}, it is if
+            its label starts with one of
+            L{RoutingConnectionPool.readOnlyLabels}.
+        @type readOnly: C{bool}
+
+        @return: an L{IAsyncTransaction}
+        """
+        if readOnly is None:
+            readOnly = self._isReadOnly(label)
+        pool = self._chooseReplica() if readOnly else None
+        if pool is None:
+            pool = self.primary
+        return pool.connection(label, readOnly=readOnly)
+
+    @inlineCallbacks
+    def _checkLag(self):
+        """
+        Measure the lag of each replica, then schedule the next check.
+        """
+        self._lagCheckCall = None
+        try:
+            for replica in self.replicas:
+                txn = replica.connection("replica lag check", readOnly=True)
+                try:
+                    rows = yield txn.execSQL(self.lagQuery)
+                    lag = float(rows[0][0])
+                    yield txn.commit()
+                except Exception:
+                    log.failure("Replica lag check failed")
+                    self._lag[replica] = None
+                    try:
+                        yield txn.abort()
+                    except AlreadyFinishedError:
+                        # The commit itself failed.
+                        pass
+                else:
+                    self._lag[replica] = lag
+        finally:
+            if self.running:
+                self._lagCheckCall = self.reactor.callLater(
+                    self.lagCheckInterval, self._checkLag
+                )
+
+
 def txnarg():
     return [("transactionID", Integer())]
 
 
 CHUNK_MAX = 0xffff
 
+DEFAULT_ROW_BATCH_SIZE = 100
+
 
 class BigArgument(Argument):
     """
@@ -1311,9 +2414,14 @@ class BigArgument(Argument):
             if chunk is None:
                 break
             value.write(chunk)
+        if self.optional and not counter:
+            objects[name] = None
+            return
         objects[name] = self.fromString(value.getvalue())
 
     def toBox(self, name, strings, objects, proto):
+        if self.optional and objects.get(name) is None:
+            return
         value = StringIO(self.toString(objects[name]))
         for counter in count():
             nextChunk = value.read(CHUNK_MAX)
@@ -1396,8 +2504,23 @@ class ExecSQL(Command):
         ("queryID", String()),
         ("args", Pickle()),
         ("blockID", String()),
-        ("reportZeroRowCount", Boolean())
+        ("reportZeroRowCount", Boolean()),
+        # Sent by clients which understand L{Rows}; ignored by older servers.
+        ("rowBatchSize", Integer(optional=True)),
+    ] + txnarg()
+    errors = _quashErrors
+
+
+class ExecSQLMany(Command):
+    """
+    Execute an SQL statement once for each of a list of sets of arguments.
+    """
+    arguments = [
+        ("sql", String()),
+        ("argsList", Pickle()),
+        ("blockID", String()),
     ] + txnarg()
+    response = [("rowcount", Integer())]
     errors = _quashErrors
 
 
@@ -1405,7 +2528,10 @@ class StartBlock(Command):
     """
     Create a new SQL command block.
     """
-    arguments = [("blockID", String())] + txnarg()
+    arguments = [
+        ("blockID", String()),
+        ("pipeline", Boolean(optional=True)),
+    ] + txnarg()
     errors = _quashErrors
 
 
@@ -1427,16 +2553,29 @@ class Row(Command):
     errors = _quashErrors
 
 
+class Rows(Command):
+    """
+    A batch of rows has been returned.  Sent from server to client in response
+    to L{ExecSQL}, instead of L{Row}, if the client specified a
+    C{rowBatchSize}.
+    """
+
+    arguments = [("queryID", String()), ("rows", Pickle())]
+    errors = _quashErrors
+
+
 class QueryComplete(Command):
     """
-    A query issued with L{ExecSQL} is complete.
+    A query issued with L{ExecSQL} is complete.  If the client specified a
+    C{rowBatchSize}, the final batch of rows may be included as C{rows}.
     """
 
     arguments = [
         ("queryID", String()),
         ("norows", Boolean()),
         ("derived", Pickle()),
-        ("noneResult", Boolean())
+        ("noneResult", Boolean()),
+        ("rows", Pickle(optional=True)),
     ]
     errors = _quashErrors
 
@@ -1451,6 +2590,15 @@ class Abort(Command):
     errors = _quashErrors
 
 
+class PoolStats(Command):
+    """
+    Retrieve the metrics of the server's connection pool, as returned by
+    L{PoolMetrics.snapshot}.
+    """
+    response = [("stats", Pickle())]
+    errors = _quashErrors
+
+
 class _NoRows(Exception):
     """
     Placeholder exception to report zero rows.
@@ -1489,8 +2637,10 @@ class ConnectionPoolConnection(AMP):
         return {}
 
     @failsafeResponder(StartBlock)
-    def startBlock(self, transactionID, blockID):
-        self._blocks[blockID] = self._txns[transactionID].commandBlock()
+    def startBlock(self, transactionID, blockID, pipeline=False):
+        self._blocks[blockID] = self._txns[transactionID].commandBlock(
+            bool(pipeline)
+        )
         return {}
 
     @failsafeResponder(EndBlock)
@@ -1501,9 +2651,10 @@ class ConnectionPoolConnection(AMP):
     @failsafeResponder(ExecSQL)
     @inlineCallbacks
     def receivedSQL(self, transactionID, queryID, sql, args, blockID,
-                    reportZeroRowCount):
+                    reportZeroRowCount, rowBatchSize=None):
         derived = None
         noneResult = False
+        finalRows = None
 
         for param in args:
             if IDerivedParameter.providedBy(param):
@@ -1527,20 +2678,40 @@ class ConnectionPoolConnection(AMP):
             norows = True
         else:
             norows = False
-            if rows is not None:
+            if rows is None:
+                noneResult = True
+            elif rowBatchSize:
+                # Send full batches now, and the remainder along with
+                # QueryComplete.
+                last = len(rows) - (len(rows) % rowBatchSize or rowBatchSize)
+                for start in xrange(0, last, rowBatchSize):
+                    self.callRemote(
+                        Rows, queryID=queryID,
+                        rows=rows[start:start + rowBatchSize]
+                    )
+                finalRows = rows[last:] or None
+            else:
                 for row in rows:
                     # Either this should be yielded or it should be
                     # requiresAnswer=False
                     self.callRemote(Row, queryID=queryID, row=row)
-            else:
-                noneResult = True
 
         self.callRemote(
             QueryComplete, queryID=queryID, norows=norows,
-            derived=derived, noneResult=noneResult
+            derived=derived, noneResult=noneResult, rows=finalRows
         )
         returnValue({})
 
+    @failsafeResponder(ExecSQLMany)
+    @inlineCallbacks
+    def receivedSQLMany(self, transactionID, sql, argsList, blockID):
+        if blockID:
+            txn = self._blocks[blockID]
+        else:
+            txn = self._txns[transactionID]
+        rowcount = yield txn.execSQLMany(sql, argsList)
+        returnValue({"rowcount": rowcount})
+
     def _complete(self, transactionID, thunk):
         txn = self._txns.pop(transactionID)
         return thunk(txn).addCallback(lambda ignored: {})
@@ -1563,6 +2734,13 @@ class ConnectionPoolConnection(AMP):
             return x.abort()
         return self._complete(transactionID, abortme)
 
+    @failsafeResponder(PoolStats)
+    def poolStats(self):
+        """
+        Report the metrics of the connection pool.
+        """
+        return {"stats": self.pool.metrics.snapshot()}
+
 
 class ConnectionPoolClient(AMP):
     """
@@ -1571,13 +2749,24 @@ class ConnectionPoolClient(AMP):
 
     def __init__(
         self, dbtype=DEFAULT_DBTYPE,
+        statementCacheSize=DEFAULT_STATEMENT_CACHE_SIZE,
+        rowBatchSize=DEFAULT_ROW_BATCH_SIZE,
     ):
+        """
+        @param rowBatchSize: the maximum number of result rows the server
+            should send in each L{Rows} command, or C{None} to have them sent
+            one at a time with L{Row}.  Servers which do not support L{Rows}
+            will always send L{Row}s.
+        @type rowBatchSize: C{int}
+        """
         # See DEFAULT_PARAM_STYLE FIXME above.
         super(ConnectionPoolClient, self).__init__()
         self._nextID = count().next
         self._txns = weakref.WeakValueDictionary()
         self._queries = {}
         self.dbtype = dbtype if dbtype is not None else DEFAULT_DBTYPE.copyreplace()
+        self.statementCache = StatementCache(statementCacheSize) if statementCacheSize else None
+        self.rowBatchSize = rowBatchSize
 
     def unhandledError(self, failure):
         """
@@ -1604,14 +2793,34 @@ class ConnectionPoolClient(AMP):
         self.callRemote(StartTxn, transactionID=txnid)
         return txn
 
+    def poolStats(self):
+        """
+        Retrieve the metrics of the connection pool on the other end of the
+        wire.
+
+        @return: a L{Deferred} firing with the C{dict} returned by
+            L{PoolMetrics.snapshot}.
+        """
+        return self.callRemote(PoolStats).addCallback(
+            lambda response: response["stats"]
+        )
+
     @failsafeResponder(Row)
     def row(self, queryID, row):
         self._queries[queryID].row(row)
         return {}
 
+    @failsafeResponder(Rows)
+    def rows(self, queryID, rows):
+        self._queries[queryID].rows(rows)
+        return {}
+
     @failsafeResponder(QueryComplete)
-    def complete(self, queryID, norows, derived, noneResult):
-        self._queries.pop(queryID).done(norows, derived, noneResult)
+    def complete(self, queryID, norows, derived, noneResult, rows=None):
+        query = self._queries.pop(queryID)
+        if rows is not None:
+            query.rows(rows)
+        query.done(norows, derived, noneResult)
         return {}
 
 
@@ -1630,6 +2839,12 @@ class _Query(object):
         """
         self.results.append(row)
 
+    def rows(self, rows):
+        """
+        A batch of rows was received.
+        """
+        self.results.extend(rows)
+
     def done(self, norows, derived, noneResult):
         """
         The query is complete.
@@ -1704,6 +2919,13 @@ class _NetTransaction(_CommitAndAbortHooks):
         """
         return self._client.dbtype
 
+    @property
+    def statementCache(self):
+        """
+        Forward C{statementCache} attribute to the client.
+        """
+        return self._client.statementCache
+
     def execSQL(self, sql, args=None, raiseOnZeroRowCount=None, blockID=""):
         if not blockID:
             if self._completed:
@@ -1719,11 +2941,33 @@ class _NetTransaction(_CommitAndAbortHooks):
                 ExecSQL, queryID=queryID, sql=sql, args=args,
                 transactionID=self._transactionID, blockID=blockID,
                 reportZeroRowCount=raiseOnZeroRowCount is not None,
+                rowBatchSize=client.rowBatchSize,
             )
             .addCallback(lambda nothing: query.deferred)
         )
         return result
 
+    def execSQLStreaming(self, sql, args=None, batchSize=100):
+        """
+        Execute some SQL and provide its results as an L{IRowStream}.
+
+        The results are transferred from the server in the same way as for
+        L{_NetTransaction.execSQL}; only the delivery to application code is
+        incremental.
+        """
+        return self.execSQL(sql, args).addCallback(
+            _BufferedRowStream, batchSize
+        )
+
+    def execSQLMany(self, sql, argsList, blockID=""):
+        if not blockID:
+            if self._completed:
+                raise AlreadyFinishedError()
+        return self._client.callRemote(
+            ExecSQLMany, sql=sql, argsList=argsList,
+            transactionID=self._transactionID, blockID=blockID,
+        ).addCallback(lambda response: response["rowcount"])
+
     def _complete(self, command):
         if self._completed:
             raise AlreadyFinishedError()
@@ -1749,12 +2993,13 @@ class _NetTransaction(_CommitAndAbortHooks):
         self._preCommit.clear()
         return self._complete(Abort).addCallback(self._abort.runHooks)
 
-    def commandBlock(self):
+    def commandBlock(self, pipeline=False):
         if self._completed:
             raise AlreadyFinishedError()
         blockID = str(self._client._nextID())
         self._client.callRemote(
-            StartBlock, blockID=blockID, transactionID=self._transactionID
+            StartBlock, blockID=blockID, transactionID=self._transactionID,
+            pipeline=pipeline,
         )
         return _NetCommandBlock(self, blockID)
 
@@ -1787,6 +3032,13 @@ class _NetCommandBlock(object):
         """
         return self._transaction.dbtype
 
+    @property
+    def statementCache(self):
+        """
+        Forward C{statementCache} attribute to the transaction.
+        """
+        return self._transaction.statementCache
+
     def execSQL(self, sql, args=None, raiseOnZeroRowCount=None):
         """
         Execute some SQL on this command block.
@@ -1799,6 +3051,17 @@ class _NetCommandBlock(object):
         return self._transaction.execSQL(sql, args, raiseOnZeroRowCount,
                                          self._blockID)
 
+    def execSQLMany(self, sql, argsList):
+        """
+        Execute some SQL many times on this command block.
+        """
+        if (
+            self._ended or self._transaction._completed and
+            not self._transaction._committing or self._transaction._committed
+        ):
+            raise AlreadyFinishedError()
+        return self._transaction.execSQLMany(sql, argsList, self._blockID)
+
     def end(self):
         """
         End this block.
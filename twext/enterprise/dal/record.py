@@ -29,10 +29,12 @@ __all__ = [
     "Record",
 ]
 
+from itertools import izip
+
 from twisted.internet.defer import inlineCallbacks, returnValue
 from twext.enterprise.dal.syntax import (
     Select, Tuple, Constant, ColumnSyntax, Insert, Update, Delete, SavepointAction,
-    Count, ALL_COLUMNS)
+    Count, ALL_COLUMNS, Parameter, _MappedRowStream)
 from twext.enterprise.ienterprise import ORACLE_DIALECT
 from twext.enterprise.util import parseSQLTimestamp
 from twext.python.log import Logger
@@ -62,6 +64,58 @@ class NoSuchRecord(Exception):
     """
 
 
+def _rowLayout(table, colmap):
+    """
+    Work out, once per L{Record} class, how to turn a row of all the columns in
+    a table into record attributes.
+
+    @param table: the table the rows are from.
+    @type table: L{TableSyntax}
+
+    @param colmap: map of L{ColumnSyntax} objects to attribute names.
+    @type colmap: L{dict}
+
+    @return: the attribute name for each column in the row, and C{(index,
+        converter)} for each column whose database value has to be converted.
+    @rtype: 2-C{tuple} of C{tuple}s
+    """
+    names = []
+    converters = []
+    for index, column in enumerate(table):
+        names.append(colmap[column])
+        if column.model.type.name == "timestamp":
+            converters.append((index, parseSQLTimestamp))
+    return tuple(names), tuple(converters)
+
+
+class _CompactAttribute(object):
+    """
+    An attribute of a compact L{Record} (see L{Record.__compact__}), whose
+    value is kept in a slot.  As with the attributes of other records, looking
+    it up on the class, or on an instance where it has not been set, gives its
+    default: the L{ColumnSyntax} for a column.
+    """
+
+    def __init__(self, slot, default):
+        """
+        @param slot: the member descriptor of the slot holding the value.
+        @param default: the value when the slot is empty.
+        """
+        self._slot = slot
+        self._default = default
+
+    def __get__(self, instance, owner=None):
+        if instance is not None:
+            try:
+                return self._slot.__get__(instance, owner)
+            except AttributeError:
+                pass
+        return self._default
+
+    def __set__(self, instance, value):
+        self._slot.__set__(instance, value)
+
+
 class _RecordMeta(type):
     """
     Metaclass for associating a L{fromTable} with a L{Record} at inheritance
@@ -95,6 +149,7 @@ class _RecordMeta(type):
                         namer = base
                 newbases.append(base)
 
+        compact = False
         if table is not None:
             attrmap = {}
             colmap = {}
@@ -103,10 +158,35 @@ class _RecordMeta(type):
                 attrname = namer.namingConvention(column.model.name)
                 attrmap[attrname] = column
                 colmap[column] = attrname
-            ns.update(table=table, __attrmap__=attrmap, __colmap__=colmap)
+            rownames, rowconverters = _rowLayout(table, colmap)
+            ns.update(
+                table=table, __attrmap__=attrmap, __colmap__=colmap,
+                __rownames__=rownames, __rowconverters__=rowconverters,
+            )
             ns.update(attrmap)
 
-        return super(_RecordMeta, cls).__new__(cls, name, tuple(newbases), ns)
+            compact = ns.get("__compact__", False)
+            if compact:
+                # Slots can't have the same names as class attributes, so the
+                # values are kept in private slots behind L{_CompactAttribute}s
+                ns["__slots__"] = tuple(ns.get("__slots__", ())) + tuple(
+                    "_slot_" + attrname
+                    for attrname in ("transaction",) + rownames
+                )
+
+        newcls = super(_RecordMeta, cls).__new__(cls, name, tuple(newbases), ns)
+
+        if compact:
+            defaults = dict(attrmap, transaction=None)
+            for attrname, default in defaults.iteritems():
+                slot = newcls.__dict__["_slot_" + attrname]
+                setattr(newcls, attrname, _CompactAttribute(slot, default))
+            newcls.__rowsetters__ = tuple(
+                newcls.__dict__["_slot_" + attrname].__set__
+                for attrname in rownames
+            )
+
+        return newcls
 
 
 class fromTable(object):
@@ -141,10 +221,37 @@ class Record(object):
 
     @cvar __attrmap__: map of attribute names to L{ColumnSyntax} objects.
     @type __attrmap__: L{dict}
+
+    @cvar __rownames__: the attribute name for each column of C{table}, in
+        order.
+    @type __rownames__: L{tuple}
+
+    @cvar __rowconverters__: C{(index, converter)} for each column of C{table}
+        whose database value has to be converted to an attribute value.
+    @type __rowconverters__: L{tuple}
+
+    @cvar __compact__: Set this to C{True} in a subclass mapped to a table to
+        keep each instance's attributes in slots rather than a C{__dict__},
+        which takes much less memory when many records are loaded at once.
+        Compact records behave like any other, except that they cannot be
+        given attributes that are not columns, unless a base class provides a
+        C{__dict__} for them.  Not supported for classes mapped with
+        L{Record.fromTable}.
+    @type __compact__: L{bool}
+
+    @cvar __rowsetters__: for a compact record, the slot setter for each
+        column of C{table}, in order; otherwise C{None}.
+    @type __rowsetters__: L{tuple}
     """
 
     __metaclass__ = _RecordMeta
 
+    # No __dict__ for compact records
+    __slots__ = ()
+
+    __compact__ = False
+    __rowsetters__ = None
+
     transaction = None
 
     def __setattr__(self, name, value):
@@ -157,6 +264,20 @@ class Record(object):
 
         return super(Record, self).__setattr__(name, value)
 
+    def _setAttributes(self, values):
+        """
+        Set some attributes to match changes made in the database, bypassing
+        the read-only check in L{Record.__setattr__}.
+
+        @param values: map of attribute names to values.
+        @type values: L{dict}
+        """
+        if self.__compact__:
+            for name, value in values.iteritems():
+                object.__setattr__(self, name, value)
+        else:
+            self.__dict__.update(values)
+
     def __repr__(self):
         r = (
             "<{0} record from table {1}"
@@ -192,6 +313,7 @@ class Record(object):
             attrname = cls.namingConvention(column.model.name)
             cls.__attrmap__[attrname] = column
             cls.__colmap__[column] = attrname
+        cls.__rownames__, cls.__rowconverters__ = _rowLayout(table, cls.__colmap__)
 
     @staticmethod
     def namingConvention(columnName):
@@ -224,12 +346,56 @@ class Record(object):
     def _primaryKeyComparison(cls, primaryKey):
         return cls._primaryKeyExpression() == Tuple(map(Constant, primaryKey))
 
+    @classmethod
+    def _primaryKeyParameterComparison(cls):
+        """
+        Like L{_primaryKeyComparison}, but comparing against L{Parameter}s
+        that are bound with the arguments returned by L{_primaryKeyArguments}.
+        """
+        return cls._primaryKeyExpression() == Tuple([
+            Constant(Parameter("pk{}".format(n)))
+            for n in range(len(cls.table.model.primaryKey))
+        ])
+
+    @staticmethod
+    def _primaryKeyArguments(primaryKey):
+        return dict(
+            ("pk{}".format(n), value) for n, value in enumerate(primaryKey)
+        )
+
+    @classmethod
+    def _statement(cls, name, build):
+        """
+        Get a statement that is built once per class and then re-used, so
+        that the SQL generated for it can be cached by the transaction (see
+        L{twext.enterprise.dal.syntax.StatementCache}).
+
+        @param name: the name of the statement, unique within this class.
+        @type name: L{str}
+
+        @param build: 0-argument callable that creates the statement.
+
+        @return: the statement.
+        """
+        statements = cls.__dict__.get("_statements")
+        if statements is None:
+            statements = cls._statements = {}
+        statement = statements.get(name)
+        if statement is None:
+            statement = statements[name] = build().cached()
+        return statement
+
     @classmethod
     @inlineCallbacks
     def load(cls, transaction, *primaryKey):
-        results = yield cls.query(
+        results = yield cls._rowsFromQuery(
             transaction,
-            cls._primaryKeyComparison(primaryKey)
+            cls._statement(
+                "load",
+                lambda: cls.queryExpr(cls._primaryKeyParameterComparison())
+            ),
+            None,
+            **cls._primaryKeyArguments(primaryKey)
         )
         if len(results) != 1:
             raise NoSuchRecord()
@@ -250,6 +416,73 @@ class Record(object):
         yield self.insert(transaction)
         returnValue(self)
 
+    @classmethod
+    @inlineCallbacks
+    def createMany(cls, transaction, kwList):
+        """
+        Create several rows.
+
+        Used like this::
+
+            MyRecord.createMany(transaction, [
+                dict(column1=1, column2=u"two"),
+                dict(column1=3, column2=u"four"),
+            ])
+
+        Runs of records which have a value for every attribute are inserted
+        with a single L{Insert.onMany} call each.  Records which rely on the
+        database to supply some values (such as a primary key from a sequence)
+        are inserted one at a time, since a batched insert cannot return those
+        values.  Either way, rows are inserted in the same order as C{kwList}.
+
+        @return: a L{Deferred} firing with a C{list} of the new records, in
+            the same order as C{kwList}.
+        """
+        records = [cls.make(**k) for k in kwList]
+        attrs = sorted(cls.__attrmap__)
+        complete = []
+        for record in records:
+            if any(
+                isinstance(getattr(record, attr), ColumnSyntax)
+                for attr in attrs
+            ):
+                yield cls._insertMany(transaction, attrs, complete)
+                complete = []
+                yield record.insert(transaction)
+            else:
+                complete.append(record)
+        yield cls._insertMany(transaction, attrs, complete)
+
+        returnValue(records)
+
+    @classmethod
+    @inlineCallbacks
+    def _insertMany(cls, transaction, attrs, records):
+        """
+        Insert some records which have a value for every attribute with a
+        single L{Insert.onMany} call.
+
+        @param attrs: the names of all of this class's attributes, sorted.
+        @type attrs: L{list} of L{str}
+
+        @param records: the records to insert; may be empty.
+        @type records: L{list} of L{Record}
+
+        @return: a L{Deferred} that fires when the records have been inserted.
+        """
+        if records:
+            yield cls._statement(
+                "createMany",
+                lambda: Insert(dict([
+                    (cls.__attrmap__[attr], Parameter(attr)) for attr in attrs
+                ]))
+            ).onMany(transaction, [
+                dict([(attr, getattr(record, attr)) for attr in attrs])
+                for record in records
+            ])
+            for record in records:
+                record.transaction = transaction
+
     @classmethod
     def make(cls, **k):
         """
@@ -347,10 +580,17 @@ class Record(object):
             has been deleted, or fails with L{NoSuchRecord} if the underlying
             row was already deleted.
         """
-        return Delete(
-            From=self.table,
-            Where=self._primaryKeyComparison(self._primaryKeyValue())
-        ).on(self.transaction, raiseOnZeroRowCount=NoSuchRecord)
+        return self._statement(
+            "delete",
+            lambda: Delete(
+                From=self.table,
+                Where=self._primaryKeyParameterComparison()
+            )
+        ).on(
+            self.transaction,
+            raiseOnZeroRowCount=NoSuchRecord,
+            **self._primaryKeyArguments(self._primaryKeyValue())
+        )
 
     @inlineCallbacks
     def update(self, **kw):
@@ -369,7 +609,7 @@ class Record(object):
             Where=self._primaryKeyComparison(self._primaryKeyValue())
         ).on(self.transaction)
 
-        self.__dict__.update(kw)
+        self._setAttributes(kw)
 
     @inlineCallbacks
     def lock(self, where=None):
@@ -444,12 +684,16 @@ class Record(object):
         """
         return cls._rowsFromQuery(
             transaction,
-            Delete(
-                Where=cls._primaryKeyComparison(primaryKey),
-                From=cls.table,
-                Return=list(cls.table)
+            cls._statement(
+                "pop",
+                lambda: Delete(
+                    Where=cls._primaryKeyParameterComparison(),
+                    From=cls.table,
+                    Return=list(cls.table)
+                )
             ),
-            lambda: NoSuchRecord()
+            lambda: NoSuchRecord(),
+            **cls._primaryKeyArguments(primaryKey)
         ).addCallback(lambda x: x[0])
 
     @classmethod
@@ -495,6 +739,41 @@ class Record(object):
             None
         )
 
+    @classmethod
+    def queryIter(cls, transaction, expr, order=None, ascending=True, batchSize=100):
+        """
+        Query the table that corresponds to C{cls}, like L{Record.query}, but
+        retrieve the resulting instances of C{cls} a batch at a time, so that
+        large results need not be held in memory all at once.
+
+        Used like this::
+
+            stream = yield MyRecord.queryIter(transaction, MyRecord.col1 > 7)
+            while True:
+                records = yield stream.nextBatch()
+                if not records:
+                    break
+                ...
+
+        @param expr: see L{Record.query}
+
+        @param order: see L{Record.query}
+
+        @param ascending: see L{Record.query}
+
+        @param batchSize: the maximum number of records in each batch.
+        @type batchSize: L{int}
+
+        @return: a L{Deferred} firing with an L{IRowStream} whose batches are
+            C{list}s of instances of C{cls}.
+        """
+        return cls.queryExpr(
+            expr, order=order, ascending=ascending
+        ).onStreaming(transaction, batchSize).addCallback(
+            _MappedRowStream,
+            lambda rows: cls._recordsFromRows(transaction, rows)
+        )
+
     @classmethod
     def queryExpr(cls, expr, attributes=None, order=None, group=None, limit=None, forUpdate=False, noWait=False, skipLocked=False, ascending=True, distinct=False):
         """
@@ -656,7 +935,7 @@ class Record(object):
 
     @classmethod
     @inlineCallbacks
-    def _rowsFromQuery(cls, transaction, qry, rozrc):
+    def _rowsFromQuery(cls, transaction, qry, rozrc, **kw):
         """
         Execute the given query, and transform its results into instances of
         C{cls}.
@@ -669,18 +948,68 @@ class Record(object):
 
         @param rozrc: The C{raiseOnZeroRowCount} argument.
 
+        @param kw: values for any L{Parameter}s in C{qry}.
+
         @return: a L{Deferred} that succeeds with a C{list} of instances of
             C{cls} or fails with an exception produced by C{rozrc}.
         """
-        rows = yield qry.on(transaction, raiseOnZeroRowCount=rozrc)
+        rows = yield qry.on(transaction, raiseOnZeroRowCount=rozrc, **kw)
+        returnValue(cls._recordsFromRows(transaction, rows))
+
+    @classmethod
+    def _recordsFromRows(cls, transaction, rows):
+        """
+        Transform rows of all the columns in C{self.table} into instances of
+        C{cls}.
+
+        @param transaction: the L{IAsyncTransaction} the rows were retrieved
+            with.
+
+        @param rows: the rows.
+        @type rows: C{list} of C{tuple}s
+
+        @return: a C{list} of instances of C{cls}.
+        """
+        names = cls.__rownames__
+        if cls._attributesFromRow.im_func is not Record._attributesFromRow.im_func:
+            # A subclass has its own way of loading rows, so let it.
+            selves = []
+            for row in rows:
+                self = cls()
+                self._attributesFromRow(zip(names, row))
+                self.transaction = transaction
+                selves.append(self)
+            return selves
+
+        # This is the hot path for loading records, so use the layout worked
+        # out when the class was created, and fill in each instance's
+        # attributes directly rather than via L{Record.__setattr__}.
+        converters = cls.__rowconverters__
+        if converters and "native-timestamps" in transaction.dbtype.options:
+            # The driver has already converted the timestamps
+            converters = ()
+        setters = cls.__rowsetters__
+        if setters is not None:
+            setTransaction = cls._slot_transaction.__set__
         selves = []
-        names = [cls.__colmap__[column] for column in list(cls.table)]
         for row in rows:
+            if converters:
+                row = list(row)
+                for index, converter in converters:
+                    value = row[index]
+                    if value is not None:
+                        row[index] = converter(value)
             self = cls()
-            self._attributesFromRow(zip(names, row))
-            self.transaction = transaction
+            if setters is None:
+                attrs = self.__dict__
+                attrs.update(izip(names, row))
+                attrs["transaction"] = transaction
+            else:
+                for setter, value in izip(setters, row):
+                    setter(self, value)
+                setTransaction(self, transaction)
             selves.append(self)
-        returnValue(selves)
+        return selves
 
 
 class SerializableRecord(Record):
@@ -690,6 +1019,8 @@ class SerializableRecord(Record):
     one system to another (with potentially mismatched schemas).
     """
 
+    __slots__ = ()
+
     def serialize(self):
         """
         Create an L{dict} of each attribute with L{str} values for each attribute
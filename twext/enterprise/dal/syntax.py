@@ -68,8 +68,10 @@ __all__ = [
     "NoOp",
     "SQLFragment",
     "Parameter",
+    "StatementCache",
 ]
 
+from collections import OrderedDict
 from itertools import count, repeat
 from functools import partial
 from operator import eq, ne
@@ -80,7 +82,8 @@ from twisted.internet.defer import succeed
 
 from twext.enterprise.dal.model import Schema, Table, Column, Sequence, SQLType
 from twext.enterprise.ienterprise import (
-    POSTGRES_DIALECT, ORACLE_DIALECT, SQLITE_DIALECT, DatabaseType, IDerivedParameter
+    POSTGRES_DIALECT, ORACLE_DIALECT, SQLITE_DIALECT, DatabaseType, IDerivedParameter,
+    IRowStream,
 )
 from twext.enterprise.util import mapOracleOutputType
 
@@ -181,8 +184,19 @@ class _Statement(object):
     """
     An SQL statement that may be executed.  (An abstract base class, must
     implement several methods.)
+
+    @cvar _writes: Does this statement modify or lock anything, and so must
+        not be executed on a read-only transaction?
+
+    @ivar cacheable: May the SQL generated for this statement be kept in the
+        transaction's L{StatementCache}?  See L{_Statement.cached}.
+    @type cacheable: L{bool}
     """
 
+    _writes = False
+
+    cacheable = False
+
     _paramstyles = {
         "pyformat": partial(FixedPlaceholder, "%s"),
         "numeric": NumericPlaceholder,
@@ -194,6 +208,33 @@ class _Statement(object):
             queryGenerator = QueryGenerator()
         return self._toSQL(queryGenerator)
 
+    def cached(self):
+        """
+        Mark this statement as one which is built once, executed many times
+        and never modified, so that the SQL generated for it is kept in the
+        L{StatementCache} of the transactions it is executed on, rather than
+        being generated again every time.
+
+        @return: this statement.
+        @rtype: L{_Statement}
+        """
+        self.cacheable = True
+        return self
+
+    def _checkWritable(self, txn):
+        """
+        Make sure this statement may be executed on the given transaction.
+
+        @raise DALError: if this statement writes and C{txn} is read-only (has
+            a true C{readOnly} attribute).
+        """
+        if self._writes and getattr(txn, "readOnly", False):
+            raise DALError(
+                "{} cannot be executed on a read-only transaction".format(
+                    self.__class__.__name__
+                )
+            )
+
     def _extraVars(self, txn, queryGenerator):
         """
         A hook for subclasses to provide additional keyword arguments to the
@@ -239,16 +280,23 @@ class _Statement(object):
         @param kw: keyword arguments, mapping names of L{Parameter} objects
             located somewhere in C{self}
 
+        If this statement is L{cacheable <_Statement.cached>} and C{txn} has
+        a C{statementCache} attribute (a L{StatementCache}), the SQL generated
+        for this statement is looked up there rather than being re-generated.
+
         @return: results from the database.
         @rtype: a L{Deferred} firing a C{list} of records (C{tuple}s or
             C{list}s)
+
+        @raise DALError: if this statement writes and C{txn} is read-only.
         """
+        self._checkWritable(txn)
         queryGenerator = QueryGenerator(
             txn.dbtype, self._paramstyles[txn.dbtype.paramstyle]()
         )
         outvars = self._extraVars(txn, queryGenerator)
         kw.update(outvars)
-        fragment = self.toSQL(queryGenerator).bind(**kw)
+        fragment = self._bindFor(txn, queryGenerator, kw)
         result = txn.execSQL(
             fragment.text, fragment.parameters, raiseOnZeroRowCount
         )
@@ -257,6 +305,28 @@ class _Statement(object):
             result.addCallback(self._fixOracleNulls)
         return result
 
+    def _bindFor(self, txn, queryGenerator, kw):
+        """
+        Generate the SQL for this statement, using the transaction's
+        L{StatementCache} if it has one and this statement is cacheable, and
+        bind values to it.
+
+        @param txn: the L{IAsyncTransaction} the statement will be executed on.
+
+        @param queryGenerator: describes the database to generate SQL for.
+        @type queryGenerator: L{QueryGenerator}
+
+        @param kw: values for L{Parameter}s, by name.
+        @type kw: L{dict}
+
+        @rtype: L{SQLFragment}
+        """
+        cache = getattr(txn, "statementCache", None) if self.cacheable else None
+        if cache is not None:
+            return cache.compile(self, queryGenerator).bind(**kw)
+        else:
+            return self.toSQL(queryGenerator).bind(**kw)
+
     def _resultColumns(self):
         """
         Subclasses must implement this to return a description of the columns
@@ -1336,6 +1406,13 @@ class Select(_Statement):
             other = Tuple(other)
         return CompoundComparison(other, "=", self)
 
+    @property
+    def _writes(self):
+        """
+        A C{select ... for update} locks the rows it selects.
+        """
+        return bool(self.ForUpdate)
+
     def _toSQL(self, queryGenerator):
         """
         @return: a C{select} statement with placeholders and arguments
@@ -1440,6 +1517,35 @@ class Select(_Statement):
 
         return result
 
+    def onStreaming(self, txn, batchSize=100, **kw):
+        """
+        Execute this statement on a given L{IAsyncTransaction}, retrieving the
+        results a batch at a time.
+
+        @param txn: the L{IAsyncTransaction} to execute this on.
+
+        @param batchSize: the maximum number of rows in each batch.
+        @type batchSize: L{int}
+
+        @param kw: keyword arguments, mapping names of L{Parameter} objects
+            located somewhere in C{self}
+
+        @return: a L{Deferred} firing with an L{IRowStream}.
+
+        @raise DALError: if this statement locks rows and C{txn} is read-only.
+        """
+        self._checkWritable(txn)
+        queryGenerator = QueryGenerator(
+            txn.dbtype, self._paramstyles[txn.dbtype.paramstyle]()
+        )
+        fragment = self._bindFor(txn, queryGenerator, kw)
+        result = txn.execSQLStreaming(
+            fragment.text, fragment.parameters, batchSize
+        )
+        if queryGenerator.dbtype.dialect == ORACLE_DIALECT:
+            result.addCallback(_MappedRowStream, self._fixOracleNulls)
+        return result
+
     def _resultColumns(self):
         """
         Determine the list of L{ColumnSyntax} objects that will represent the
@@ -1481,8 +1587,13 @@ class Select(_Statement):
 class Call(_Statement):
     """
     CALL statement. Only supported by Oracle.
+
+    Since there is no telling what a procedure or function does, a call is
+    assumed to write unless it is marked as read-only.
     """
 
+    _writes = True
+
     def __init__(self, name, *args, **kwargs):
         """
         @param name: name of procedure or function to call
@@ -1492,10 +1603,15 @@ class Call(_Statement):
         @param returnType: kwarg: the Python type of the return value for
             a function
         @type returnType: L{Type}
+        @param readOnly: kwarg: whether the procedure or function neither
+            modifies nor locks anything, so that it may be called on a
+            read-only transaction
+        @type readOnly: L{bool}
         """
         self.Name = name
         self.Args = args
         self.ReturnType = kwargs.get("returnType")
+        self._writes = not kwargs.get("readOnly", False)
 
     def _toSQL(self, queryGenerator):
         """
@@ -1579,6 +1695,8 @@ class _DMLStatement(_Statement):
     Common functionality of Insert/Update/Delete statements.
     """
 
+    _writes = True
+
     def _returningClause(self, queryGenerator, stmt, allTables):
         """
         Add a dialect-appropriate C{returning} clause to the end of the given
@@ -1624,6 +1742,42 @@ class _DMLStatement(_Statement):
 
         return stmt
 
+    def onMany(self, txn, parameterList):
+        """
+        Execute this statement once for each of a list of sets of L{Parameter}
+        values, in a single round trip, using
+        L{IAsyncTransaction.execSQLMany}.
+
+        @param txn: the L{IAsyncTransaction} to execute this on.
+
+        @param parameterList: a C{list} of C{dict}s, each mapping names of
+            L{Parameter} objects located somewhere in C{self} to values.
+
+        @return: a L{Deferred} firing with the number of rows affected.
+
+        @raise DALError: if this statement has a C{Return} clause, since no
+            results can be retrieved from a batched execution, or if C{txn} is
+            read-only.
+        """
+        self._checkWritable(txn)
+        if self.Return is not None:
+            raise DALError(
+                "Statements with a Return clause cannot be executed with "
+                "onMany"
+            )
+        queryGenerator = QueryGenerator(
+            txn.dbtype, self._paramstyles[txn.dbtype.paramstyle]()
+        )
+        cache = getattr(txn, "statementCache", None) if self.cacheable else None
+        if cache is not None:
+            compiled = cache.compile(self, queryGenerator)
+        else:
+            compiled = _CompiledStatement(self.toSQL(queryGenerator))
+        return txn.execSQLMany(
+            compiled.text,
+            [compiled.bind(**kw).parameters for kw in parameterList]
+        )
+
     def _returnAsList(self):
         if not isinstance(self.Return, (tuple, list)):
             return [self.Return]
@@ -1915,6 +2069,8 @@ class Lock(_LockingStatement):
     An SQL "lock" statement.
     """
 
+    _writes = True
+
     def __init__(self, table, mode):
         self.table = table
         self.mode = mode
@@ -1943,6 +2099,8 @@ class DatabaseLock(_LockingStatement):
     An SQL exclusive session level advisory lock
     """
 
+    _writes = True
+
     def _toSQL(self, queryGenerator):
         assert(queryGenerator.dbtype.dialect == POSTGRES_DIALECT)
         return SQLFragment("select pg_advisory_lock(1)")
@@ -1951,6 +2109,7 @@ class DatabaseLock(_LockingStatement):
         """
         Override on() to only execute on Postgres
         """
+        self._checkWritable(txn)
         if txn.dbtype.dialect == POSTGRES_DIALECT:
             return super(DatabaseLock, self).on(txn, *a, **kw)
 
@@ -1962,6 +2121,8 @@ class DatabaseUnlock(_LockingStatement):
     An SQL exclusive session level advisory lock
     """
 
+    _writes = True
+
     def _toSQL(self, queryGenerator):
         assert(queryGenerator.dbtype.dialect == POSTGRES_DIALECT)
         return SQLFragment("select pg_advisory_unlock(1)")
@@ -1970,6 +2131,7 @@ class DatabaseUnlock(_LockingStatement):
         """
         Override on() to only execute on Postgres
         """
+        self._checkWritable(txn)
         if txn.dbtype.dialect == POSTGRES_DIALECT:
             return super(DatabaseUnlock, self).on(txn, *a, **kw)
 
@@ -2099,6 +2261,160 @@ class SQLFragment(object):
         return self
 
 
+class _MappedRowStream(object):
+    """
+    An L{IRowStream} which transforms each batch of rows from another
+    L{IRowStream}.
+    """
+    implements(IRowStream)
+
+    def __init__(self, stream, transform):
+        """
+        @param stream: the stream to get batches from.
+        @type stream: L{IRowStream}
+
+        @param transform: a 1-argument callable taking a C{list} of rows and
+            returning a C{list} of transformed rows.
+        """
+        self._stream = stream
+        self._transform = transform
+
+    def nextBatch(self):
+        return self._stream.nextBatch().addCallback(self._transform)
+
+    def close(self):
+        return self._stream.close()
+
+
+class _CompiledStatement(object):
+    """
+    The SQL text generated for a L{_Statement}, together with a plan for
+    binding values into its parameter slots.
+
+    @ivar text: the SQL text, with placeholders.
+    @type text: L{str}
+
+    @ivar slots: one 3-tuple per placeholder-producing parameter of the
+        generated L{SQLFragment}: C{(name, count, value)}.  C{name} is C{None}
+        for a literal C{value}; otherwise it is the name of a L{Parameter} to
+        look up at bind time, and C{count} is its expected number of items
+        (or C{None} for a single value).
+    @type slots: L{tuple}
+    """
+
+    def __init__(self, fragment):
+        self.text = fragment.text
+        slots = []
+        for parameter in fragment.parameters:
+            if isinstance(parameter, Parameter):
+                slots.append((parameter.name, parameter.count, None))
+            else:
+                slots.append((None, None, parameter))
+        self.slots = tuple(slots)
+
+    def bind(self, **kw):
+        """
+        Bind values to the parameter slots.
+
+        @see: L{SQLFragment.bind}
+
+        @return: an L{SQLFragment} with the bound values.
+        """
+        params = []
+        for name, paramCount, value in self.slots:
+            if name is None:
+                params.append(value)
+            elif paramCount is None:
+                params.append(kw[name])
+            else:
+                items = kw[name]
+                if paramCount != len(items):
+                    raise DALError(
+                        "Number of place holders does not match "
+                        "number of items to bind"
+                    )
+                params.extend(items)
+        return SQLFragment(self.text, params)
+
+
+DEFAULT_STATEMENT_CACHE_SIZE = 500
+
+
+class StatementCache(object):
+    """
+    A bounded, least-recently-used cache of the SQL generated for
+    L{_Statement}s, so that statements which are built once and executed many
+    times only need to have values bound on each execution.  Only statements
+    marked with L{_Statement.cached} are kept here.
+
+    Entries are keyed on the identity of the statement along with the dialect
+    and paramstyle of the database it is generated for.  Each entry holds a
+    reference to its statement, so an identifier cannot be re-used by another
+    statement while its entry is present.
+
+    @ivar maxSize: the maximum number of entries to keep.
+    @type maxSize: L{int}
+
+    @ivar hits: the number of lookups satisfied from the cache.
+    @type hits: L{int}
+
+    @ivar misses: the number of lookups that required SQL generation.
+    @type misses: L{int}
+
+    @ivar evictions: the number of entries discarded to stay within
+        C{maxSize}.
+    @type evictions: L{int}
+    """
+
+    def __init__(self, maxSize=DEFAULT_STATEMENT_CACHE_SIZE):
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def compile(self, statement, queryGenerator):
+        """
+        Get the L{_CompiledStatement} for the given statement, generating it
+        with the given L{QueryGenerator} if it is not already cached.
+
+        @param statement: the statement to compile.
+        @type statement: L{_Statement}
+
+        @param queryGenerator: describes the database the SQL is for; this is
+            only used to generate the SQL on a cache miss.
+        @type queryGenerator: L{QueryGenerator}
+
+        @rtype: L{_CompiledStatement}
+        """
+        dbtype = queryGenerator.dbtype
+        key = (id(statement), dbtype.dialect, dbtype.paramstyle)
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            entry = (
+                statement,
+                _CompiledStatement(statement.toSQL(queryGenerator))
+            )
+            if self._entries and len(self._entries) >= self.maxSize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        # Re-inserting moves the entry to the most-recently-used end.
+        self._entries[key] = entry
+        return entry[1]
+
+    def clear(self):
+        """
+        Discard all entries; the counters are left alone.
+        """
+        self._entries.clear()
+
+
 class Parameter(object):
     """
     Used to represent a place holder for a value to be bound to the query
@@ -0,0 +1,283 @@
+##
+# Copyright (c) 2017 Apple Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Micro-benchmark for turning query results into L{Record} instances.
+
+The rows are a realistic dump of the job queue's C{JOB} table: jobs are
+enqueued in bursts which share a C{NOT_BEFORE}, and some of them are assigned,
+with C{ASSIGNED} and C{OVERDUE} to the microsecond.  They are materialized by
+L{Record._recordsFromRows}, both as ordinary records and as compact ones (see
+L{Record.__compact__}), and, for comparison, by the original per-attribute
+path through L{Record._attributesFromRow} and L{Record.__setattr__}.  This is
+done with timestamps as strings, as SQLite returns them by default, and as
+L{datetime.datetime}s, as returned by drivers with the C{"native-timestamps"}
+option.  No database is used, so only the cost of materialization is
+measured.
+
+Run it like this::
+
+    python -m twext.enterprise.dal.test.bench_record --rows=10000
+
+Each result is written as one line of JSON.  For each kind of timestamp:
+
+    - C{rowsPerSecond}, C{compactRowsPerSecond} and C{legacyRowsPerSecond}:
+      the rows materialized per second by each path, the best of C{--repeat}
+      runs.
+    - C{bytesPerRecord} and C{compactBytesPerRecord}: the memory used by each
+      kind of record, not counting attribute values, which the two share.
+
+And for the timestamp strings in the dump, the number parsed per second by
+L{parseSQLTimestamp} (C{parsesPerSecond}), by it without its memo of recent
+values (C{uncachedParsesPerSecond}), and by C{strptime}
+(C{strptimePerSecond}), as it used to.
+"""
+
+from __future__ import print_function
+
+from datetime import datetime, timedelta
+import json
+import sys
+import time
+
+from twisted.python.usage import Options, UsageError
+
+from twext.enterprise import util
+from twext.enterprise.dal.record import Record, fromTable
+from twext.enterprise.dal.syntax import SchemaSyntax
+from twext.enterprise.dal.test.test_parseschema import SchemaTestHelper
+from twext.enterprise.ienterprise import DatabaseType, SQLITE_DIALECT
+
+
+benchSchemaText = """
+    create table JOB (
+      JOB_ID      integer primary key,
+      WORK_TYPE   varchar(255) not null,
+      PRIORITY    integer default 0 not null,
+      WEIGHT      integer default 0 not null,
+      NOT_BEFORE  timestamp not null,
+      IS_ASSIGNED integer default 0 not null,
+      ASSIGNED    timestamp default null,
+      OVERDUE     timestamp default null,
+      FAILED      integer default 0 not null,
+      PAUSE       integer default 0 not null,
+      DEDUP_KEY   varchar(255) default null
+    );
+"""
+
+helper = SchemaTestHelper()
+helper.id = lambda: __name__
+benchSchema = SchemaSyntax(helper.schemaFromString(benchSchemaText))
+
+
+class BenchRecord(Record, fromTable(benchSchema.JOB)):
+    """
+    A record for the benchmark's C{JOB} table.
+    """
+
+
+class CompactBenchRecord(Record, fromTable(benchSchema.JOB)):
+    """
+    A compact record for the benchmark's C{JOB} table.
+    """
+    __compact__ = True
+
+
+class FakeTransaction(object):
+    """
+    Just enough of a transaction for L{Record._recordsFromRows}.
+    """
+
+    def __init__(self, native):
+        options = ("native-timestamps",) if native else ()
+        self.dbtype = DatabaseType(SQLITE_DIALECT, "numeric", options)
+
+
+def makeRows(count, native):
+    """
+    Make a realistic dump of the C{JOB} table for L{BenchRecord}: jobs are
+    enqueued in bursts of 50 which share a C{NOT_BEFORE}, and one in five is
+    assigned.
+
+    @param count: the number of rows.
+    @type count: L{int}
+    @param native: whether timestamps are L{datetime}s rather than strings.
+    @type native: L{bool}
+
+    @rtype: L{list} of L{tuple}
+    """
+    start = datetime(2017, 1, 1, 12, 0, 0)
+    stamp = (lambda when: when) if native else str
+    rows = []
+    for jobID in xrange(count):
+        notBefore = start + timedelta(seconds=jobID // 50)
+        if jobID % 5 == 0:
+            assigned = notBefore + timedelta(microseconds=jobID * 7919 % 1000000 or 1)
+            overdue = assigned + timedelta(minutes=5)
+            rows.append((
+                jobID, "BENCH_WORK_ITEM", 1, 5, stamp(notBefore),
+                1, stamp(assigned), stamp(overdue), 0, 0, None,
+            ))
+        else:
+            rows.append((
+                jobID, "BENCH_WORK_ITEM", 1, 5, stamp(notBefore),
+                0, None, None, 0, 0, None,
+            ))
+    return rows
+
+
+def legacyRecordsFromRows(cls, transaction, rows):
+    """
+    Materialize records the way L{Record._recordsFromRows} used to, one
+    attribute at a time.
+    """
+    selves = []
+    names = [cls.__colmap__[column] for column in list(cls.table)]
+    for row in rows:
+        self = cls()
+        self._attributesFromRow(zip(names, row))
+        self.transaction = transaction
+        selves.append(self)
+    return selves
+
+
+def bestRate(run, count, repeat):
+    """
+    Time something that processes C{count} items.
+
+    @return: the best rate over C{repeat} runs.
+    @rtype: L{float}
+    """
+    best = None
+    for _ignore in xrange(repeat):
+        start = time.time()
+        run()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return count / best if best else float("inf")
+
+
+def rowsPerSecond(materialize, cls, transaction, rows, repeat):
+    """
+    Time materializing some rows.
+
+    @return: the best rate over C{repeat} runs.
+    @rtype: L{float}
+    """
+    def run():
+        util._timestampCache.clear()
+        materialize(cls, transaction, rows)
+    return bestRate(run, len(rows), repeat)
+
+
+def parsesPerSecond(parse, stamps, repeat):
+    """
+    Time parsing some timestamps.
+
+    @return: the best rate over C{repeat} runs.
+    @rtype: L{float}
+    """
+    def run():
+        util._timestampCache.clear()
+        for stamp in stamps:
+            parse(stamp)
+    return bestRate(run, len(stamps), repeat)
+
+
+def strptime(stamp):
+    """
+    Parse a timestamp the way L{parseSQLTimestamp} used to.
+    """
+    if len(stamp) < len(util.SQL_TIMESTAMP_FORMAT):
+        stamp += ".0"
+    return datetime.strptime(stamp, util.SQL_TIMESTAMP_FORMAT)
+
+
+def uncachedParse(stamp):
+    """
+    Parse a timestamp with L{parseSQLTimestamp}, but without its memo.
+    """
+    util._timestampCache.clear()
+    return util.parseSQLTimestamp(stamp)
+
+
+def bytesPerRecord(record):
+    """
+    The memory used by a record, and its C{__dict__} if it has one.
+
+    @rtype: L{int}
+    """
+    size = sys.getsizeof(record)
+    if hasattr(record, "__dict__"):
+        size += sys.getsizeof(record.__dict__)
+    return size
+
+
+class BenchOptions(Options):
+    """
+    Command line options for the record materialization benchmark.
+    """
+
+    optParameters = [
+        ["rows", "n", 10000, "Number of rows to materialize.", int],
+        ["repeat", "r", 5, "Number of runs to take the best of.", int],
+    ]
+
+    def postOptions(self):
+        if self["rows"] < 1 or self["repeat"] < 1:
+            raise UsageError("--rows and --repeat must be positive.")
+
+
+def main(argv=sys.argv[1:]):
+    options = BenchOptions()
+    try:
+        options.parseOptions(argv)
+    except UsageError as e:
+        print("{}\n{}".format(options, e))
+        sys.exit(1)
+
+    repeat = options["repeat"]
+    fast = lambda cls, transaction, rows: cls._recordsFromRows(transaction, rows)
+    for native in (False, True):
+        rows = makeRows(options["rows"], native)
+        txn = FakeTransaction(native)
+        result = {
+            "rows": len(rows),
+            "timestamps": "native" if native else "strings",
+            "rowsPerSecond": round(rowsPerSecond(fast, BenchRecord, txn, rows, repeat)),
+            "compactRowsPerSecond": round(rowsPerSecond(fast, CompactBenchRecord, txn, rows, repeat)),
+            "legacyRowsPerSecond": round(rowsPerSecond(legacyRecordsFromRows, BenchRecord, txn, rows, repeat)),
+            "bytesPerRecord": bytesPerRecord(BenchRecord._recordsFromRows(txn, rows[:1])[0]),
+            "compactBytesPerRecord": bytesPerRecord(CompactBenchRecord._recordsFromRows(txn, rows[:1])[0]),
+        }
+        print(json.dumps(result, sort_keys=True))
+
+    stamps = [
+        stamp for row in makeRows(options["rows"], False)
+        for stamp in (row[4], row[6], row[7]) if stamp is not None
+    ]
+    result = {
+        "timestamps": len(stamps),
+        "parsesPerSecond": round(parsesPerSecond(util.parseSQLTimestamp, stamps, repeat)),
+        "uncachedParsesPerSecond": round(parsesPerSecond(uncachedParse, stamps, repeat)),
+        "strptimePerSecond": round(parsesPerSecond(strptime, stamps, repeat)),
+    }
+    print(json.dumps(result, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
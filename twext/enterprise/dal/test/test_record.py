@@ -27,8 +27,9 @@ from twext.enterprise.dal.record import (
     Record, fromTable, ReadOnly, NoSuchRecord,
     SerializableRecord)
 from twext.enterprise.dal.test.test_parseschema import SchemaTestHelper
-from twext.enterprise.dal.syntax import SchemaSyntax
+from twext.enterprise.dal.syntax import SchemaSyntax, ColumnSyntax
 from twext.enterprise.fixtures import buildConnectionPool
+from twext.enterprise.ienterprise import DatabaseType, SQLITE_DIALECT
 
 # from twext.enterprise.dal.syntax import
 
@@ -77,6 +78,23 @@ class TestAutoRecord(Record, Delta):
     """
 
 
+class TestCompactRecord(SerializableRecord, Delta):
+    """
+    A sample test record stored compactly.
+    """
+    __compact__ = True
+
+
+class TestLoadingRecord(Record, Alpha):
+    """
+    A sample test record with its own way of loading rows.
+    """
+
+    def _attributesFromRow(self, attributeList):
+        super(TestLoadingRecord, self)._attributesFromRow(attributeList)
+        self.gamma = self.gamma.upper()
+
+
 class TestCRUD(TestCase):
     """
     Tests for creation, mutation, and deletion operations.
@@ -106,6 +124,24 @@ class TestCRUD(TestCase):
         self.assertEqual(rec2.beta, 234)
         self.assertEqual(rec2.gamma, "one")
 
+    @inlineCallbacks
+    def test_loadUsesStatementCache(self):
+        """
+        L{Record.load} re-uses the same statement for every primary key, so
+        only the first load needs to generate SQL.
+        """
+        txn = self.pool.connection()
+        yield txn.execSQL("insert into ALPHA values (:1, :2)", [234, "one"])
+        yield txn.execSQL("insert into ALPHA values (:1, :2)", [456, "two"])
+        cache = self.pool.statementCache
+        yield TestRecord.load(txn, 234)
+        misses = cache.misses
+        hits = cache.hits
+        rec = yield TestRecord.load(txn, 456)
+        self.assertEquals(rec.gamma, "two")
+        self.assertEquals(cache.misses, misses)
+        self.assertEquals(cache.hits, hits + 1)
+
     @inlineCallbacks
     def test_missingLoad(self):
         """
@@ -172,6 +208,80 @@ class TestCRUD(TestCase):
         yield newRow.delete()
         yield self.assertFailure(newRow.delete(), NoSuchRecord)
 
+    @inlineCallbacks
+    def test_createMany(self):
+        """
+        L{Record.createMany} inserts several rows with a single batched
+        statement, and returns the new records in order.
+        """
+        txn = self.pool.connection()
+        records = yield TestRecord.createMany(txn, [
+            dict(beta=3, gamma=u"three"),
+            dict(beta=4, gamma=u"four"),
+        ])
+        self.assertEquals([rec.beta for rec in records], [3, 4])
+        self.assertEquals(records[0].transaction, txn)
+        rows = yield txn.execSQL("select BETA, GAMMA from ALPHA order by BETA")
+        self.assertEqual(map(list, rows), [[3, u"three"], [4, u"four"]])
+
+    @inlineCallbacks
+    def test_createManyWithDefaults(self):
+        """
+        Records passed to L{Record.createMany} which need values from the
+        database are inserted individually, so those values are filled in.
+        """
+        txn = self.pool.connection()
+        records = yield TestAutoRecord.createMany(txn, [
+            dict(epsilon=u"one"),
+            dict(epsilon=u"two"),
+        ])
+        self.assertEquals([rec.epsilon for rec in records], [u"one", u"two"])
+        self.assertNotEqual(records[0].phi, records[1].phi)
+        self.assertEqual(
+            records[1].zeta, datetime.datetime(2012, 12, 12, 12, 12, 12)
+        )
+
+    @inlineCallbacks
+    def test_createManyMixedOrder(self):
+        """
+        When L{Record.createMany} is given a mix of records which do and do not
+        need values from the database, the rows are inserted in the order they
+        were given, with each run of complete records batched together.
+        """
+        txn = self.pool.connection()
+        inserts = []
+        execSQL = txn.execSQL
+        execSQLMany = txn.execSQLMany
+
+        def recordOne(sql, *a, **kw):
+            if sql.startswith("insert"):
+                inserts.append(1)
+            return execSQL(sql, *a, **kw)
+
+        def recordMany(sql, argsList, *a, **kw):
+            if sql.startswith("insert"):
+                inserts.append(len(argsList))
+            return execSQLMany(sql, argsList, *a, **kw)
+
+        self.patch(txn, "execSQL", recordOne)
+        self.patch(txn, "execSQLMany", recordMany)
+        zeta = datetime.datetime(2013, 1, 1, 0, 0, 0)
+        records = yield TestAutoRecord.createMany(txn, [
+            dict(phi=201, epsilon=u"one", zeta=zeta),
+            dict(phi=202, epsilon=u"two", zeta=zeta),
+            dict(epsilon=u"three"),
+            dict(phi=101, epsilon=u"four", zeta=zeta),
+        ])
+        self.assertEquals(
+            [rec.epsilon for rec in records],
+            [u"one", u"two", u"three", u"four"]
+        )
+        self.assertEquals(inserts, [2, 1, 1])
+        rows = yield execSQL("select EPSILON from DELTA order by EPSILON")
+        self.assertEquals(
+            [row[0] for row in rows], [u"four", u"one", u"three", u"two"]
+        )
+
     @inlineCallbacks
     def test_cantCreateWithoutRequiredValues(self):
         """
@@ -205,6 +315,126 @@ class TestCRUD(TestCase):
             datetime.datetime(2012, 12, 12, 12, 12, 12)
         )
 
+    @inlineCallbacks
+    def test_loadedRecords(self):
+        """
+        Records loaded from rows have every column's attribute set, with
+        timestamps converted, belong to the loading transaction and are
+        read-only.
+        """
+        self.assertEqual(TestAutoRecord.__rownames__, ("phi", "epsilon", "zeta"))
+        self.assertEqual([index for index, _ignore in TestAutoRecord.__rowconverters__], [2])
+
+        txn = self.pool.connection()
+        yield TestAutoRecord.create(txn, epsilon=u"one")
+        yield TestAutoRecord.create(txn, epsilon=u"two")
+        yield txn.commit()
+
+        txn = self.pool.connection()
+        recs = yield TestAutoRecord.query(txn, TestAutoRecord.phi > 0, order=TestAutoRecord.phi)
+        self.assertEqual(
+            [(rec.phi, rec.epsilon, rec.zeta) for rec in recs],
+            [
+                (1, u"one", datetime.datetime(2012, 12, 12, 12, 12, 12)),
+                (2, u"two", datetime.datetime(2012, 12, 12, 12, 12, 12)),
+            ]
+        )
+        self.assertTrue(all(rec.transaction is txn for rec in recs))
+
+        def setit():
+            recs[0].epsilon = u"three"
+
+        self.assertRaises(ReadOnly, setit)
+
+    @inlineCallbacks
+    def test_overriddenAttributesFromRow(self):
+        """
+        Records whose class overrides L{Record._attributesFromRow} are loaded
+        from rows with it.
+        """
+        txn = self.pool.connection()
+        yield txn.execSQL("insert into ALPHA values (:1, :2)", [234, "one"])
+        yield txn.execSQL("insert into ALPHA values (:1, :2)", [456, "two"])
+
+        recs = yield TestLoadingRecord.query(
+            txn, TestLoadingRecord.beta > 0, order=TestLoadingRecord.beta
+        )
+        self.assertEqual(
+            [(rec.beta, rec.gamma) for rec in recs], [(234, "ONE"), (456, "TWO")]
+        )
+        self.assertTrue(all(rec.transaction is txn for rec in recs))
+        rec = yield TestRecord.load(txn, 234)
+        self.assertEqual(rec.gamma, "one")
+
+    @inlineCallbacks
+    def test_compactRecords(self):
+        """
+        A L{Record} with C{__compact__} set keeps its attributes in slots, but
+        otherwise behaves like any other.
+        """
+        self.assertIsInstance(TestCompactRecord.epsilon, ColumnSyntax)
+        self.assertIdentical(TestCompactRecord.transaction, None)
+
+        made = TestCompactRecord.make(epsilon=u"one")
+        self.assertFalse(hasattr(made, "__dict__"))
+        self.assertIsInstance(made.phi, ColumnSyntax)
+        self.assertIdentical(made.transaction, None)
+
+        txn = self.pool.connection()
+        yield made.insert(txn)
+        self.assertEqual(made.phi, 1)
+        yield TestCompactRecord.create(txn, epsilon=u"two")
+        yield txn.commit()
+
+        txn = self.pool.connection()
+        recs = yield TestCompactRecord.query(txn, TestCompactRecord.phi > 0, order=TestCompactRecord.phi)
+        self.assertEqual(
+            [(rec.phi, rec.epsilon, rec.zeta) for rec in recs],
+            [
+                (1, u"one", datetime.datetime(2012, 12, 12, 12, 12, 12)),
+                (2, u"two", datetime.datetime(2012, 12, 12, 12, 12, 12)),
+            ]
+        )
+        self.assertIdentical(recs[0].transaction, txn)
+        self.assertEqual(recs[0], made)
+        self.assertNotEqual(recs[0], recs[1])
+
+        def setit():
+            recs[0].epsilon = u"three"
+
+        self.assertRaises(ReadOnly, setit)
+        yield recs[0].update(epsilon=u"three")
+        self.assertEqual(recs[0].epsilon, u"three")
+        yield txn.commit()
+
+        serialized = recs[0].serialize()
+        self.assertEqual(serialized["epsilon"], u"three")
+        self.assertEqual(TestCompactRecord.deserialize(serialized), recs[0])
+
+    @inlineCallbacks
+    def test_nativeTimestamps(self):
+        """
+        When the driver returns timestamps as L{datetime.datetime}s, as
+        indicated by the C{"native-timestamps"} database option, records use
+        them as they are.
+        """
+        pool = buildConnectionPool(
+            self, schemaString,
+            dbtype=DatabaseType(SQLITE_DIALECT, "numeric", ("native-timestamps",))
+        )
+        zeta = datetime.datetime(2012, 12, 12, 12, 12, 12, 123456)
+        txn = pool.connection()
+        yield TestAutoRecord.create(txn, epsilon=u"one", zeta=zeta)
+        yield TestAutoRecord.create(txn, epsilon=u"two")
+        yield txn.commit()
+
+        txn = pool.connection()
+        recs = yield TestAutoRecord.query(txn, TestAutoRecord.phi > 0, order=TestAutoRecord.phi)
+        self.assertEqual(
+            [rec.zeta for rec in recs],
+            [zeta, datetime.datetime(2012, 12, 12, 12, 12, 12)]
+        )
+
     @inlineCallbacks
     def test_tooManyAttributes(self):
         """
@@ -288,6 +518,28 @@ class TestCRUD(TestCase):
         self.assertEqual(records[0].beta, 345)
         self.assertEqual(records[1].beta, 356)
 
+    @inlineCallbacks
+    def test_queryIter(self):
+        """
+        L{Record.queryIter} provides the records matching a query in batches.
+        """
+        txn = self.pool.connection()
+        for beta in range(5):
+            yield txn.execSQL(
+                "insert into ALPHA values (:1, :2)", [beta, str(beta)]
+            )
+        stream = yield TestRecord.queryIter(
+            txn, TestRecord.beta > 0, order=TestRecord.beta, batchSize=3
+        )
+        batches = []
+        while True:
+            records = yield stream.nextBatch()
+            if not records:
+                break
+            batches.append([record.beta for record in records])
+        self.assertEqual(batches, [[1, 2, 3], [4]])
+        self.assertIsInstance(records, list)
+
     @inlineCallbacks
     def test_querySimple(self):
         """
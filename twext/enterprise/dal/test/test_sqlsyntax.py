@@ -18,7 +18,7 @@
 Tests for L{twext.enterprise.dal.syntax}
 """
 
-from twisted.internet.defer import succeed
+from twisted.internet.defer import maybeDeferred, succeed
 from twisted.trial.unittest import TestCase, SkipTest
 
 from twext.enterprise.adbapi2 import DEFAULT_PARAM_STYLE
@@ -35,7 +35,7 @@ from twext.enterprise.dal.syntax import (
     Union, Intersect, Except, SetExpression, DALError,
     ResultAliasSyntax, Count, QueryGenerator, ALL_COLUMNS,
     DatabaseLock, DatabaseUnlock, Not, Coalesce, NullIf,
-    Call, Case)
+    Call, Case, StatementCache)
 from twext.enterprise.dal.syntax import FixedPlaceholder, NumericPlaceholder
 from twext.enterprise.dal.syntax import Function
 from twext.enterprise.dal.syntax import SchemaSyntax
@@ -98,6 +98,15 @@ class CatchSQL(object):
             result = self.counter
         return succeed(result)
 
+    def execSQLMany(self, sql, argsList):
+        """
+        Implement L{IAsyncTransaction} by recording C{sql} and C{argsList} in
+        C{self.execed}, and return a L{Deferred} firing with the number of
+        sets of arguments.
+        """
+        self.execed.append([sql, argsList])
+        return succeed(len(argsList))
+
 
 class NullTestingOracleTxn(object):
     """
@@ -2250,6 +2259,246 @@ class GenerationTests(ExampleSchemaHelper, TestCase, AssertResultHelper):
         )
 
 
+class ReadOnlyTests(ExampleSchemaHelper, TestCase):
+    """
+    Tests for executing statements on read-only transactions.
+    """
+
+    def readOnlyTxn(self, dialect=POSTGRES_DIALECT):
+        txn = CatchSQL(DatabaseType(dialect, "numeric"))
+        txn.readOnly = True
+        return txn
+
+    def test_selectAllowed(self):
+        """
+        A L{Select} may be executed on a read-only transaction.
+        """
+        txn = self.readOnlyTxn()
+        Select(From=self.schema.FOO).on(txn)
+        self.assertEquals(len(txn.execed), 1)
+
+    def test_readOnlyCallAllowed(self):
+        """
+        A L{Call} marked as read-only may be executed on a read-only
+        transaction.
+        """
+        txn = self.readOnlyTxn(ORACLE_DIALECT)
+        txn.nextResult([[1]])
+        Call("read_only", readOnly=True).on(txn)
+        self.assertEquals(len(txn.execed), 1)
+
+    def test_writesRefused(self):
+        """
+        Statements which write or lock raise L{DALError}, without executing
+        anything, when executed on a read-only transaction.
+        """
+        txn = self.readOnlyTxn()
+        for statement in [
+            Insert({self.schema.FOO.BAR: 1}),
+            Update({self.schema.FOO.BAR: 1}, Where=self.schema.FOO.BAZ == 2),
+            Delete(From=self.schema.FOO, Where=self.schema.FOO.BAZ == 2),
+            Select(From=self.schema.FOO, ForUpdate=True),
+            Call("may_write"),
+            Lock.exclusive(self.schema.FOO),
+            DatabaseLock(),
+            DatabaseUnlock(),
+        ]:
+            self.failureResultOf(maybeDeferred(statement.on, txn), DALError)
+        self.assertRaises(
+            DALError,
+            Insert({self.schema.FOO.BAR: Parameter("bar")}).onMany,
+            txn, [dict(bar=1)]
+        )
+        self.assertEquals(txn.execed, [])
+
+    def test_streamingLockRefused(self):
+        """
+        A L{Select} which locks rows raises L{DALError}, without executing
+        anything, when streamed on a read-only transaction.
+        """
+        txn = self.readOnlyTxn()
+        self.assertRaises(
+            DALError,
+            Select(From=self.schema.FOO, ForUpdate=True).onStreaming, txn
+        )
+        self.assertEquals(txn.execed, [])
+
+
+class OnManyTests(ExampleSchemaHelper, TestCase):
+    """
+    Tests for L{Insert.onMany} and friends.
+    """
+
+    def test_insertMany(self):
+        """
+        L{Insert.onMany} generates the statement once and executes it with one
+        list of arguments for each set of L{Parameter} values.
+        """
+        txn = CatchSQL()
+        result = resultOf(
+            Insert({
+                self.schema.FOO.BAR: Parameter("bar"),
+                self.schema.FOO.BAZ: "constant",
+            }).onMany(txn, [dict(bar=1), dict(bar=2)])
+        )
+        self.assertEquals(result, [2])
+        self.assertEquals(
+            txn.execed,
+            [["insert into FOO (BAR, BAZ) values (:1, :2)",
+              [[1, "constant"], [2, "constant"]]]]
+        )
+
+    def test_updateMany(self):
+        """
+        L{Update.onMany} works the same way.
+        """
+        txn = CatchSQL()
+        Update(
+            {self.schema.FOO.BAZ: Parameter("baz")},
+            Where=self.schema.FOO.BAR == Parameter("bar")
+        ).onMany(txn, [dict(bar=1, baz="one"), dict(bar=2, baz="two")])
+        self.assertEquals(
+            txn.execed,
+            [["update FOO set BAZ = :1 where BAR = :2",
+              [["one", 1], ["two", 2]]]]
+        )
+
+    def test_returnNotAllowed(self):
+        """
+        Statements with a C{Return} clause cannot be executed with C{onMany},
+        since there is nowhere for the results to go.
+        """
+        stmt = Insert(
+            {self.schema.FOO.BAR: Parameter("bar")},
+            Return=self.schema.FOO.BAZ
+        )
+        self.assertRaises(DALError, stmt.onMany, CatchSQL(), [dict(bar=1)])
+
+
+class StatementCacheTests(ExampleSchemaHelper, TestCase):
+    """
+    Tests for L{StatementCache}.
+    """
+
+    def cachingTxn(self, maxSize=10):
+        """
+        Create a L{CatchSQL} with a L{StatementCache} attached.
+        """
+        txn = CatchSQL()
+        txn.statementCache = StatementCache(maxSize)
+        return txn
+
+    def test_hitsAndMisses(self):
+        """
+        Executing the same statement more than once generates its SQL only the
+        first time; subsequent executions are counted as hits.
+        """
+        txn = self.cachingTxn()
+        stmt = Select(
+            From=self.schema.FOO, Where=self.schema.FOO.BAR == Parameter("bar")
+        ).cached()
+        stmt.on(txn, bar=1)
+        stmt.on(txn, bar=2)
+        stmt.on(txn, bar=3)
+        self.assertEquals(txn.statementCache.misses, 1)
+        self.assertEquals(txn.statementCache.hits, 2)
+        self.assertEquals(len(txn.statementCache), 1)
+        self.assertEquals(
+            txn.execed,
+            [["select * from FOO where BAR = :1", [bar]] for bar in (1, 2, 3)]
+        )
+
+    def test_onlyCachedStatements(self):
+        """
+        Statements which are not marked with L{_Statement.cached} are not kept
+        in the cache, so executing ad-hoc statements neither fills it nor holds
+        on to them.
+        """
+        txn = self.cachingTxn()
+        for bar in (1, 2):
+            Select(From=self.schema.FOO, Where=self.schema.FOO.BAR == bar).on(txn)
+        stmt = Update(
+            {self.schema.FOO.BAZ: "x"}, Where=self.schema.FOO.BAR == 1
+        )
+        stmt.on(txn)
+        stmt.onMany(txn, [{}, {}])
+        cache = txn.statementCache
+        self.assertEquals((cache.hits, cache.misses, len(cache)), (0, 0, 0))
+        self.assertEquals(len(txn.execed), 4)
+
+    def test_sameAsUncached(self):
+        """
+        Binding values into a cached statement produces the same SQL and
+        parameters as generating it from scratch, including literal values and
+        multi-valued L{Parameter}s.
+        """
+        stmt = Select(
+            From=self.schema.FOO,
+            Where=(self.schema.FOO.BAZ == "x").And(
+                self.schema.FOO.BAR.In(Parameter("bars", 3))
+            )
+        ).cached()
+        cached = self.cachingTxn()
+        plain = CatchSQL()
+        for bars in ([1, 2, 3], [4, 5, 6]):
+            stmt.on(cached, bars=bars)
+            stmt.on(plain, bars=bars)
+        self.assertEquals(cached.execed, plain.execed)
+        self.assertEquals(cached.statementCache.hits, 1)
+
+    def test_wrongParameterCount(self):
+        """
+        Binding the wrong number of items to a multi-valued L{Parameter} of a
+        cached statement raises L{DALError}.
+        """
+        txn = self.cachingTxn()
+        stmt = Select(
+            From=self.schema.FOO,
+            Where=self.schema.FOO.BAR.In(Parameter("bars", 2))
+        ).cached()
+        stmt.on(txn, bars=[1, 2])
+        self.assertRaises(DALError, stmt.on, txn, bars=[1, 2, 3])
+
+    def test_leastRecentlyUsedEviction(self):
+        """
+        When the cache is full, the least recently used entry is evicted to
+        make room for a new one.
+        """
+        txn = self.cachingTxn(2)
+        first, second, third = [
+            Select(From=self.schema.FOO, Where=self.schema.FOO.BAR == n).cached()
+            for n in range(3)
+        ]
+        first.on(txn)
+        second.on(txn)
+        first.on(txn)
+        third.on(txn)
+        cache = txn.statementCache
+        self.assertEquals((cache.hits, cache.misses, cache.evictions),
+                          (1, 3, 1))
+        first.on(txn)
+        self.assertEquals(cache.hits, 2)
+        second.on(txn)
+        self.assertEquals((cache.misses, cache.evictions), (4, 2))
+
+    def test_dialectsCachedSeparately(self):
+        """
+        The same statement executed against databases with different dialects
+        is cached separately for each.
+        """
+        cache = StatementCache()
+        sqlite = CatchSQL()
+        oracle = CatchSQL(DatabaseType(ORACLE_DIALECT, "numeric"))
+        oracle.nextResult([])
+        sqlite.statementCache = oracle.statementCache = cache
+        stmt = Select(From=self.schema.FOO, Where=self.schema.FOO.BAR == 1).cached()
+        stmt.on(sqlite)
+        stmt.on(oracle)
+        self.assertEquals((cache.hits, cache.misses), (0, 2))
+        cache.clear()
+        self.assertEquals(len(cache), 0)
+
+
 class OracleConnectionMethods(object):
 
     def test_rewriteOracleNULLs_Insert(self):
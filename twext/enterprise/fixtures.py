@@ -51,15 +51,21 @@ def buildConnectionPool(testCase, schemaText="", dbtype=DatabaseType(SQLITE_DIAL
         database.
     @type schemaText: L{str}
 
+    @param dbtype: the type of database.  If its options include
+        C{"native-timestamps"}, SQLite will return timestamp columns as
+        L{datetime.datetime}s.
+    @type dbtype: L{DatabaseType}
+
     @return: a L{ConnectionPool} service whose C{startService} method has
         already been invoked.
     @rtype: L{ConnectionPool}
     """
     sqlitename = testCase.mktemp()
     seqs = {}
+    detectTypes = sqlite3.PARSE_DECLTYPES if "native-timestamps" in dbtype.options else 0
 
     def connectionFactory(label=testCase.id()):
-        conn = sqlite3.connect(sqlitename, isolation_level=None)
+        conn = sqlite3.connect(sqlitename, isolation_level=None, detect_types=detectTypes)
 
         def nextval(seq):
             result = seqs[seq] = seqs.get(seq, 0) + 1
@@ -211,6 +217,10 @@ class ConnectionPoolHelper(object):
     """
 
     dbtype = DatabaseType(POSTGRES_DIALECT, DEFAULT_PARAM_STYLE)
+    prepareStatements = False
+    minConnections = 0
+    idleTimeout = None
+    probeInterval = None
 
     def setUp(self, test=None, connect=None):
         """
@@ -228,6 +238,10 @@ class ConnectionPoolHelper(object):
             connect,
             maxConnections=2,
             dbtype=self.dbtype,
+            prepareStatements=self.prepareStatements,
+            minConnections=self.minConnections,
+            idleTimeout=self.idleTimeout,
+            probeInterval=self.probeInterval,
         )
         self.pool._createHolder = self.makeAHolder
         self.clock = self.pool.reactor = ClockWithThreads()
@@ -349,9 +363,12 @@ class FakeConnection(Parent, Child):
 
     @ivar executions: the number of statements which have been executed.
 
+    @ivar prepares: the number of statements which have been prepared, either
+        with C{cursor.prepare} or with an SQL C{PREPARE} statement.
     """
 
     executions = 0
+    prepares = 0
 
     def __init__(self, factory):
         """
@@ -361,6 +378,7 @@ class FakeConnection(Parent, Child):
         Child.__init__(self, factory)
         self.id = factory.idcounter.next()
         self._executeFailQueue = []
+        self._prepareFailQueue = []
         self._commitCount = 0
         self._rollbackCount = 0
 
@@ -371,6 +389,13 @@ class FakeConnection(Parent, Child):
         """
         self._executeFailQueue.append(thunk)
 
+    def prepareWillFail(self, thunk):
+        """
+        The next call to L{FakeCursor.prepare} will fail with an exception
+        returned from the given callable.
+        """
+        self._prepareFailQueue.append(thunk)
+
     @property
     def cursors(self):
         "Alias to make tests more readable."
@@ -416,20 +441,46 @@ class FakeCursor(Child):
         self.description = False
         self.variables = []
         self.allExecutions = []
+        self.batch = None
 
     @property
     def connection(self):
         "Alias to make tests more readable."
         return self.parent
 
+    def prepare(self, sql):
+        """
+        Prepare a statement in the style of the cx_Oracle bindings, to be
+        executed by passing C{None} as the SQL to L{FakeCursor.execute}.
+        """
+        if self.connection.closed:
+            raise FakeConnectionError
+        if self.connection._prepareFailQueue:
+            raise self.connection._prepareFailQueue.pop(0)()
+        self.connection.prepares += 1
+        self.statement = sql
+
     def execute(self, sql, args=()):
         if self.connection.closed:
             raise FakeConnectionError
         self.connection.executions += 1
         if self.connection._executeFailQueue:
             raise self.connection._executeFailQueue.pop(0)()
+        if sql is None:
+            sql = self.statement
+        elif sql.startswith("prepare "):
+            self.connection.prepares += 1
         self.allExecutions.append((sql, args))
+        self.batch = None
+        if sql.startswith("fetch forward "):
+            # Retrieve the next rows of the cursor declared by the last
+            # statement, as PostgreSQL's FETCH would.
+            self.batch = self.fetchmany(int(sql.split()[2]))
+            return
+        if sql.startswith("close "):
+            return
         self.sql = sql
+        self.fetched = 0
         factory = self.connection.parent
         self.description = factory.hasResults
         if factory.hasResults and factory.shouldUpdateRowcount:
@@ -438,6 +489,16 @@ class FakeCursor(Child):
             self.rowcount = 0
         return
 
+    def executemany(self, sql, argsList):
+        """
+        Execute a statement for each set of arguments; recorded as a single
+        entry in C{allExecutions}.
+        """
+        self.execute(sql, argsList)
+        if self.connection.parent.shouldUpdateRowcount:
+            self.rowcount = len(argsList)
+        self.description = False
+
     def var(self, type, *args):
         """
         Return a database variable in the style of the cx_Oracle bindings.
@@ -446,12 +507,27 @@ class FakeCursor(Child):
         self.variables.append(v)
         return v
 
+    def fetchmany(self, size):
+        """
+        Return the next C{size} of the rows that L{FakeCursor.fetchall} would
+        return.
+        """
+        rows = self.fetchall()[self.fetched:self.fetched + size]
+        self.fetched += len(rows)
+        return rows
+
     def fetchall(self):
         """
-        Just echo the SQL that was executed in the last query.
+        Just echo the SQL that was executed in the last query, or return the
+        rows retrieved by the last C{FETCH}.
         """
+        if self.batch is not None:
+            return self.batch
         if self.connection.parent.hasResults:
-            return [[self.connection.id, self.sql]]
+            return (
+                [[self.connection.id, self.sql]] *
+                self.connection.parent.resultRowCount
+            )
         if self.description:
             return []
         return None
@@ -484,10 +560,14 @@ class ConnectionFactory(Parent):
 
     @ivar hasResults: should cursors produced by connections by this factory
         have any results returned by C{fetchall()}?
+
+    @ivar resultRowCount: if C{hasResults} is set, how many (identical) rows
+        should C{fetchall()} return?
     """
 
     rollbackFail = False
     commitFail = False
+    resultRowCount = 1
 
     def __init__(self, shouldUpdateRowcount=True, hasResults=True):
         Parent.__init__(self)
@@ -22,6 +22,7 @@ __all__ = [
     "IAsyncTransaction",
     "ISQLExecutor",
     "ICommandBlock",
+    "IRowStream",
     "IQueuer",
     "IDerivedParameter",
     "AlreadyFinishedError",
@@ -70,7 +71,10 @@ class DatabaseType(object):
         @type dialect: L{str}
         @param paramstyle: parameter style for SQL statements
         @type paramstyle: L[str}
-        @param options: set of optional features
+        @param options: set of optional features, such as C{"skip-locked"}
+            (the database supports C{SKIP LOCKED}) or C{"native-timestamps"}
+            (the driver returns timestamp columns as L{datetime.datetime}s,
+            so L{twext.enterprise.dal.record.Record}s need not parse them)
         @type options: L{iterable}
         """
         self.dialect = dialect
@@ -128,6 +132,23 @@ class ISQLExecutor(Interface):
             affected.
         """
 
+    def execSQLMany(sql, argsList):
+        """
+        Execute some SQL once for each of a list of sets of arguments, in a
+        single round trip to the database (as with DB-API 2.0's
+        C{executemany}).
+
+        @param sql: an SQL string.
+
+        @type sql: C{str}
+
+        @param argsList: C{list} of C{list}s of arguments to interpolate into
+            C{sql}, one for each execution.
+
+        @return: L{Deferred} which fires with the number of rows affected, as
+            reported by the database; this may be C{-1} if it is unknown.
+        """
+
 
 class IAsyncTransaction(ISQLExecutor):
     """
@@ -137,6 +158,25 @@ class IAsyncTransaction(ISQLExecutor):
     at all, it is assumed to have been started.
     """
 
+    def execSQLStreaming(sql, args=(), batchSize=100):
+        """
+        Execute some SQL whose results are to be retrieved a batch at a time,
+        rather than all at once.
+
+        @param sql: an SQL string.
+
+        @type sql: C{str}
+
+        @param args: C{list} of arguments to interpolate into C{sql}.
+
+        @param batchSize: the maximum number of rows to retrieve in each batch.
+
+        @type batchSize: C{int}
+
+        @return: L{Deferred} which fires with an L{IRowStream} once the SQL has
+            been executed.
+        """
+
     def commit():
         """
         Commit changes caused by this transaction.
@@ -188,7 +228,7 @@ class IAsyncTransaction(ISQLExecutor):
             L{Deferred}.
         """
 
-    def commandBlock():
+    def commandBlock(pipeline=False):
         """
         Create an object which will cause the commands executed on it to be
         grouped together.
@@ -223,6 +263,14 @@ class IAsyncTransaction(ISQLExecutor):
         to store a computed aggregate (such as a sum) at a particular point in
         a transaction, without sacrificing parallelism.
 
+        @param pipeline: if C{True}, none of the commands executed on the block
+            are run until L{ICommandBlock.end} has been called; then they are
+            all sent to the database together, and their results delivered
+            together.  This saves a round trip between threads (or processes)
+            for each command, but means the results of a command cannot be
+            waited for before executing further commands in the same block.
+        @type pipeline: C{bool}
+
         @rtype: L{ICommandBlock}
         """
 
@@ -254,6 +302,31 @@ class ICommandBlock(ISQLExecutor):
         """
 
 
+class IRowStream(Interface):
+    """
+    The results of a query, retrieved incrementally.
+
+    @see: L{IAsyncTransaction.execSQLStreaming}
+    """
+
+    def nextBatch():
+        """
+        Retrieve the next batch of rows.  The next batch is not retrieved from
+        the database until this is called, so a slow consumer will not cause
+        rows to accumulate in memory.
+
+        @return: L{Deferred} which fires with a C{list} of C{tuple}s, which is
+            empty once all the rows have been retrieved.
+        """
+
+    def close():
+        """
+        Discard any rows which have not yet been retrieved.
+
+        @return: L{Deferred} which fires with C{None}.
+        """
+
+
 class IDerivedParameter(Interface):
     """
     A parameter which needs to be derived from the underlying DB-API cursor;
@@ -16,9 +16,10 @@
 ##
 
 from twext.enterprise.dal.model import Sequence
-from twext.enterprise.dal.model import Table, Schema, SQLType
+from twext.enterprise.dal.model import Index, Table, Schema, SQLType
 from twext.enterprise.dal.record import Record, fromTable, NoSuchRecord
 from twext.enterprise.dal.syntax import SchemaSyntax, Call, Count, Case, Constant, Sum
+from twext.enterprise.dal.syntax import Parameter, Update, SavepointAction
 from twext.enterprise.ienterprise import ORACLE_DIALECT
 from twext.enterprise.jobs.utils import inTransaction, astimestamp
 from twext.python.log import Logger
@@ -29,6 +30,8 @@ from twisted.python.failure import Failure
 
 from datetime import datetime, timedelta
 from collections import namedtuple
+import ast
+import random
 import time
 
 log = Logger()
@@ -49,10 +52,11 @@ def makeJobSchema(inSchema):
     """
     Create a self-contained schema for L{JobInfo} to use, in C{inSchema}.
 
-    @param inSchema: a L{Schema} to add the job table to.
+    @param inSchema: a L{Schema} to add the job tables to.
     @type inSchema: L{Schema}
 
-    @return: a schema with just the one table.
+    @return: a schema with just the job table and the dead-letter table of
+        jobs which failed too many times.
     """
     # Initializing this duplicate schema avoids a circular dependency, but this
     # should really be accomplished with independent schema objects that the
@@ -69,6 +73,24 @@ def makeJobSchema(inSchema):
     JobTable.addColumn("OVERDUE", SQLType("timestamp", None), default=None)
     JobTable.addColumn("FAILED", SQLType("integer", 0), default=0, notNull=True)
     JobTable.addColumn("PAUSE", SQLType("integer", 0), default=0, notNull=True)
+    JobTable.addColumn("DEDUP_KEY", SQLType("varchar", 255), default=None)
+
+    # DEDUP_KEY is cleared when a job is assigned, so this only constrains
+    # jobs which are still waiting to run; NULLs never conflict.
+    dedupIndex = Index(inSchema, "JOB_DEDUP_KEY", JobTable, unique=True)
+    dedupIndex.addColumn(JobTable.columnNamed("DEDUP_KEY"))
+
+    # Jobs which failed too many times (see WorkItem.maxAttempts), with their
+    # work item serialized as a Python literal
+    DeadTable = Table(inSchema, "JOB_DEAD")
+
+    DeadTable.addColumn("JOB_ID", SQLType("integer", None), notNull=True, primaryKey=True)
+    DeadTable.addColumn("WORK_TYPE", SQLType("varchar", 255), notNull=True)
+    DeadTable.addColumn("PRIORITY", SQLType("integer", 0), default=0, notNull=True)
+    DeadTable.addColumn("WEIGHT", SQLType("integer", 0), default=0, notNull=True)
+    DeadTable.addColumn("FAILED", SQLType("integer", 0), default=0, notNull=True)
+    DeadTable.addColumn("DIED", SQLType("timestamp", None), notNull=True)
+    DeadTable.addColumn("WORK_DATA", SQLType("text", None), default=None)
 
     return inSchema
 
@@ -110,6 +132,10 @@ JOB_PRIORITY_LOW = 0
 JOB_PRIORITY_MEDIUM = 1
 JOB_PRIORITY_HIGH = 2
 
+# IS_ASSIGNED value of unassigned jobs which are parked, i.e. not due within
+# JobItem.parkingHorizon, or paused
+JOB_PARKED = 2
+
 
 class JobItem(Record, fromTable(JobInfoSchema.JOB)):
     """
@@ -138,19 +164,68 @@ class JobItem(Record, fromTable(JobInfoSchema.JOB)):
     future, if it is not still running the job is marked as failed - which will reschedule it.
 
     FAILED - a count of the number of times a job has failed or had its overdue count bumped.
+    A failed job is run again after a delay which grows with this count (see
+    L{WorkItem.retryBackoff}), and once it reaches the work type's
+    L{WorkItem.maxAttempts}, the job and its work item are moved to the
+    JOB_DEAD table (see L{DeadJobItem}) instead.
+
+    DEDUP_KEY - for work types which coalesce duplicates (see
+    L{WorkItem.dedupAttributes}), a key identifying the logical work, which is unique
+    amongst jobs that have not been assigned. It is cleared when the job is assigned, so
+    that work enqueued while a job is running gets a job of its own.
+
+    IS_ASSIGNED - 1 if the job is assigned, otherwise 0, or 2 (L{JOB_PARKED}) if the job is
+    parked.  When L{JobItem.parkingHorizon} is set, jobs which are paused or not due within
+    the horizon are parked, and L{JobItem.promoteParked} (run periodically by the controller)
+    sets them back to 0 as they come within the horizon.  The queries which claim jobs only
+    look at unassigned rows (IS_ASSIGNED = 0), and those which find overdue jobs only at
+    assigned rows (IS_ASSIGNED = 1), so on a database with partial indexes, such as
+    PostgreSQL, the JOB table can be indexed so that neither scans parked jobs, however
+    many there are::
+
+        create index JOB_READY on JOB(PRIORITY, NOT_BEFORE)
+            where IS_ASSIGNED = 0 and PAUSE = 0;
+        create index JOB_PARKED on JOB(NOT_BEFORE)
+            where IS_ASSIGNED = 2 and PAUSE = 0;
+        create index JOB_ASSIGNED on JOB(OVERDUE)
+            where IS_ASSIGNED = 1;
 
     The above behavior depends on some important locking behavior: when an L{JobItem} is run,
     it locks the L{WorkItem} row corresponding to the job (it may lock other associated
     rows - e.g., other L{WorkItem}'s in the same group). It does not lock the L{JobItem}
     row corresponding to the job because the job processing loop may need to update the
     OVERDUE value of that row if the work takes a long time to complete.
+
+    The controller loads many jobs at a time (see L{JobItem.nextjobs}), so
+    L{JobItem}s are compact records (see L{Record.__compact__}).
     """
 
+    __compact__ = True
+
     _workTypes = None
     _workTypeMap = None
 
     lockRescheduleInterval = 60     # When a job can't run because of a lock, reschedule it this number of seconds in the future
     failureRescheduleInterval = 60  # When a job fails, reschedule it this number of seconds in the future
+    parkingHorizon = None           # When set, park unassigned jobs not due within this number of seconds
+
+    @classmethod
+    def unassignedState(cls, notBefore, pause=False):
+        """
+        Determine the IS_ASSIGNED value for an unassigned job: L{JOB_PARKED} if
+        C{parkingHorizon} is set and the job is paused or not due within it,
+        otherwise 0.
+
+        @param notBefore: when the job is due
+        @type notBefore: L{datetime.datetime}
+        @param pause: whether the job is paused
+        @type pause: L{bool}
+        """
+        if cls.parkingHorizon is not None and (
+            pause or notBefore > datetime.utcnow() + timedelta(seconds=cls.parkingHorizon)
+        ):
+            return JOB_PARKED
+        return 0
 
     def descriptor(self):
         return JobDescriptor(self.jobID, self.weight, self.workType)
@@ -165,7 +240,32 @@ class JobItem(Record, fromTable(JobInfoSchema.JOB)):
         @param overdue: number of seconds after assignment that the job will be considered overdue
         @type overdue: L{int}
         """
-        return self.update(isAssigned=1, assigned=when, overdue=when + timedelta(seconds=overdue))
+        return self.update(isAssigned=1, assigned=when, overdue=when + timedelta(seconds=overdue), dedupKey=None)
+
+    @classmethod
+    @inlineCallbacks
+    def assignJobs(cls, txn, jobs, when, overdue):
+        """
+        Mark several jobs as assigned, as L{JobItem.assign} does, with a single
+        statement.
+
+        @param jobs: the jobs to assign, all loaded in C{txn}
+        @type jobs: L{list} of L{JobItem}
+        @param when: current timestamp
+        @type when: L{datetime.datetime}
+        @param overdue: number of seconds after assignment that the jobs will be considered overdue
+        @type overdue: L{int}
+        """
+        if not jobs:
+            returnValue(None)
+        values = dict(isAssigned=1, assigned=when, overdue=when + timedelta(seconds=overdue), dedupKey=None)
+        colmap = dict((cls.__attrmap__[k], v) for k, v in values.iteritems())
+        yield Update(
+            colmap,
+            Where=cls.jobID.In(Parameter("jobIDs", len(jobs))),
+        ).on(txn, jobIDs=[job.jobID for job in jobs])
+        for job in jobs:
+            job._setAttributes(values)
 
     def unassign(self):
         """
@@ -173,6 +273,44 @@ class JobItem(Record, fromTable(JobInfoSchema.JOB)):
         """
         return self.update(isAssigned=0, assigned=None, overdue=None)
 
+    @classmethod
+    def unassignJobs(cls, txn, jobIDs):
+        """
+        Mark several assigned jobs as unassigned, as L{JobItem.unassign} does,
+        with a single statement.  Jobs which are no longer assigned, or no
+        longer exist, are left alone.
+
+        @param jobIDs: the IDs of the jobs
+        @type jobIDs: L{list} of L{int}
+        """
+        return Update(
+            {cls.isAssigned: 0, cls.assigned: None, cls.overdue: None},
+            Where=(cls.jobID.In(Parameter("jobIDs", len(jobIDs)))).And(cls.isAssigned == 1),
+        ).on(txn, jobIDs=jobIDs)
+
+    @classmethod
+    def bumpOverdueJobs(cls, txn, jobIDs, now, bump):
+        """
+        Push back the overdue value of several assigned jobs which are overdue
+        but known to be still running, with a single statement, so that the
+        overdue check does not have to look at each of them.  Jobs which are
+        not overdue, no longer assigned, or no longer exist, are left alone.
+
+        @param jobIDs: the IDs of the jobs
+        @type jobIDs: L{list} of L{int}
+        @param now: current timestamp
+        @type now: L{datetime.datetime}
+        @param bump: number of seconds from C{now} that the jobs will next be
+            considered overdue
+        @type bump: L{int}
+        """
+        return Update(
+            {cls.overdue: now + timedelta(seconds=bump)},
+            Where=(cls.jobID.In(Parameter("jobIDs", len(jobIDs)))).And(
+                cls.isAssigned == 1
+            ).And(cls.overdue < now),
+        ).on(txn, jobIDs=jobIDs)
+
     def bumpOverdue(self, bump):
         """
         Increment the overdue value by the specified number of seconds. Used when an overdue job
@@ -183,36 +321,117 @@ class JobItem(Record, fromTable(JobInfoSchema.JOB)):
         """
         return self.update(overdue=self.overdue + timedelta(seconds=bump))
 
+    @inlineCallbacks
     def failedToRun(self, locked=False, delay=None):
         """
         The attempt to run the job failed. Leave it in the queue, but mark it
         as unassigned, bump the failure count and set to run at some point in
-        the future.
+        the future.  If the job has now failed as many times as its work type's
+        C{maxAttempts} allows, move it and its work item to the dead-letter
+        table instead.
 
         @param lock: indicates if the failure was due to a lock timeout.
         @type lock: L{bool}
-        @param delay: how long before the job is run again, or C{None} for a default
-            staggered delay behavior.
+        @param delay: the delay before the job is run again after its first
+            failure (e.g. from a L{JobTemporaryError}), or C{None} for the
+            default for the kind of failure.  The delay grows with the number
+            of failures, as set by the work type's C{retryBackoff}.
         @type delay: L{int}
         """
 
-        # notBefore is set to the chosen interval multiplied by the failure count, which
-        # results in an incremental backoff for failures
+        failed = self.failed + (0 if locked else 1)
+        workItemType = self.allWorkTypes().get(self.workType)
+        if (
+            not locked and workItemType is not None and
+            workItemType.maxAttempts is not None and
+            failed >= workItemType.maxAttempts
+        ):
+            yield self.kill(failed)
+            returnValue(None)
+
         if delay is None:
             delay = self.lockRescheduleInterval if locked else self.failureRescheduleInterval
-            delay *= (self.failed + 1)
-        return self.update(
-            isAssigned=0,
+        notBefore = datetime.utcnow() + timedelta(seconds=self.retryDelay(delay, workItemType))
+        yield self.update(
+            isAssigned=self.unassignedState(notBefore, self.pause),
             assigned=None,
             overdue=None,
-            failed=self.failed + (0 if locked else 1),
-            notBefore=datetime.utcnow() + timedelta(seconds=delay)
+            failed=failed,
+            notBefore=notBefore,
+        )
+
+    def retryDelay(self, delay, workItemType=None):
+        """
+        Determine how long to wait before running this job again after a
+        failure.  By default the delay is multiplied by the number of
+        failures so far, plus one; if the work type sets C{retryBackoff}, it is
+        instead multiplied by C{retryBackoff} raised to the number of failures,
+        up to C{retryMaxDelay}.  Either way it is then randomly varied by up to
+        the work type's C{retryJitter}, so that jobs which failed together do
+        not all run again together.
+
+        @param delay: the delay after the first failure, in seconds
+        @type delay: L{int}
+        @param workItemType: the work type's L{WorkItem} subclass, or C{None}
+            if it is not known.
+
+        @return: the delay, in seconds
+        @rtype: L{float}
+        """
+        if workItemType is None or workItemType.retryBackoff is None:
+            # Incremental backoff for failures
+            delay *= (self.failed + 1)
+        else:
+            delay *= workItemType.retryBackoff ** self.failed
+        if workItemType is not None:
+            if workItemType.retryMaxDelay is not None:
+                delay = min(delay, workItemType.retryMaxDelay)
+            if workItemType.retryJitter:
+                delay *= random.uniform(1.0 - workItemType.retryJitter, 1.0 + workItemType.retryJitter)
+        return delay
+
+    @inlineCallbacks
+    def kill(self, failed=None):
+        """
+        Give up on this job: move it, with its work item serialized as a
+        Python literal, to the dead-letter table, where it will not be run but
+        can be listed, requeued or purged (see L{JobItem.deadJobs}).  Unlike
+        JSON, the literal keeps C{str} and C{unicode} values apart, and copes
+        with C{str} values which are not UTF-8.
+
+        @param failed: the number of times the job has failed, or C{None} for
+            its current failure count.
+        @type failed: L{int}
+        """
+        work = None
+        workItem = yield self.workItem()
+        if workItem is not None:
+            work = repr(workItem.serialize())
+        yield DeadJobItem.create(
+            self.transaction,
+            jobID=self.jobID,
+            workType=self.workType,
+            priority=self.priority,
+            weight=self.weight,
+            failed=self.failed if failed is None else failed,
+            died=datetime.utcnow(),
+            workData=work,
+        )
+        if workItem is not None:
+            yield workItem.delete()
+        yield self.delete()
+        log.error(
+            "JobItem: {workType} {jobid} moved to dead-letter table after {count} failures",
+            workType=self.workType,
+            jobid=self.jobID,
+            count=self.failed if failed is None else failed,
         )
 
     def pauseIt(self, pause=False):
         """
         Pause the L{JobItem} leaving all other attributes the same. The job processing loop
-        will skip paused items.
+        will skip paused items.  An unassigned job is parked while paused, if parking is
+        enabled (see L{JobItem.parkingHorizon}).
 
         @param pause: indicates whether the job should be paused.
         @type pause: L{bool}
@@ -221,7 +440,9 @@ class JobItem(Record, fromTable(JobInfoSchema.JOB)):
         @type delay: L{int}
         """
 
-        return self.update(pause=pause)
+        if self.isAssigned == 1:
+            return self.update(pause=pause)
+        return self.update(pause=pause, isAssigned=self.unassignedState(self.notBefore, pause))
 
     @classmethod
     @inlineCallbacks
@@ -302,7 +523,7 @@ class JobItem(Record, fromTable(JobInfoSchema.JOB)):
 
             # Temporary failure delay with back-off
             def _temporaryFailure():
-                return _failureCleanUp(delay=e.delay * (job.failed + 1))
+                return _failureCleanUp(delay=e.delay)
             log.debug(
                 "JobItem: {workType} {jobid} {desc} t={tm}",
                 workType=jobDescriptor.workType,
@@ -352,7 +573,117 @@ class JobItem(Record, fromTable(JobInfoSchema.JOB)):
 
     @classmethod
     @inlineCallbacks
-    def nextjob(cls, txn, now, minPriority, rowLimit):
+    def ultimatelyPerformBatch(cls, txnFactory, jobDescriptors):
+        """
+        Perform several jobs of the same (batchable) work type in a single
+        transaction.  The L{JobItem}s and L{WorkItem}s are loaded with one query
+        each, and each job is run inside its own savepoint, so that a job which
+        fails is rolled back (and marked as failed, as L{ultimatelyPerform}
+        would) without affecting the others.
+
+        Note that the work items are loaded with L{WorkItem.loadForJobs}, not
+        L{WorkItem.loadForJob}.
+
+        @param txnFactory: a 0- or 1-argument callable that creates an
+            L{IAsyncTransaction}
+        @type txnFactory: L{callable}
+        @param jobDescriptors: the job descriptors, all of the same work type
+        @type jobDescriptors: L{list} of L{JobDescriptor}
+        @return: a L{Deferred} which fires with the IDs of the jobs which
+            raised an unexpected exception, once the transaction is committed,
+            or fails if the transaction could not be committed.
+        """
+
+        t = time.time()
+        workType = jobDescriptors[0].workType
+        jobIDs = [jobDescriptor.jobID for jobDescriptor in jobDescriptors]
+
+        def _tm():
+            return "{:.3f}".format(1000 * (time.time() - t))
+
+        log.debug("JobItem: {workType} batch of {count} starting to run", workType=workType, count=len(jobIDs))
+        txn = txnFactory(label="ultimatelyPerformBatch: {workType} x{count}".format(workType=workType, count=len(jobIDs)))
+        failed = []
+        try:
+            jobs = yield cls.query(txn, cls.jobID.In(jobIDs))
+            jobs = dict((job.jobID, job) for job in jobs)
+            workItems = yield cls.workItemForType(workType).loadForJobs(txn, jobIDs)
+
+            savepoint = SavepointAction("JobItem_batch")
+            for jobID in jobIDs:
+                job = jobs.get(jobID)
+                if job is None:
+                    # The record has already been removed
+                    log.debug(
+                        "JobItem: {workType} {jobid} already removed t={tm}",
+                        workType=workType,
+                        jobid=jobID,
+                        tm=_tm(),
+                    )
+                    continue
+
+                yield savepoint.acquire(txn)
+                try:
+                    yield job._run(workItems.get(jobID))
+                except Exception as e:
+                    f = Failure()
+                    yield savepoint.rollback(txn)
+                    if isinstance(e, JobTemporaryError):
+                        log.debug(
+                            "JobItem: {workType} {jobid} {desc} t={tm}",
+                            workType=workType,
+                            jobid=jobID,
+                            desc="temporary failure #{}".format(job.failed + 1),
+                            tm=_tm(),
+                        )
+                        yield job.failedToRun(delay=e.delay)
+                    elif isinstance(e, (JobFailedError, JobRunningError)):
+                        log.debug(
+                            "JobItem: {workType} {jobid} {desc} t={tm}",
+                            workType=workType,
+                            jobid=jobID,
+                            desc="failed" if isinstance(e, JobFailedError) else "locked",
+                            tm=_tm(),
+                        )
+                        yield job.failedToRun(locked=isinstance(e, JobRunningError))
+                    else:
+                        log.error(
+                            "JobItem: {workType} {jobid} exception t={tm} {exc}",
+                            workType=workType,
+                            jobid=jobID,
+                            tm=_tm(),
+                            exc=f,
+                        )
+                        failed.append(jobID)
+                else:
+                    yield savepoint.release(txn)
+
+        except:
+            f = Failure()
+            log.error(
+                "JobItem: {workType} batch exception t={tm} {exc}",
+                workType=workType,
+                tm=_tm(),
+                exc=f,
+            )
+            yield txn.abort()
+            returnValue(f)
+
+        else:
+            yield txn.commit()
+            log.debug(
+                "JobItem: {workType} batch of {count} completed t={tm} failed={failed}",
+                workType=workType,
+                count=len(jobIDs),
+                tm=_tm(),
+                failed=len(failed),
+            )
+
+        returnValue(failed)
+
+    @classmethod
+    @inlineCallbacks
+    def nextjob(cls, txn, now, minPriority, rowLimit, excludeTypes=()):
         """
         Find the next available job based on priority, also return any that are overdue. This
         method uses an SQL query to find the matching jobs, and sorts based on the NOT_BEFORE
@@ -371,12 +702,17 @@ class JobItem(Record, fromTable(JobInfoSchema.JOB)):
         @type minPriority: L{int}
         @param rowLimit: query at most this number of rows at a time
         @type rowLimit: L{int}
+        @param excludeTypes: work types to skip, e.g. because they have reached
+            their concurrency or rate limits.  Oracle's C{next_job} stored
+            procedure cannot skip work types, so when there are any to skip,
+            Oracle uses the same locking query as other databases instead.
+        @type excludeTypes: iterable of L{str}
 
         @return: the job record
         @rtype: L{JobItem}
         """
 
-        if txn.dbtype.dialect == ORACLE_DIALECT:
+        if txn.dbtype.dialect == ORACLE_DIALECT and not excludeTypes:
 
             # For Oracle we need a multi-app server solution that only locks the
             # (one) row being returned by the query, and allows other app servers
@@ -391,44 +727,177 @@ class JobItem(Record, fromTable(JobInfoSchema.JOB)):
             if jobID:
                 job = yield cls.load(txn, jobID)
         else:
-            # Only add the PRIORITY term if minimum is greater than zero
-            queryExpr = (cls.isAssigned == 0).And(cls.pause == 0).And(cls.notBefore <= now)
+            # Oracle only gets here when work types are excluded: stopping at
+            # a job of one of those would hide the jobs of other types behind it
+            jobs = yield cls._queryNextJobs(txn, now, minPriority, rowLimit, excludeTypes)
+            job = jobs[0] if jobs else None
 
-            # PRIORITY can only be 0, 1, or 2. So we can convert an inequality into
-            # an equality test as follows:
-            #
-            # PRIORITY >= 0 - no test needed all values match all the time
-            # PRIORITY >= 1 === PRIORITY != 0
-            # PRIORITY >= 2 === PRIORITY == 2
-            #
-            # Doing this allows use of the PRIORITY column in an index since we already
-            # have one inequality in the index (NOT_BEFORE)
+        returnValue(job)
 
-            if minPriority == JOB_PRIORITY_MEDIUM:
-                queryExpr = (cls.priority != JOB_PRIORITY_LOW).And(queryExpr)
-            elif minPriority == JOB_PRIORITY_HIGH:
-                queryExpr = (cls.priority == JOB_PRIORITY_HIGH).And(queryExpr)
+    @classmethod
+    @inlineCallbacks
+    def nextjobs(cls, txn, now, minPriority, limit, excludeTypes=()):
+        """
+        Find and lock up to C{limit} available jobs, in the same order as
+        L{JobItem.nextjob}. Jobs locked by other transactions are skipped when
+        the database supports C{SKIP LOCKED}, so several controllers can claim
+        batches at the same time.
 
-            extra_kwargs = {}
-            if "skip-locked" in txn.dbtype.options:
-                extra_kwargs["skipLocked"] = True
-            jobs = yield cls.query(
-                txn,
-                queryExpr,
-                order=cls.priority,
-                ascending=False,
-                forUpdate=True,
-                noWait=False,
-                limit=rowLimit,
-                **extra_kwargs
-            )
-            job = jobs[0] if jobs else None
+        On Oracle, which has to use the C{next_job} stored procedure, at most
+        one job is returned.
 
-        returnValue(job)
+        @param txn: the transaction to use
+        @type txn: L{IAsyncTransaction}
+        @param now: current timestamp
+        @type now: L{datetime.datetime}
+        @param minPriority: lowest priority level to query for
+        @type minPriority: L{int}
+        @param limit: maximum number of jobs to return
+        @type limit: L{int}
+        @param excludeTypes: work types to skip, as for L{JobItem.nextjob}
+        @type excludeTypes: iterable of L{str}
+
+        @return: the job records
+        @rtype: L{list} of L{JobItem}
+        """
+        if txn.dbtype.dialect == ORACLE_DIALECT:
+            job = yield cls.nextjob(txn, now, minPriority, 1, excludeTypes)
+            jobs = [job] if job is not None else []
+        else:
+            jobs = yield cls._queryNextJobs(txn, now, minPriority, limit, excludeTypes)
+        returnValue(jobs)
+
+    @classmethod
+    def _queryNextJobs(cls, txn, now, minPriority, limit, excludeTypes=()):
+        """
+        Query for, and lock, available jobs on databases other than Oracle,
+        and on Oracle when some work types are excluded.
+        """
+        # Only add the PRIORITY term if minimum is greater than zero
+        queryExpr = (cls.isAssigned == 0).And(cls.pause == 0).And(cls.notBefore <= now)
+        if excludeTypes:
+            queryExpr = queryExpr.And(cls.workType.NotIn(sorted(excludeTypes)))
+
+        # PRIORITY can only be 0, 1, or 2. So we can convert an inequality into
+        # an equality test as follows:
+        #
+        # PRIORITY >= 0 - no test needed all values match all the time
+        # PRIORITY >= 1 === PRIORITY != 0
+        # PRIORITY >= 2 === PRIORITY == 2
+        #
+        # Doing this allows use of the PRIORITY column in an index since we already
+        # have one inequality in the index (NOT_BEFORE)
+
+        if minPriority == JOB_PRIORITY_MEDIUM:
+            queryExpr = (cls.priority != JOB_PRIORITY_LOW).And(queryExpr)
+        elif minPriority == JOB_PRIORITY_HIGH:
+            queryExpr = (cls.priority == JOB_PRIORITY_HIGH).And(queryExpr)
+
+        extra_kwargs = {}
+        if "skip-locked" in txn.dbtype.options:
+            extra_kwargs["skipLocked"] = True
+        return cls.query(
+            txn,
+            queryExpr,
+            order=cls.priority,
+            ascending=False,
+            forUpdate=True,
+            noWait=False,
+            limit=limit,
+            **extra_kwargs
+        )
+
+    @classmethod
+    def readyJobs(cls, txn, until, limit):
+        """
+        Find, without locking, the jobs waiting to be assigned that are due by
+        a given time, as used to fill the ready queue of a
+        L{twext.enterprise.jobs.queue.ControllerQueue}.
+
+        @param txn: the transaction to use
+        @type txn: L{IAsyncTransaction}
+        @param until: include jobs due up to this time
+        @type until: L{datetime.datetime}
+        @param limit: maximum number of jobs to return
+        @type limit: L{int}
+
+        @return: the job records, highest priority first
+        @rtype: L{list} of L{JobItem}
+        """
+        return cls.query(
+            txn,
+            (cls.isAssigned == 0).And(cls.pause == 0).And(cls.notBefore <= until),
+            order=cls.priority,
+            ascending=False,
+            limit=limit,
+        )
 
     @classmethod
     @inlineCallbacks
-    def overduejob(cls, txn, now, rowLimit):
+    def promoteParked(cls, txn, until, limit=None):
+        """
+        Unpark the parked jobs which are due by a given time and not paused,
+        so that they can be claimed.
+
+        @param txn: the transaction to use
+        @type txn: L{IAsyncTransaction}
+        @param until: unpark jobs due up to this time
+        @type until: L{datetime.datetime}
+        @param limit: the maximum number of jobs to unpark, or C{None} for all
+        @type limit: L{int}
+
+        @return: the IDs of the jobs unparked
+        @rtype: L{list} of L{int}
+        """
+        rows = yield cls.queryExpr(
+            (cls.isAssigned == JOB_PARKED).And(cls.pause == 0).And(cls.notBefore <= until),
+            attributes=(cls.jobID,),
+            limit=limit,
+        ).on(txn)
+        jobIDs = [row[0] for row in rows]
+        if jobIDs:
+            # Don't unpark any job paused in the meantime
+            yield Update(
+                {cls.isAssigned: 0},
+                Where=(cls.jobID.In(Parameter("jobIDs", len(jobIDs)))).And(
+                    cls.isAssigned == JOB_PARKED).And(cls.pause == 0),
+            ).on(txn, jobIDs=jobIDs)
+        returnValue(jobIDs)
+
+    @classmethod
+    def lockJobs(cls, txn, jobIDs, now):
+        """
+        Lock those of the given jobs which are still waiting to be assigned and
+        are due.  Jobs locked by other transactions are skipped when the
+        database supports C{SKIP LOCKED}.
+
+        @param txn: the transaction to use
+        @type txn: L{IAsyncTransaction}
+        @param jobIDs: the IDs of the jobs to lock
+        @type jobIDs: L{list} of L{int}
+        @param now: current timestamp; jobs whose C{notBefore} has since been
+            moved later than this are skipped
+        @type now: L{datetime.datetime}
+
+        @return: the locked job records, in no particular order
+        @rtype: L{list} of L{JobItem}
+        """
+        extra_kwargs = {}
+        if "skip-locked" in txn.dbtype.options:
+            extra_kwargs["skipLocked"] = True
+        return cls.query(
+            txn,
+            (cls.jobID.In(jobIDs)).And(cls.isAssigned == 0).And(cls.pause == 0).And(
+                cls.notBefore <= now
+            ),
+            forUpdate=True,
+            noWait=False,
+            **extra_kwargs
+        )
+
+    @classmethod
+    @inlineCallbacks
+    def overduejob(cls, txn, now, rowLimit, excludeJobIDs=()):
         """
         Find the next overdue job.
 
@@ -442,6 +911,12 @@ class JobItem(Record, fromTable(JobInfoSchema.JOB)):
         @type now: L{datetime.datetime}
         @param rowLimit: query at most this number of rows at a time
         @type rowLimit: L{int}
+        @param excludeJobIDs: jobs to skip, e.g. because they are known to be
+            running.  Oracle's C{overdue_job} stored procedure cannot skip
+            jobs, so there an excluded job may be returned anyway; callers
+            should push back the overdue value of the jobs they exclude (see
+            L{JobItem.bumpOverdueJobs}) so that they are not.
+        @type excludeJobIDs: iterable of L{int}
 
         @return: the job record
         @rtype: L{JobItem}
@@ -454,12 +929,15 @@ class JobItem(Record, fromTable(JobInfoSchema.JOB)):
             if jobID:
                 job = yield cls.load(txn, jobID)
         else:
+            queryExpr = (cls.isAssigned == 1).And(cls.overdue < now)
+            if excludeJobIDs:
+                queryExpr = queryExpr.And(cls.jobID.NotIn(sorted(excludeJobIDs)))
             extra_kwargs = {}
             if "skip-locked" in txn.dbtype.options:
                 extra_kwargs["skipLocked"] = True
             jobs = yield cls.query(
                 txn,
-                (cls.isAssigned == 1).And(cls.overdue < now),
+                queryExpr,
                 forUpdate=True,
                 noWait=False,
                 limit=rowLimit,
@@ -477,6 +955,15 @@ class JobItem(Record, fromTable(JobInfoSchema.JOB)):
         """
 
         workItem = yield self.workItem()
+        yield self._run(workItem)
+
+    @inlineCallbacks
+    def _run(self, workItem):
+        """
+        Run this job item's already loaded work item, if it has one, then
+        delete this job item.
+        """
+
         if workItem is not None:
 
             # First we lock the L{WorkItem}
@@ -657,11 +1144,118 @@ class JobItem(Record, fromTable(JobInfoSchema.JOB)):
 
         returnValue(True)
 
+    @classmethod
+    @inlineCallbacks
+    def inFlight(cls, txn, workTypes):
+        """
+        Count the jobs of each of the given work types which are assigned, i.e.
+        in flight, across all controllers.
+
+        @param workTypes: the work types to count
+        @type workTypes: L{list} of L{str}
+
+        @return: the number of assigned jobs keyed by work type, including only
+            work types which have any.
+        @rtype: L{dict}
+        """
+        rows = yield cls.queryExpr(
+            expr=(cls.isAssigned == 1).And(cls.workType.In(sorted(workTypes))),
+            attributes=(cls.workType, Count(cls.workType)),
+            group=cls.workType
+        ).on(txn)
+        returnValue(dict(rows))
+
+    @classmethod
+    def deadJobs(cls, txn, workTypes=None):
+        """
+        List the jobs in the dead-letter table.
+
+        @param workTypes: only list jobs of these work types, or C{None} for
+            all of them.
+        @type workTypes: L{list} of L{str}
+
+        @return: the dead jobs, oldest first
+        @rtype: L{list} of L{DeadJobItem}
+        """
+        expr = None if workTypes is None else DeadJobItem.workType.In(sorted(workTypes))
+        return DeadJobItem.query(txn, expr, order=DeadJobItem.died)
+
+    @classmethod
+    @inlineCallbacks
+    def requeueDeadJobs(cls, txn, jobIDs):
+        """
+        Move jobs from the dead-letter table back into the job queue, as new
+        jobs with a clean failure count, to be run straight away.  Dead jobs
+        without a work item that can be read back, or of work types which no
+        longer exist, are left where they are.
+
+        @param jobIDs: the IDs of the dead jobs
+        @type jobIDs: L{list} of L{int}
+
+        @return: the new work items
+        @rtype: L{list} of L{WorkItem}
+        """
+        deadJobs = yield DeadJobItem.query(txn, DeadJobItem.jobID.In(jobIDs))
+        results = []
+        for deadJob in deadJobs:
+            workItemType = cls.allWorkTypes().get(deadJob.workType)
+            serialized = None
+            if workItemType is not None and deadJob.workData is not None:
+                try:
+                    serialized = ast.literal_eval(deadJob.workData)
+                except (ValueError, SyntaxError):
+                    pass
+            if serialized is None:
+                log.error(
+                    "JobItem: dead {workType} {jobid} cannot be requeued",
+                    workType=deadJob.workType,
+                    jobid=deadJob.jobID,
+                )
+                continue
+            workItem = workItemType.deserialize(serialized)
+            kwargs = dict(
+                (attr, getattr(workItem, attr))
+                for attr in workItemType.__attrmap__
+                if attr not in ("workID", "jobID")
+            )
+            work = yield workItemType.makeJob(
+                txn, priority=deadJob.priority, weight=deadJob.weight, **kwargs
+            )
+            yield deadJob.delete()
+            results.append(work)
+        returnValue(results)
+
+    @classmethod
+    @inlineCallbacks
+    def purgeDeadJobs(cls, txn, jobIDs=None, before=None):
+        """
+        Remove jobs from the dead-letter table for good.
+
+        @param jobIDs: the IDs of the dead jobs to remove, or C{None} for all.
+        @type jobIDs: L{list} of L{int}
+        @param before: only remove jobs which died before this time, or
+            C{None} for all.
+        @type before: L{datetime.datetime}
+
+        @return: the IDs of the jobs removed
+        @rtype: L{list} of L{int}
+        """
+        expr = None
+        if jobIDs is not None:
+            expr = DeadJobItem.jobID.In(jobIDs)
+        if before is not None:
+            expr = (DeadJobItem.died < before) if expr is None else expr.And(DeadJobItem.died < before)
+        removed = yield DeadJobItem.deletesome(txn, expr, returnCols=DeadJobItem.jobID)
+        returnValue([row[0] for row in removed])
+
     @classmethod
     @inlineCallbacks
     def histogram(cls, txn):
         """
-        Generate a histogram of work items currently in the queue.
+        Generate a histogram of work items currently in the queue.  The
+        C{"assigned"} count of each work type is its number of jobs in flight,
+        and C{"maxInFlight"} and C{"rateLimit"} are its limits (see
+        L{twext.enterprise.jobs.workitem.WorkItem}).
         """
         from twext.enterprise.jobs.queue import WorkerConnectionPool
 
@@ -678,7 +1272,9 @@ class JobItem(Record, fromTable(JobInfoSchema.JOB)):
                 "late": 0,
                 "failed": 0,
                 "completed": WorkerConnectionPool.completed.get(workType, 0),
-                "time": WorkerConnectionPool.timing.get(workType, 0.0)
+                "time": WorkerConnectionPool.timing.get(workType, 0.0),
+                "maxInFlight": workItemType.maxInFlight,
+                "rateLimit": workItemType.rateLimit,
             })
 
         # Use an aggregate query to get the results for each currently queued
@@ -706,6 +1302,16 @@ class JobItem(Record, fromTable(JobInfoSchema.JOB)):
         returnValue(results)
 
 
+class DeadJobItem(Record, fromTable(JobInfoSchema.JOB_DEAD)):
+    """
+    @DynamicAttrs
+    A job which failed too many times to be retried (see
+    L{WorkItem.maxAttempts}).  Its work item is kept, serialized as a Python
+    literal (see L{JobItem.kill}), in C{workData}.  See L{JobItem.deadJobs}, L{JobItem.requeueDeadJobs} and
+    L{JobItem.purgeDeadJobs}.
+    """
+
+
 JobDescriptor = namedtuple("JobDescriptor", ["jobID", "weight", "workType"])
 
 
@@ -0,0 +1,275 @@
+# -*- test-case-name: twext.enterprise.jobs.test.test_jobs -*-
+##
+# Copyright (c) 2017 Apple Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Notifications that new jobs have been enqueued, so that a
+L{twext.enterprise.jobs.queue.ControllerQueue} can check for work as soon as
+a job is committed rather than waiting for its next poll.
+
+Within a single process, L{localJobNotifier} tells its listeners about every
+committed transaction that created a job.  On PostgreSQL the transaction also
+issues a C{NOTIFY}, which the database delivers on commit to any connection
+that has issued a matching C{LISTEN}, such as the dedicated connection held
+open by a L{JobListener}.
+"""
+
+from select import select
+from weakref import WeakKeyDictionary
+
+from twext.enterprise.ienterprise import POSTGRES_DIALECT
+from twext.internet.threadutils import ThreadHolder
+from twext.python.log import Logger
+
+from twisted.application.service import Service
+from twisted.internet.defer import succeed
+
+log = Logger()
+
+__all__ = [
+    "JOB_CHANNEL",
+    "JobListener",
+    "LocalJobNotifier",
+    "localJobNotifier",
+    "notifyNewJob",
+]
+
+
+# The name of the channel used for job notifications.
+JOB_CHANNEL = "twext_job"
+
+
+class LocalJobNotifier(object):
+    """
+    Relay job notifications to listeners in this process.
+    """
+
+    def __init__(self):
+        self._listeners = []
+
+    def addListener(self, listener):
+        """
+        @param listener: a 1-argument callable, called with the L{JobItem}s
+            created by a transaction whenever one that created jobs commits.
+        """
+        self._listeners.append(listener)
+
+    def removeListener(self, listener):
+        self._listeners.remove(listener)
+
+    def notify(self, jobs):
+        """
+        Tell each listener that new jobs have been committed.
+
+        @param jobs: the new jobs.
+        @type jobs: L{list} of L{JobItem}
+        """
+        for listener in list(self._listeners):
+            try:
+                listener(jobs)
+            except Exception:
+                log.failure("Job notification listener failed")
+
+
+localJobNotifier = LocalJobNotifier()
+
+# The jobs created by transactions which have already arranged to notify
+# listeners, so that a transaction creating many jobs only sends one
+# notification.
+_notifying = WeakKeyDictionary()
+
+
+def notifyNewJob(txn, job):
+    """
+    Arrange for job listeners to be notified when C{txn} commits.
+
+    @param txn: the transaction that has created a job.
+    @type txn: L{IAsyncTransaction}
+
+    @param job: the job created.
+    @type job: L{JobItem}
+
+    @return: a L{Deferred} that fires when the notification has been queued.
+    """
+    jobs = _notifying.get(txn)
+    if jobs is not None:
+        jobs.append(job)
+        return succeed(None)
+    jobs = _notifying[txn] = [job]
+    txn.postCommit(lambda: localJobNotifier.notify(jobs))
+    if txn.dbtype.dialect == POSTGRES_DIALECT:
+        # Delivered by the database only if the transaction commits.
+        return txn.execSQL("notify {}".format(JOB_CHANNEL))
+    return succeed(None)
+
+
+def waitForNotifications(connection, timeout):
+    """
+    Wait for notifications to arrive on a connection which is listening for
+    them.  This is the default implementation of
+    L{JobListener.waitForNotifications}, and works with drivers which follow
+    C{psycopg2}'s interface: connections with a C{fileno} method, a C{poll}
+    method which reads any pending notifications, and a C{notifies} list of
+    notifications received.
+
+    @param connection: the listening DB-API connection.
+
+    @param timeout: the maximum time to wait, in seconds.
+    @type timeout: C{float}
+
+    @return: the number of notifications received.
+    @rtype: C{int}
+    """
+    if select([connection], [], [], timeout)[0]:
+        connection.poll()
+    received = len(connection.notifies)
+    del connection.notifies[:]
+    return received
+
+
+class JobListener(Service, object):
+    """
+    Hold open a dedicated database connection which listens for job
+    notifications, and call a function each time some arrive.
+
+    Waiting for a notification blocks, so it is done in a thread of its own.
+    If the connection fails it is replaced after C{reconnectDelay} seconds;
+    callers should keep polling at a slow rate as a safety net for
+    notifications missed in the meantime.
+
+    @ivar waitForNotifications: a 2-argument callable, taking a connection
+        and a timeout, that blocks until notifications arrive on the
+        connection or the timeout expires, and returns the number received.
+        Receiving notifications is not part of DB-API 2.0, so this may need
+        to be replaced to suit the driver in use.
+    """
+
+    waitForNotifications = staticmethod(waitForNotifications)
+
+    reconnectDelay = 5.0
+
+    def __init__(self, reactor, connectionFactory, callback,
+                 channel=JOB_CHANNEL, timeout=1.0):
+        """
+        @param reactor: the reactor used for threads and timed events.
+
+        @param connectionFactory: a 0-argument callable which returns a DB-API
+            connection.
+
+        @param callback: a 0-argument callable, called in the reactor thread
+            whenever notifications arrive.
+
+        @param channel: the name of the channel to listen on.
+
+        @param timeout: the maximum time the listening thread blocks for at a
+            time, in seconds; this bounds how long stopping the service takes.
+        """
+        self.reactor = reactor
+        self.connectionFactory = connectionFactory
+        self.callback = callback
+        self.channel = channel
+        self.timeout = timeout
+        self._connection = None
+        self._holder = None
+        self._nextCall = None
+
+    def _createHolder(self):
+        """
+        Create a L{ThreadHolder}.  (Test hook.)
+        """
+        return ThreadHolder(self.reactor)
+
+    def startService(self):
+        super(JobListener, self).startService()
+        self._holder = self._createHolder()
+        self._holder.start()
+        self._listen()
+
+    def stopService(self):
+        super(JobListener, self).stopService()
+        if self._nextCall is not None:
+            self._nextCall.cancel()
+            self._nextCall = None
+        holder = self._holder
+        self._holder = None
+        holder.submit(self._disconnect)
+        return holder.stop()
+
+    def _schedule(self, delay, f):
+        self._nextCall = self.reactor.callLater(delay, f)
+
+    def _listen(self):
+        """
+        Connect and start listening.
+        """
+        self._nextCall = None
+        if not self.running:
+            return
+
+        def connected(ignored):
+            if self.running:
+                self._schedule(0, self._wait)
+
+        d = self._holder.submit(self._connect)
+        d.addCallbacks(connected, self._failed)
+
+    def _wait(self):
+        """
+        Wait for some notifications.
+        """
+        self._nextCall = None
+        if not self.running:
+            return
+
+        def received(count):
+            if not self.running:
+                return
+            if count:
+                self.callback()
+            self._schedule(0, self._wait)
+
+        d = self._holder.submit(
+            lambda: self.waitForNotifications(self._connection, self.timeout)
+        )
+        d.addCallbacks(received, self._failed)
+
+    def _failed(self, f):
+        log.failure("Job notification listener failed", f)
+        if self.running:
+            self._holder.submit(self._disconnect)
+            self._schedule(self.reconnectDelay, self._listen)
+
+    def _connect(self):
+        """
+        Create the listening connection.  Called in the listening thread.
+        """
+        self._connection = self.connectionFactory()
+        cursor = self._connection.cursor()
+        cursor.execute("listen {}".format(self.channel))
+        cursor.close()
+        self._connection.commit()
+
+    def _disconnect(self):
+        """
+        Close the listening connection.  Called in the listening thread.
+        """
+        connection = self._connection
+        self._connection = None
+        if connection is not None:
+            try:
+                connection.close()
+            except Exception:
+                log.failure("Closing job notification connection failed")
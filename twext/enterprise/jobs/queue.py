@@ -19,20 +19,25 @@
 from twext.enterprise.ienterprise import IQueuer
 from twext.enterprise.jobs.jobitem import JobDescriptorArg, JobItem, \
     JobFailedError
+from twext.enterprise.jobs.notify import JobListener, localJobNotifier
+from twext.enterprise.jobs.utils import astimestamp, inTransaction
 from twext.enterprise.jobs.workitem import WORK_WEIGHT_CAPACITY, \
     WORK_PRIORITY_LOW, WORK_PRIORITY_MEDIUM, WORK_PRIORITY_HIGH
 from twext.python.log import Logger
 
 from twisted.application.service import MultiService
-from twisted.internet.defer import inlineCallbacks, returnValue, Deferred, succeed
+from twisted.internet.defer import inlineCallbacks, returnValue, Deferred, succeed, \
+    CancelledError
 from twisted.internet.error import AlreadyCalled, AlreadyCancelled
 from twisted.internet.protocol import Factory
-from twisted.protocols.amp import AMP, Command
+from twisted.protocols.amp import AMP, Command, Float, Integer, ListOf, String
 
 from zope.interface import implements
 from zope.interface.interface import Interface
 
-from datetime import datetime
+from datetime import datetime, timedelta
+from heapq import heapify, heappop, heappush
+from itertools import count
 import collections
 import time
 
@@ -77,6 +82,18 @@ class _IJobPerformer(Interface):
         @rtype: L{Deferred} firing L{dict}
         """
 
+    def performJobs(jobs):  # @NoSelf
+        """
+        @param jobs: Details about several jobs of the same batchable work
+            type (see L{WorkItem.batchable}), to perform in one transaction.
+        @type jobs: L{list} of L{JobDescriptor}
+
+        @return: a L{Deferred} firing with a dictionary whose C{"failed"} key
+            lists the IDs of the jobs which raised an unexpected exception,
+            when the work is complete.
+        @rtype: L{Deferred} firing L{dict}
+        """
+
 
 class PerformJob(Command):
     """
@@ -90,13 +107,51 @@ class PerformJob(Command):
     response = []
 
 
+class PerformJobs(Command):
+    """
+    Notify a worker that it must do several jobs of the same batchable work
+    type, in one transaction.  The response lists the jobs which raised an
+    unexpected exception; the others completed, or were rescheduled after a
+    failure.
+    """
+
+    arguments = [
+        ("jobs", ListOf(JobDescriptorArg())),
+    ]
+    response = [
+        ("failed", ListOf(Integer())),
+    ]
+
+
+class JobHeartbeat(Command):
+    """
+    Notify the controller process that a worker is still performing some jobs.
+    Sent periodically by a worker for as long as it has jobs in flight, so that
+    the controller can tell which jobs are still alive without querying the
+    database.
+    """
+
+    arguments = [
+        ("jobIDs", ListOf(Integer())),
+    ]
+    response = []
+    requiresAnswer = False
+
+
 class EnqueuedJob(Command):
     """
     Notify the controller process that a worker enqueued some work. This is used to "wake up"
-    the controller if it has slowed its polling loop due to it being idle.
+    the controller if it has slowed its polling loop due to it being idle.  When sent after the
+    job has been committed, it also describes the job, so that the controller can add it to its
+    ready queue.
     """
 
-    arguments = []
+    arguments = [
+        ("jobID", Integer(optional=True)),
+        ("workType", String(optional=True)),
+        ("priority", Integer(optional=True)),
+        ("notBefore", Float(optional=True)),
+    ]
     response = []
 
 
@@ -106,15 +161,107 @@ class WorkerConnectionPool(object):
     that the controller process can dispatch work to. It tracks each L{ConnectionFromWorker},
     reporting on the overall load, and allows for dispatching of work to the lowest load
     worker.
+
+    Workers are kept in a heap ordered by load, and the aggregate load and
+    spare capacity are maintained as workers are added and removed and as
+    their load changes (see L{WorkerConnectionPool.workerLoadChanged}), so
+    that selecting a worker is O(log n) and load queries are O(1) in the
+    number of workers.
+
+    Jobs are only given to a worker with room for their weight (a job heavier
+    than C{maximumLoadPerWorker} needs an idle worker).  A job which does not
+    fit any worker is held, and dispatched as soon as a worker has room for
+    it, rather than overloading a worker.  Held jobs do not stop lighter jobs
+    being dispatched in the meantime, unless a job has been held for longer
+    than C{maximumHoldTime}: then later jobs are held behind it, so that the
+    workers drain until one has room for it, rather than a steady stream of
+    light jobs keeping it waiting forever.
+
+    A batch of jobs (see L{WorkerConnectionPool.performJobs}) is run one job
+    after another, so it is placed as a single job as heavy as the heaviest
+    job in it.
+
+    @ivar bestFit: if C{True}, give each job to the worker with the least
+        room that can still take it, keeping other workers free for heavier
+        jobs; otherwise give it to the least loaded worker.
+    @type bestFit: L{bool}
+
+    @ivar maximumHoldTime: how long, in seconds, a job may be held while
+        lighter jobs are dispatched ahead of it.
+    @type maximumHoldTime: L{float}
     """
     implements(_IJobPerformer)
 
     completed = collections.defaultdict(int)
     timing = collections.defaultdict(float)
 
-    def __init__(self, maximumLoadPerWorker=WORK_WEIGHT_CAPACITY):
+    bestFit = True
+
+    maximumHoldTime = 60.0
+
+    def __init__(self, maximumLoadPerWorker=WORK_WEIGHT_CAPACITY, reactor=None):
         self.workers = []
         self.maximumLoadPerWorker = maximumLoadPerWorker
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+
+        # Heap of [load, sequence, worker] entries.  An entry is made stale,
+        # by setting its worker to None, rather than being removed when its
+        # worker's load changes.  The sequence number breaks ties between
+        # equally loaded workers in favor of the one whose load changed least
+        # recently.
+        self._heap = []
+        self._entries = {}
+        self._sequence = count()
+        self._totalLoad = 0
+        self._spareCapacity = 0
+        self._availableWorkers = 0
+
+        # Workers keyed by load, each bucket ordered from the least to the
+        # most recently changed, for best-fit selection.
+        self._byLoad = collections.defaultdict(collections.OrderedDict)
+
+        # Jobs (or batches of jobs) waiting for a worker with room for them,
+        # as (weight, perform, job, Deferred, heldSince) tuples in the order
+        # they arrived, where perform is the method that dispatches job to a
+        # worker.
+        self._held = collections.deque()
+        self._heldWeight = 0
+        self._dispatchingHeld = False
+
+    def _account(self, load, sign):
+        """
+        Add (C{sign} of 1) or remove (C{sign} of -1) a worker with the given
+        load from the aggregate load totals.
+        """
+        self._totalLoad += sign * load
+        spare = self.maximumLoadPerWorker - load
+        if spare > 0:
+            self._spareCapacity += sign * spare
+            self._availableWorkers += sign
+
+    def _track(self, worker):
+        load = worker.currentLoad
+        entry = [load, next(self._sequence), worker]
+        self._entries[worker] = entry
+        heappush(self._heap, entry)
+        self._byLoad[load][worker] = True
+        self._account(load, 1)
+
+    def _untrack(self, worker):
+        entry = self._entries.pop(worker)
+        entry[2] = None
+        bucket = self._byLoad[entry[0]]
+        del bucket[worker]
+        if not bucket:
+            del self._byLoad[entry[0]]
+        self._account(entry[0], -1)
+
+        # Don't let stale entries accumulate indefinitely
+        if len(self._heap) > 2 * len(self._entries) + 16:
+            self._heap = [e for e in self._heap if e[2] is not None]
+            heapify(self._heap)
 
     def addWorker(self, worker):
         """
@@ -122,35 +269,99 @@ class WorkerConnectionPool(object):
         it can be selected.
         """
         self.workers.append(worker)
+        self._track(worker)
+        self._dispatchHeld()
 
     def removeWorker(self, worker):
         """
         Remove a L{ConnectionFromWorker} from this L{WorkerConnectionPool} that
-        was previously added.
+        was previously added.  If it was the last worker, the jobs being held
+        are dropped (see L{WorkerConnectionPool.dropHeld}), since there is no
+        longer any worker to give them to.
+
+        @return: the IDs of the jobs that were dropped.
+        @rtype: L{list} of L{int}
         """
         self.workers.remove(worker)
+        self._untrack(worker)
+        if not self.workers:
+            return self.dropHeld(CancelledError("No workers left"))
+        return []
+
+    def dropHeld(self, reason):
+        """
+        Give up on all the jobs being held: their L{Deferred}s fail with
+        C{reason}.  The jobs are still assigned in the database, so it is up
+        to the caller to see that they are claimed again.
+
+        @param reason: the error to fail the held jobs with.
+        @type reason: L{Exception}
+
+        @return: the IDs of the jobs that were dropped.
+        @rtype: L{list} of L{int}
+        """
+        held = self._held
+        self._held = collections.deque()
+        self._heldWeight = 0
+        jobIDs = []
+        for _ignore_weight, _ignore_perform, job, d, _ignore_since in held:
+            jobs = job if isinstance(job, list) else [job]
+            jobIDs.extend(each.jobID for each in jobs)
+            d.errback(reason)
+        return jobIDs
+
+    def heldJobIDs(self):
+        """
+        The jobs being held until a worker has room for them.
+
+        @rtype: L{set} of L{int}
+        """
+        jobIDs = set()
+        for _ignore_weight, _ignore_perform, job, _ignore_d, _ignore_since in self._held:
+            jobs = job if isinstance(job, list) else [job]
+            jobIDs.update(each.jobID for each in jobs)
+        return jobIDs
+
+    def workerLoadChanged(self, worker):
+        """
+        The C{currentLoad} of a worker has changed.  Workers which are not in
+        this pool (e.g. because they have already been removed) are ignored.
+        """
+        if worker in self._entries:
+            self._untrack(worker)
+            self._track(worker)
+            self._dispatchHeld()
 
     def hasAvailableCapacity(self):
         """
         Does this worker connection pool have any local workers who have spare
         hasAvailableCapacity to process another queue item?
         """
-        for worker in self.workers:
-            if worker.currentLoad < self.maximumLoadPerWorker:
-                return True
-        return False
+        return self._availableWorkers > 0
+
+    def availableCapacity(self):
+        """
+        How much more load can the workers in this pool take on?
+
+        @return: the sum, over all workers, of the load each can still accept,
+            less the weight of the jobs being held, or zero while new jobs
+            are being held behind one that has waited too long.
+        @rtype: L{int}
+        """
+        if self._heldTooLong():
+            return 0
+        return max(self._spareCapacity - self._heldWeight, 0)
 
     def loadLevel(self):
         """
         Return the overall load of this worker connection pool have as a percentage of
-        total capacity.
+        total capacity, counting jobs being held as well as those running.
 
         @return: current load percentage.
         @rtype: L{int}
         """
-        current = sum(worker.currentLoad for worker in self.workers)
         total = len(self.workers) * self.maximumLoadPerWorker
-        return ((current * 100) / total) if total else 100
+        return (((self._totalLoad + self._heldWeight) * 100) / total) if total else 100
 
     def eachWorkerLoad(self):
         """
@@ -162,7 +373,7 @@ class WorkerConnectionPool(object):
         """
         The total load of all currently connected workers.
         """
-        return sum(worker.currentLoad for worker in self.workers)
+        return self._totalLoad
 
     def _selectLowestLoadWorker(self):
         """
@@ -172,16 +383,64 @@ class WorkerConnectionPool(object):
         @return: a worker connection with the lowest current load.
         @rtype: L{ConnectionFromWorker}
         """
+        heap = self._heap
+        while heap[0][2] is None:
+            heappop(heap)
+        return heap[0][2]
 
-        # Stable sort based on worker load
-        self.workers.sort(key=lambda w: w.currentLoad)
-        return self.workers[0]
+    def _selectWorkerFor(self, weight):
+        """
+        Select the local connection that should perform a job of the given
+        weight, according to C{bestFit}.
+
+        @return: a worker connection with room for the job, or C{None} if
+            there is none.
+        @rtype: L{ConnectionFromWorker}
+        """
+        if not self._entries:
+            return None
+        highest = self.maximumLoadPerWorker - min(weight, self.maximumLoadPerWorker)
+        if self.bestFit:
+            for load in xrange(highest, -1, -1):
+                bucket = self._byLoad.get(load)
+                if bucket:
+                    return next(iter(bucket))
+            return None
+        worker = self._selectLowestLoadWorker()
+        return worker if worker.currentLoad <= highest else None
+
+    def fragmentation(self):
+        """
+        Describe how well the load of the workers is packed.
+
+        @return: a C{dict} with the total spare capacity of the workers
+            (C{"spare"}), the largest spare capacity of any one worker
+            (C{"largestSpare"}), the fraction of the spare capacity not
+            available to a single job because it is split between workers
+            (C{"fragmentation"}), and the number and total weight of jobs
+            held until a worker has room for them (C{"held"} and
+            C{"heldWeight"}).
+        @rtype: C{dict}
+        """
+        if self._entries:
+            largest = max(
+                self.maximumLoadPerWorker - self._selectLowestLoadWorker().currentLoad, 0
+            )
+        else:
+            largest = 0
+        spare = self._spareCapacity
+        return {
+            "spare": spare,
+            "largestSpare": largest,
+            "fragmentation": (1.0 - float(largest) / spare) if spare else 0.0,
+            "held": len(self._held),
+            "heldWeight": self._heldWeight,
+        }
 
-    @inlineCallbacks
     def performJob(self, job):
         """
-        Select a local worker that is idle enough to perform the given job,
-        then ask them to perform it.
+        Select a local worker that has room for the given job, then ask them
+        to perform it.  If no worker has room, hold the job until one does.
 
         @param job: The details of the given job.
         @type job: L{JobDescriptor}
@@ -190,9 +449,83 @@ class WorkerConnectionPool(object):
             complete.
         @rtype: L{Deferred} firing L{dict}
         """
+        return self._perform(max(job.weight, 1), self._performJobOn, job)
+
+    def performJobs(self, jobs):
+        """
+        Select a local worker that has room for the heaviest of the given jobs,
+        then ask them to perform them all in one transaction.  If no worker
+        has room, hold the jobs until one does.
+
+        @param jobs: The details of the jobs, all of the same batchable work
+            type.
+        @type jobs: L{list} of L{JobDescriptor}
+
+        @return: a L{Deferred} firing with a dictionary whose C{"failed"} key
+            lists the IDs of jobs which raised an unexpected exception, when
+            the work is complete.
+        @rtype: L{Deferred} firing L{dict}
+        """
+        weight = max([job.weight for job in jobs] + [1])
+        return self._perform(weight, self._performJobsOn, jobs)
+
+    def _heldTooLong(self):
+        """
+        Has the longest held job been held for C{maximumHoldTime} or more?
+        """
+        return bool(self._held) and (
+            self.reactor.seconds() - self._held[0][4] >= self.maximumHoldTime
+        )
+
+    def _perform(self, weight, perform, job):
+        """
+        Dispatch a job, or batch of jobs, with C{perform} to a worker with room
+        for C{weight}, or hold it until there is one.  While a job has been
+        held too long, hold new ones behind it.
+        """
+        worker = None if self._heldTooLong() else self._selectWorkerFor(weight)
+        if worker is None:
+            d = Deferred()
+            self._held.append((weight, perform, job, d, self.reactor.seconds()))
+            self._heldWeight += weight
+            return d
+        return perform(worker, job)
+
+    def _dispatchHeld(self):
+        """
+        Dispatch, in the order they arrived, any held jobs which now fit a
+        worker, up to the first one which still does not fit and has been held
+        for C{maximumHoldTime} or more.
+        """
+        if not self._held or self._dispatchingHeld:
+            return
+        self._dispatchingHeld = True
+        try:
+            stillHeld = collections.deque()
+            cutoff = self.reactor.seconds() - self.maximumHoldTime
+            while self._held:
+                entry = self._held.popleft()
+                weight, perform, job, d, heldSince = entry
+                worker = self._selectWorkerFor(weight)
+                if worker is None:
+                    stillHeld.append(entry)
+                    if heldSince <= cutoff:
+                        # Keep everything after it waiting too
+                        stillHeld.extend(self._held)
+                        self._held.clear()
+                else:
+                    self._heldWeight -= weight
+                    perform(worker, job).chainDeferred(d)
+            self._held = stillHeld
+        finally:
+            self._dispatchingHeld = False
 
+    @inlineCallbacks
+    def _performJobOn(self, preferredWorker, job):
+        """
+        Ask a worker to perform a job, and record statistics about it.
+        """
         t = time.time()
-        preferredWorker = self._selectLowestLoadWorker()
         try:
             result = yield preferredWorker.performJob(job)
         finally:
@@ -200,6 +533,21 @@ class WorkerConnectionPool(object):
             self.timing[job.workType] += time.time() - t
         returnValue(result)
 
+    @inlineCallbacks
+    def _performJobsOn(self, preferredWorker, jobs):
+        """
+        Ask a worker to perform a batch of jobs, and record statistics about
+        them.
+        """
+        t = time.time()
+        try:
+            result = yield preferredWorker.performJobs(jobs)
+        finally:
+            workType = jobs[0].workType
+            self.completed[workType] += len(jobs)
+            self.timing[workType] += time.time() - t
+        returnValue(result)
+
 
 class ConnectionFromWorker(AMP):
     """
@@ -214,6 +562,10 @@ class ConnectionFromWorker(AMP):
         self._load = 0
         self._completed = 0
 
+        # When each job in flight on this worker was dispatched or last
+        # reported by a heartbeat, keyed by job ID
+        self._heartbeats = {}
+
     @property
     def currentAssigned(self):
         """
@@ -245,12 +597,57 @@ class ConnectionFromWorker(AMP):
 
     def stopReceivingBoxes(self, reason):
         """
-        AMP boxes will no longer be received.
+        AMP boxes will no longer be received.  The jobs this worker was
+        performing have been lost, as have any jobs being held for a worker if
+        this was the last one.
         """
+        lost = set(self._heartbeats)
+        self._heartbeats.clear()
         result = super(ConnectionFromWorker, self).stopReceivingBoxes(reason)
-        self.controllerQueue.workerPool.removeWorker(self)
+        lost.update(self.controllerQueue.workerPool.removeWorker(self))
+        if lost:
+            self.controllerQueue.jobsLost(sorted(lost))
         return result
 
+    def _now(self):
+        return self.controllerQueue.reactor.seconds()
+
+    def _jobsStarted(self, jobs):
+        now = self._now()
+        for job in jobs:
+            self._heartbeats[job.jobID] = now
+
+    def _jobsFinished(self, jobs):
+        for job in jobs:
+            self._heartbeats.pop(job.jobID, None)
+
+    def liveJobs(self, since):
+        """
+        The jobs this worker is performing which were dispatched or reported
+        by a heartbeat at or after a given time.
+
+        @param since: the time, per the controller's reactor
+        @type since: L{float}
+
+        @rtype: L{list} of L{int}
+        """
+        return [jobID for jobID, when in self._heartbeats.iteritems() if when >= since]
+
+    def staleJobs(self, since):
+        """
+        Forget, and return, the jobs this worker is meant to be performing
+        which have not been reported by a heartbeat since a given time.
+
+        @param since: the time, per the controller's reactor
+        @type since: L{float}
+
+        @rtype: L{list} of L{int}
+        """
+        stale = [jobID for jobID, when in self._heartbeats.iteritems() if when < since]
+        for jobID in stale:
+            del self._heartbeats[jobID]
+        return stale
+
     def performJob(self, job):
         """
         Dispatch a job to this worker.
@@ -261,25 +658,72 @@ class ConnectionFromWorker(AMP):
         d = self.callRemote(PerformJob, job=job)
         self._assigned += 1
         self._load += max(job.weight, 1)
+        self._jobsStarted([job])
+        self.controllerQueue.workerPool.workerLoadChanged(self)
 
         @d.addBoth
         def f(result):
             self._assigned -= 1
             self._load -= max(job.weight, 1)
             self._completed += 1
+            self._jobsFinished([job])
+            self.controllerQueue.workerPool.workerLoadChanged(self)
+            return result
+
+        return d
+
+    def performJobs(self, jobs):
+        """
+        Dispatch a batch of jobs to this worker.  The batch adds the weight of
+        its heaviest job to the load of this worker, since its jobs are
+        performed one after another.
+
+        @see: The responder for this should always be
+            L{ConnectionFromController.executeJobsHere}.
+        """
+        d = self.callRemote(PerformJobs, jobs=jobs)
+        weight = max([job.weight for job in jobs] + [1])
+        self._assigned += len(jobs)
+        self._load += weight
+        self._jobsStarted(jobs)
+        self.controllerQueue.workerPool.workerLoadChanged(self)
+
+        @d.addBoth
+        def f(result):
+            self._assigned -= len(jobs)
+            self._load -= weight
+            self._completed += len(jobs)
+            self._jobsFinished(jobs)
+            self.controllerQueue.workerPool.workerLoadChanged(self)
             return result
 
         return d
 
+    @JobHeartbeat.responder
+    def jobHeartbeat(self, jobIDs):
+        """
+        The worker is still performing some jobs.
+        """
+        now = self._now()
+        for jobID in jobIDs:
+            if jobID in self._heartbeats:
+                self._heartbeats[jobID] = now
+        return {}
+
     @EnqueuedJob.responder
-    def enqueuedJob(self):
+    def enqueuedJob(self, jobID=None, workType=None, priority=None, notBefore=None):
         """
         A worker enqueued a job and is letting us know. We need to "ping" the
         L{ControllerQueue} to ensure it is polling the job queue at its
         normal "fast" rate, as opposed to slower idle rates.
         """
 
-        self.controllerQueue.enqueuedJob()
+        if jobID is None:
+            self.controllerQueue.enqueuedJob()
+        else:
+            self.controllerQueue.enqueuedJob([_ReadyJob(
+                jobID, workType, priority, datetime.utcfromtimestamp(notBefore)
+            )])
         return {}
 
 
@@ -292,6 +736,8 @@ class ConnectionFromController(AMP):
     """
     implements(IQueuer)
 
+    heartbeatInterval = 10.0    # How often to send a JobHeartbeat while performing jobs
+
     def __init__(self, transactionFactory, whenConnected,
                  boxReceiver=None, locator=None):
         super(ConnectionFromController, self).__init__(boxReceiver, locator)
@@ -299,6 +745,8 @@ class ConnectionFromController(AMP):
         self.whenConnected = whenConnected
         from twisted.internet import reactor
         self.reactor = reactor
+        self._inFlight = collections.Counter()
+        self._heartbeatCall = None
 
     def transactionFactory(self, *args, **kwargs):
         txn = self._txnFactory(*args, **kwargs)
@@ -309,6 +757,43 @@ class ConnectionFromController(AMP):
         super(ConnectionFromController, self).startReceivingBoxes(sender)
         self.whenConnected(self)
 
+    def stopReceivingBoxes(self, reason):
+        super(ConnectionFromController, self).stopReceivingBoxes(reason)
+        self._inFlight.clear()
+        self._stopHeartbeat()
+
+    def _jobsStarted(self, jobs):
+        """
+        Jobs have started: send heartbeats until they finish.
+        """
+        for job in jobs:
+            self._inFlight[job.jobID] += 1
+        if self._heartbeatCall is None:
+            self._heartbeatCall = self.reactor.callLater(self.heartbeatInterval, self._heartbeat)
+
+    def _jobsFinished(self, jobs):
+        for job in jobs:
+            self._inFlight[job.jobID] -= 1
+            if self._inFlight[job.jobID] <= 0:
+                del self._inFlight[job.jobID]
+        if not self._inFlight:
+            self._stopHeartbeat()
+
+    def _stopHeartbeat(self):
+        if self._heartbeatCall is not None:
+            if self._heartbeatCall.active():
+                self._heartbeatCall.cancel()
+            self._heartbeatCall = None
+
+    def _heartbeat(self):
+        """
+        Tell the controller which jobs are still being performed.
+        """
+        self._heartbeatCall = None
+        if self._inFlight:
+            self.callRemote(JobHeartbeat, jobIDs=sorted(self._inFlight))
+            self._heartbeatCall = self.reactor.callLater(self.heartbeatInterval, self._heartbeat)
+
     @inlineCallbacks
     def enqueueWork(self, txn, workItemType, **kw):
         """
@@ -322,7 +807,18 @@ class ConnectionFromController(AMP):
         @type kw: keyword parameters to C{workItemType.makeJob}
         """
         work = yield workItemType.makeJob(txn, **kw)
-        self.callRemote(EnqueuedJob)
+        if work is None:
+            self.callRemote(EnqueuedJob)
+        else:
+            # Describe the job once it is visible to the controller
+            job = work.job
+            txn.postCommit(lambda: self.callRemote(
+                EnqueuedJob,
+                jobID=job.jobID,
+                workType=job.workType,
+                priority=job.priority,
+                notBefore=astimestamp(job.notBefore),
+            ))
         returnValue(work)
 
     @PerformJob.responder
@@ -332,10 +828,28 @@ class ConnectionFromController(AMP):
         process has instructed this worker to do it; so, look up the data in
         the row, and do it.
         """
+        self._jobsStarted([job])
         d = JobItem.ultimatelyPerform(self.transactionFactory, job)
+        d.addBoth(self._performed, [job])
         d.addCallback(lambda ignored: {})
         return d
 
+    def _performed(self, result, jobs):
+        self._jobsFinished(jobs)
+        return result
+
+    @PerformJobs.responder
+    def executeJobsHere(self, jobs):
+        """
+        The controller process has instructed this worker to do a batch of
+        jobs; do them all in one transaction.
+        """
+        self._jobsStarted(jobs)
+        d = JobItem.ultimatelyPerformBatch(self.transactionFactory, jobs)
+        d.addBoth(self._performed, jobs)
+        d.addCallback(lambda failed: {"failed": failed})
+        return d
+
 
 class WorkerFactory(Factory, object):
     """
@@ -389,6 +903,123 @@ class _BaseQueuer(object):
         pass
 
 
+_ReadyJob = collections.namedtuple(
+    "_ReadyJob", ["jobID", "workType", "priority", "notBefore"]
+)
+
+
+class _ReadyJobs(object):
+    """
+    The jobs a L{ControllerQueue} believes are waiting to be assigned, highest
+    priority and then earliest first.  This is only a cache: the jobs may since
+    have been assigned by another controller, or deleted, so they must be
+    locked and checked before being assigned.
+
+    @ivar needScan: whether jobs may have been created which are not in the
+        cache, so that it needs to be refilled from the database.
+    @ivar lastScan: when the cache was last refilled, per C{reactor.seconds}.
+    """
+
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self.needScan = True
+        self.lastScan = None
+        self._heap = []
+        self._known = set()
+        self._added = None
+
+    def __len__(self):
+        return len(self._heap)
+
+    def add(self, job):
+        """
+        Add a job to the cache, unless it is already there or the cache is
+        full.
+
+        @param job: the job; anything with C{jobID}, C{workType}, C{priority}
+            and C{notBefore} attributes.
+        """
+        if job.jobID in self._known or len(self._heap) >= self.maxSize:
+            return
+        self._known.add(job.jobID)
+        heappush(self._heap, (-job.priority, job.notBefore, job.jobID, job.workType))
+        if self._added is not None:
+            self._added.append(job)
+
+    def startScan(self):
+        """
+        The cache is about to be refilled from the database.
+        """
+        self.needScan = False
+        self._added = []
+
+    def finishScan(self, jobs, when):
+        """
+        Replace the contents of the cache with the jobs found by a scan, and
+        any added since it started.
+        """
+        added = self._added or []
+        self._added = None
+        self._heap = []
+        self._known = set()
+        for job in jobs:
+            self.add(job)
+        for job in added:
+            self.add(job)
+        self.lastScan = when
+
+    def take(self, now, minPriority, limit, excludeTypes=()):
+        """
+        Remove and return the IDs of up to C{limit} jobs which are due, of at
+        least the given priority and not of an excluded work type.
+
+        @rtype: L{list} of L{int}
+        """
+        heap = self._heap
+        taken = []
+        skipped = []
+        while heap and len(taken) < limit and -heap[0][0] >= minPriority:
+            entry = heappop(heap)
+            if entry[1] > now or entry[3] in excludeTypes:
+                skipped.append(entry)
+            else:
+                self._known.discard(entry[2])
+                taken.append(entry[2])
+        for entry in skipped:
+            heappush(heap, entry)
+        return taken
+
+
+class _TokenBuckets(object):
+    """
+    A token bucket per key, for rate limiting.  Each bucket fills at C{rate}
+    tokens per second, up to one second's worth (and at least one token).
+    """
+
+    def __init__(self):
+        self._buckets = {}
+
+    def available(self, key, rate, now):
+        """
+        @return: the number of tokens in the bucket for C{key} at time C{now}.
+        @rtype: L{float}
+        """
+        capacity = max(rate, 1.0)
+        tokens, then = self._buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - then) * rate)
+        self._buckets[key] = (tokens, now)
+        return tokens
+
+    def take(self, key, count=1):
+        """
+        Remove tokens from the bucket for C{key}, if there is one (i.e. if
+        L{_TokenBuckets.available} has been called for C{key}).
+        """
+        if key in self._buckets:
+            tokens, then = self._buckets[key]
+            self._buckets[key] = (max(tokens - count, 0.0), then)
+
+
 class ControllerQueue(_BaseQueuer, MultiService, object):
     """
     Each controller has a L{ControllerQueue} that polls the database
@@ -409,6 +1040,13 @@ class ControllerQueue(_BaseQueuer, MultiService, object):
         back-off.
     @type queuePollingBackoff: L{tuple}
 
+    @ivar queueNotifiedPollingBackoff: Used in place of
+        C{queuePollingBackoff} once L{ControllerQueue.listenForJobs} has been
+        called.  Enqueued jobs then trigger a work check straight away, so
+        polling is only a safety net for jobs that become due later and for
+        missed notifications, and can back off quickly.
+    @type queueNotifiedPollingBackoff: L{tuple}
+
     @ivar overloadLevel: The load level above which job dispatch will stop.
     @type overloadLevel: L{int}
 
@@ -420,6 +1058,53 @@ class ControllerQueue(_BaseQueuer, MultiService, object):
         jobs will not be dispatched.
     @type mediumPriorityLevel: L{int}
 
+    @ivar batchClaimSize: The maximum number of jobs claimed in a single
+        transaction.  If greater than 1, each work check selects (with
+        C{SKIP LOCKED} where supported) and assigns a batch of due jobs at
+        once, limited by the spare capacity of the worker pool, rather than
+        using one transaction per job.
+    @type batchClaimSize: L{int}
+
+    Jobs are only assigned within the C{maxInFlight} and C{rateLimit} limits
+    of their work type (see L{WorkItem}); work types which have reached a
+    limit are skipped by the job query.
+
+    @ivar readyQueueSize: If non-zero, keep a cache of up to this many jobs
+        waiting to be assigned, filled by jobs committed in this process and
+        reported by workers via L{EnqueuedJob}, and by periodically scanning
+        the database.  Work checks then only lock and assign specific cached
+        jobs, rather than querying the whole job table each time.  Must be set
+        before the L{ControllerQueue} is created.
+    @type readyQueueSize: L{int}
+
+    @ivar readyQueueReconcileInterval: how often, in seconds, the ready queue
+        is refilled from the database, to pick up jobs created elsewhere (for
+        which no notification was received) or rescheduled.  Each scan also
+        picks up jobs due within this interval.
+    @type readyQueueReconcileInterval: L{float}
+
+    @ivar jobBatchSize: The maximum number of jobs of a batchable work type
+        (see L{WorkItem.batchable}) sent to a worker in one L{PerformJobs}
+        command.  Jobs are only batched when several of the same type are
+        claimed together, so this has no effect unless C{batchClaimSize} or
+        C{readyQueueSize} is set.
+    @type jobBatchSize: L{int}
+
+    @ivar queuePromoteInterval: When jobs are parked (see
+        L{JobItem.parkingHorizon}), how often, in seconds, parked jobs which
+        are now due within the horizon are unparked, up to
+        C{queuePromoteBatchSize} per transaction.  This must be less than the
+        horizon, so that jobs are unparked before they are due.
+    @type queuePromoteInterval: L{float}
+
+    @ivar heartbeatTimeout: How long, in seconds, a job dispatched to a worker
+        may go without a L{JobHeartbeat} before it is assumed lost and
+        unassigned, so that it is claimed again.  Jobs whose worker is still
+        sending heartbeats are not checked for being overdue, and jobs whose
+        worker disconnects are unassigned straight away.  This must be longer
+        than L{ConnectionFromController.heartbeatInterval}.
+    @type heartbeatTimeout: L{float}
+
     @ivar reactor: The reactor used for scheduling timed events.
     @type reactor: L{IReactorTime} provider.
     """
@@ -429,6 +1114,7 @@ class ControllerQueue(_BaseQueuer, MultiService, object):
     queueOverduePollInterval = 60.0     # How often to poll for overdue work
     queueOverdueTimeout = 5.0 * 60.0    # How long before assigned work is possibly overdue
     queuePollingBackoff = ((60.0, 60.0), (5.0, 1.0),)   # Polling backoffs
+    queueNotifiedPollingBackoff = ((60.0, 60.0), (1.0, 10.0),)  # Polling backoffs when notified of new jobs
 
     overloadLevel = 95          # Percentage load level above which job queue processing stops
     highPriorityLevel = 80      # Percentage load level above which only high priority jobs are processed
@@ -440,6 +1126,18 @@ class ControllerQueue(_BaseQueuer, MultiService, object):
     # server always use 1.
     rowLimit = 1
 
+    batchClaimSize = 1
+
+    readyQueueSize = 0
+    readyQueueReconcileInterval = 5.0
+
+    jobBatchSize = 10
+
+    queuePromoteInterval = 30.0         # How often to unpark jobs that are nearly due
+    queuePromoteBatchSize = 1000
+
+    heartbeatTimeout = 60.0             # How long before a job with no heartbeat is assumed lost
+
     def __init__(self, reactor, transactionFactory, useWorkerPool=True, disableWorkProcessing=False):
         """
         Initialize a L{ControllerQueue}.
@@ -453,13 +1151,18 @@ class ControllerQueue(_BaseQueuer, MultiService, object):
         super(ControllerQueue, self).__init__()
         self.reactor = reactor
         self.transactionFactory = transactionFactory
-        self.workerPool = WorkerConnectionPool() if useWorkerPool else None
+        self.workerPool = WorkerConnectionPool(reactor=reactor) if useWorkerPool else None
         self.disableWorkProcessing = disableWorkProcessing
         self._lastMinPriority = WORK_PRIORITY_LOW
         self._timeOfLastWork = time.time()
         self._actualPollInterval = self.queuePollInterval
         self._inWorkCheck = False
         self._inOverdueCheck = False
+        self._notified = False
+        self._listening = False
+        self._jobListener = None
+        self._rateBuckets = _TokenBuckets()
+        self._readyJobs = _ReadyJobs(self.readyQueueSize) if self.readyQueueSize else None
 
     def enable(self):
         """
@@ -544,17 +1247,33 @@ class ControllerQueue(_BaseQueuer, MultiService, object):
             # that are due, ordered by priority, notBefore etc
             nowTime = datetime.utcfromtimestamp(self.reactor.seconds())
 
+            if self.batchClaimSize > 1 or self._readyJobs is not None:
+                claimLimit = self._claimLimit()
+                if claimLimit == 0:
+                    break
+                jobs = yield self._claimJobs(nowTime, minPriority, claimLimit)
+                if jobs:
+                    self._timeOfLastWork = time.time()
+                    loopCounter += len(jobs)
+                    self._dispatchJobs(jobs)
+                if len(jobs) < claimLimit:
+                    break
+                continue
+
             self._inWorkCheck = True
             txn = nextJob = None
             try:
                 txn = self.transactionFactory(label="jobqueue.workCheck")
-                nextJob = yield JobItem.nextjob(txn, nowTime, minPriority, self.rowLimit)
+                allowances = yield self._workTypeAllowances(txn)
+                blocked = [workType for workType, allowed in allowances.iteritems() if allowed < 1]
+                nextJob = yield JobItem.nextjob(txn, nowTime, minPriority, self.rowLimit, blocked)
                 if nextJob is None:
                     break
 
                 # Always assign as a new job even when it is an orphan
                 log.debug("workCheck: assigned job: {jobID}".format(jobID=nextJob.jobID))
                 yield nextJob.assign(nowTime, self.queueOverdueTimeout)
+                self._tookJobs([nextJob])
                 self._timeOfLastWork = time.time()
                 loopCounter += 1
 
@@ -617,6 +1336,199 @@ class ControllerQueue(_BaseQueuer, MultiService, object):
         if loopCounter:
             log.debug("workCheck: processed {ctr} jobs in one loop", ctr=loopCounter)
 
+    def _claimLimit(self):
+        """
+        Determine how many jobs to claim in the next batch: at most
+        C{batchClaimSize}, and no more than the worker pool has spare capacity
+        for if each job weighs 1.  L{ControllerQueue._claimJobs} takes the
+        actual weights of the jobs into account.
+        """
+        if self.workerPool is None:
+            return self.batchClaimSize
+        return min(self.batchClaimSize, self.workerPool.availableCapacity())
+
+    @inlineCallbacks
+    def _claimJobs(self, nowTime, minPriority, limit):
+        """
+        Select and assign a batch of due jobs in a single transaction.
+
+        @return: a L{Deferred} firing with the assigned L{JobItem}s, which is
+            empty if there were none or they could not be assigned.
+        """
+        ready = self._readyJobs
+        if ready is not None and not len(ready) and not self._needReadyScan():
+            # Nothing is known to be waiting, so don't query for it
+            returnValue([])
+
+        self._inWorkCheck = True
+        txn = self.transactionFactory(label="jobqueue.workCheck")
+        try:
+            allowances = yield self._workTypeAllowances(txn)
+            blocked = [workType for workType, allowed in allowances.iteritems() if allowed < 1]
+            if ready is None:
+                jobs = yield JobItem.nextjobs(txn, nowTime, minPriority, limit, blocked)
+            else:
+                jobs = yield self._readyJobsFor(txn, nowTime, minPriority, limit, blocked)
+
+            # Don't assign more of any work type than its limits allow
+            allowed = []
+            for job in jobs:
+                if job.workType in allowances:
+                    if allowances[job.workType] < 1:
+                        if ready is not None:
+                            ready.add(job)
+                        continue
+                    allowances[job.workType] -= 1
+                allowed.append(job)
+            jobs = allowed
+
+            # The claim limit counts jobs, as if each weighed 1: don't claim
+            # more weight than the workers have room for, leaving the rest
+            # unassigned (and the order of the jobs intact)
+            if self.workerPool is not None:
+                room = self.workerPool.availableCapacity()
+                for index, job in enumerate(jobs):
+                    room -= min(max(job.weight, 1), self.workerPool.maximumLoadPerWorker)
+                    if room < 0:
+                        if ready is not None:
+                            for unclaimed in jobs[index:]:
+                                ready.add(unclaimed)
+                        jobs = jobs[:index]
+                        break
+
+            yield JobItem.assignJobs(txn, jobs, nowTime, self.queueOverdueTimeout)
+        except Exception as e:
+            log.error("workCheck: Failed to claim jobs: {exc}", exc=e)
+            yield txn.abort()
+            jobs = []
+            if ready is not None:
+                # Jobs taken from the ready queue were not assigned
+                ready.needScan = True
+        else:
+            yield txn.commit()
+            self._tookJobs(jobs)
+            for job in jobs:
+                log.debug("workCheck: assigned job: {jobID}", jobID=job.jobID)
+        finally:
+            self._inWorkCheck = False
+        returnValue(jobs)
+
+    def _needReadyScan(self):
+        """
+        Whether the ready queue should be refilled from the database.
+        """
+        ready = self._readyJobs
+        return ready.needScan or ready.lastScan is None or (
+            self.reactor.seconds() - ready.lastScan >= self.readyQueueReconcileInterval
+        )
+
+    @inlineCallbacks
+    def _readyJobsFor(self, txn, nowTime, minPriority, limit, blocked):
+        """
+        Take due jobs from the ready queue, refilling it first if needed, and
+        lock those which are still waiting to be assigned.
+
+        @return: a L{Deferred} firing with the locked L{JobItem}s, highest
+            priority first.
+        """
+        ready = self._readyJobs
+        if self._needReadyScan():
+            ready.startScan()
+            try:
+                scanned = yield JobItem.readyJobs(
+                    txn,
+                    nowTime + timedelta(seconds=self.readyQueueReconcileInterval),
+                    ready.maxSize,
+                )
+            except:
+                ready.needScan = True
+                raise
+            ready.finishScan(scanned, self.reactor.seconds())
+
+        jobIDs = ready.take(nowTime, minPriority, limit, blocked)
+        if not jobIDs:
+            returnValue([])
+        jobs = yield JobItem.lockJobs(txn, jobIDs, nowTime)
+        jobs.sort(key=lambda job: (-job.priority, job.notBefore))
+        returnValue(jobs)
+
+    @inlineCallbacks
+    def _workTypeAllowances(self, txn):
+        """
+        Determine how many more jobs of each work type with a C{maxInFlight}
+        or C{rateLimit} limit may be assigned right now.
+
+        @return: a L{Deferred} firing with a C{dict} mapping limited work types
+            to the number of jobs that may be assigned, which is a L{float}
+            for rate limited types.
+        """
+        allowances = {}
+        maxInFlight = {}
+        now = self.reactor.seconds()
+        for workItemType in JobItem.workTypes():
+            workType = workItemType.workType()
+            if workItemType.rateLimit is not None:
+                allowances[workType] = self._rateBuckets.available(
+                    workType, workItemType.rateLimit, now
+                )
+            if workItemType.maxInFlight is not None:
+                maxInFlight[workType] = workItemType.maxInFlight
+        if maxInFlight:
+            inFlight = yield JobItem.inFlight(txn, maxInFlight.keys())
+            for workType, limit in maxInFlight.iteritems():
+                remaining = max(limit - inFlight.get(workType, 0), 0)
+                allowances[workType] = min(allowances.get(workType, remaining), remaining)
+        returnValue(allowances)
+
+    def _tookJobs(self, jobs):
+        """
+        Jobs have been assigned: use up the rate limit of their work types.
+        """
+        for job in jobs:
+            self._rateBuckets.take(job.workType)
+
+    def _dispatchJobs(self, jobs):
+        """
+        Send each of a batch of assigned jobs to a performer, without waiting
+        for them to complete.  Jobs of batchable work types are sent together,
+        up to C{jobBatchSize} at a time.
+        """
+        workTypes = JobItem.allWorkTypes()
+        batches = collections.OrderedDict()
+        for job in jobs:
+            workItemType = workTypes.get(job.workType)
+            if workItemType is not None and workItemType.batchable and self.jobBatchSize > 1:
+                batches.setdefault(job.workType, []).append(job)
+            else:
+                self._dispatchJob(job)
+
+        for batch in batches.itervalues():
+            for start in xrange(0, len(batch), self.jobBatchSize):
+                chunk = batch[start:start + self.jobBatchSize]
+                if len(chunk) == 1:
+                    self._dispatchJob(chunk[0])
+                    continue
+                try:
+                    worker = self.choosePerformer(onlyLocally=True)
+                    worker.performJobs([job.descriptor() for job in chunk])
+                except Exception as e:
+                    log.error(
+                        "workCheck: Failed to perform jobs for jobids={jobids}, {exc}",
+                        jobids=[job.jobID for job in chunk],
+                        exc=e,
+                    )
+
+    def _dispatchJob(self, job):
+        """
+        Send an assigned job to a performer, without waiting for it to
+        complete.
+        """
+        try:
+            worker = self.choosePerformer(onlyLocally=True)
+            worker.performJob(job.descriptor())
+        except Exception as e:
+            log.error("workCheck: Failed to perform job for jobid={jobid}, {exc}", jobid=job.jobID, exc=e)
+
     _workCheckCall = None
 
     @inlineCallbacks
@@ -627,6 +1539,7 @@ class ControllerQueue(_BaseQueuer, MultiService, object):
         when there is not a lot to do.
         """
         self._workCheckCall = None
+        self._notified = False
 
         if not self.running:
             returnValue(None)
@@ -644,10 +1557,17 @@ class ControllerQueue(_BaseQueuer, MultiService, object):
         # excessive power when there is nothing to do
         interval = self.queuePollInterval
         idle = time.time() - self._timeOfLastWork
-        for threshold, poll in self.queuePollingBackoff:
+        if self._listening:
+            backoff = self.queueNotifiedPollingBackoff
+        else:
+            backoff = self.queuePollingBackoff
+        for threshold, poll in backoff:
             if idle > threshold:
                 interval = poll
                 break
+        if self._notified:
+            # Jobs were enqueued while we were checking - they may have been missed
+            interval = 0
         if self._actualPollInterval != interval:
             log.debug("_workCheckLoop: interval set to {interval}s", interval=interval)
         self._actualPollInterval = interval
@@ -660,8 +1580,27 @@ class ControllerQueue(_BaseQueuer, MultiService, object):
         """
         Every controller will periodically check for any overdue work and unassign that
         work so that it gets execute during the next regular work check.
+
+        Overdue jobs which our workers are known to be performing, or which
+        are being held for a worker, have their overdue value bumped all at
+        once, first, and are skipped.
         """
 
+        liveJobIDs = self._liveJobIDs()
+        if liveJobIDs and self.running and not self.disableWorkProcessing:
+            nowTime = datetime.utcfromtimestamp(self.reactor.seconds())
+            try:
+                yield inTransaction(
+                    self.transactionFactory,
+                    lambda txn: JobItem.bumpOverdueJobs(
+                        txn, sorted(liveJobIDs), nowTime, self.queueOverdueTimeout
+                    ),
+                    label="jobqueue.overdueCheck.live",
+                )
+            except Exception as e:
+                # Any that are still overdue are checked one at a time below
+                log.error("overdueCheck: Failed to bump overdue live jobs: {exc}", exc=e)
+
         loopCounter = 0
         while True:
             if not self.running or self.disableWorkProcessing:
@@ -676,7 +1615,9 @@ class ControllerQueue(_BaseQueuer, MultiService, object):
             txn = overdueJob = None
             try:
                 txn = self.transactionFactory(label="jobqueue.overdueCheck")
-                overdueJob = yield JobItem.overduejob(txn, nowTime, self.rowLimit)
+                overdueJob = yield JobItem.overduejob(
+                    txn, nowTime, self.rowLimit, excludeJobIDs=liveJobIDs
+                )
                 if overdueJob is None:
                     break
 
@@ -749,9 +1690,66 @@ class ControllerQueue(_BaseQueuer, MultiService, object):
 
         if loopCounter:
             # Make sure the regular work check loop runs immediately if we processed any overdue items
+            if self._readyJobs is not None:
+                self._readyJobs.needScan = True
             yield self.enqueuedJob()
             log.debug("overdueCheck: processed {ctr} jobs in one loop", ctr=loopCounter)
 
+    def _liveJobIDs(self):
+        """
+        The jobs which our workers are known to be performing right now, or
+        which are being held until a worker has room for them.
+
+        @rtype: L{set} of L{int}
+        """
+        if self.workerPool is None:
+            return set()
+        since = self.reactor.seconds() - self.heartbeatTimeout
+        live = self.workerPool.heldJobIDs()
+        for worker in self.workerPool.workers:
+            live.update(worker.liveJobs(since))
+        return live
+
+    def _heartbeatCheck(self):
+        """
+        Unassign the jobs whose worker has stopped sending heartbeats for them.
+        """
+        if self.workerPool is None:
+            return succeed(None)
+        since = self.reactor.seconds() - self.heartbeatTimeout
+        lost = []
+        for worker in self.workerPool.workers:
+            lost.extend(worker.staleJobs(since))
+        if not lost:
+            return succeed(None)
+        log.error("heartbeatCheck: no heartbeat for jobs: {jobIDs}", jobIDs=sorted(lost))
+        return self.jobsLost(lost)
+
+    @inlineCallbacks
+    def jobsLost(self, jobIDs):
+        """
+        Some jobs that were dispatched to a worker will not be completed,
+        because the worker went away or stopped responding.  Unassign them all,
+        with one statement, so that they are claimed again.
+
+        @param jobIDs: the IDs of the jobs
+        @type jobIDs: L{list} of L{int}
+        """
+        try:
+            yield inTransaction(
+                self.transactionFactory,
+                lambda txn: JobItem.unassignJobs(txn, sorted(jobIDs)),
+                label="jobqueue.jobsLost",
+            )
+        except Exception as e:
+            # The overdue check will pick them up eventually
+            log.error("jobsLost: Failed to unassign jobs: {jobIDs}, {exc}", jobIDs=jobIDs, exc=e)
+            returnValue(None)
+
+        log.debug("jobsLost: unassigned {ctr} jobs", ctr=len(jobIDs))
+        self._jobsReady(None)
+        self.enqueuedJob()
+
     _overdueCheckCall = None
 
     @inlineCallbacks
@@ -765,6 +1763,7 @@ class ControllerQueue(_BaseQueuer, MultiService, object):
             returnValue(None)
 
         try:
+            yield self._heartbeatCheck()
             yield self._overdueCheck()
         except Exception as e:
             log.error("_overdueCheckLoop: {exc}", exc=e)
@@ -776,11 +1775,82 @@ class ControllerQueue(_BaseQueuer, MultiService, object):
             self.queueOverduePollInterval, self._overdueCheckLoop
         )
 
-    def enqueuedJob(self):
+    @inlineCallbacks
+    def _promoteCheck(self):
+        """
+        Unpark the parked jobs which are now due within
+        L{JobItem.parkingHorizon}, so that they can be claimed.
+        """
+
+        promoted = 0
+        while self.running and not self.disableWorkProcessing:
+            until = datetime.utcfromtimestamp(self.reactor.seconds()) + timedelta(seconds=JobItem.parkingHorizon)
+            jobIDs = yield inTransaction(
+                self.transactionFactory,
+                lambda txn: JobItem.promoteParked(txn, until, self.queuePromoteBatchSize),
+                label="jobqueue.promoteCheck",
+            )
+            promoted += len(jobIDs)
+            if len(jobIDs) < self.queuePromoteBatchSize:
+                break
+
+        if promoted:
+            # Make sure the regular work check sees the unparked jobs
+            self._jobsReady(None)
+            self.enqueuedJob()
+            log.debug("promoteCheck: unparked {ctr} jobs", ctr=promoted)
+
+    _promoteCheckCall = None
+
+    @inlineCallbacks
+    def _promoteCheckLoop(self):
+        """
+        While the service is running, and jobs are being parked, keep
+        unparking them as they become due.
+        """
+        self._promoteCheckCall = None
+
+        if not self.running or JobItem.parkingHorizon is None:
+            returnValue(None)
+
+        try:
+            yield self._promoteCheck()
+        except Exception as e:
+            log.error("_promoteCheckLoop: {exc}", exc=e)
+
+        if not self.running:
+            returnValue(None)
+
+        self._promoteCheckCall = self.reactor.callLater(
+            self.queuePromoteInterval, self._promoteCheckLoop
+        )
+
+    def _jobsReady(self, jobs):
+        """
+        Add newly committed jobs to the ready queue, if there is one.
+
+        @param jobs: the jobs, or C{None} if they are not known, in which case
+            the ready queue is refilled from the database at the next work
+            check.
+        """
+        if self._readyJobs is None:
+            return
+        if jobs is None:
+            self._readyJobs.needScan = True
+        else:
+            for job in jobs:
+                self._readyJobs.add(job)
+
+    def enqueuedJob(self, jobs=None):
         """
         Reschedule the work check loop to run right now. This should be called in response to "external" activity that
         might want to "speed up" the job queue polling because new work may have been added.
+
+        @param jobs: the jobs enqueued, if known and committed, to be added to
+            the ready queue.
         """
+        if jobs is not None:
+            self._jobsReady(jobs)
 
         # Only need to do this if the actual poll interval is greater than the default rapid value
         if self._actualPollInterval == self.queuePollInterval:
@@ -797,14 +1867,58 @@ class ControllerQueue(_BaseQueuer, MultiService, object):
         except (AlreadyCalled, AlreadyCancelled):
             pass
 
+    def listenForJobs(self, connectionFactory=None):
+        """
+        Check for work as soon as new jobs are committed, rather than waiting
+        for the next poll, and poll less often (see
+        C{queueNotifiedPollingBackoff}).  Must be called before the service is
+        started.
+
+        @param connectionFactory: a 0-argument callable returning a DB-API
+            connection, used to hold a dedicated connection listening for
+            PostgreSQL notifications of jobs committed by any process.  If
+            C{None}, only jobs committed in this process are noticed, which
+            is only appropriate when this process creates all the jobs (or
+            for testing).
+        """
+        self._listening = True
+        if connectionFactory is not None:
+            self._jobListener = JobListener(
+                self.reactor, connectionFactory, self.jobNotified
+            )
+            self._jobListener.setServiceParent(self)
+
+    def jobNotified(self, jobs=None):
+        """
+        New jobs have been committed: check for work right now.
+
+        @param jobs: the jobs committed, or C{None} if they are not known (as
+            for notifications from the database).
+        """
+        if not self.running:
+            return
+        self._jobsReady(jobs)
+        self._timeOfLastWork = time.time()
+        if self._workCheckCall is None:
+            # A work check is in progress and may already have looked for
+            # jobs, so have the loop run again as soon as it is done
+            self._notified = True
+            return
+        try:
+            self._workCheckCall.reset(0)
+        except (AlreadyCalled, AlreadyCancelled):
+            pass
+
     def startService(self):
         """
         Register ourselves with the database and establish all outgoing
         connections to other servers in the cluster.
         """
         super(ControllerQueue, self).startService()
+        localJobNotifier.addListener(self.jobNotified)
         self._workCheckLoop()
         self._overdueCheckLoop()
+        self._promoteCheckLoop()
 
     @inlineCallbacks
     def stopService(self):
@@ -814,6 +1928,13 @@ class ControllerQueue(_BaseQueuer, MultiService, object):
 
         yield super(ControllerQueue, self).stopService()
 
+        localJobNotifier.removeListener(self.jobNotified)
+
+        # Jobs still being held for a worker will never be dispatched now;
+        # being assigned, they will be picked up again once they are overdue.
+        if self.workerPool is not None:
+            self.workerPool.dropHeld(CancelledError("Job queue stopped"))
+
         if self._workCheckCall is not None:
             self._workCheckCall.cancel()
             self._workCheckCall = None
@@ -822,6 +1943,10 @@ class ControllerQueue(_BaseQueuer, MultiService, object):
             self._overdueCheckCall.cancel()
             self._overdueCheckCall = None
 
+        if self._promoteCheckCall is not None:
+            self._promoteCheckCall.cancel()
+            self._promoteCheckCall = None
+
         # Wait for any active work check to finish (but no more than 1 minute)
         start = time.time()
         while self._inWorkCheck and self._inOverdueCheck:
@@ -851,6 +1976,14 @@ class LocalPerformer(object):
         """
         return JobItem.ultimatelyPerform(self.txnFactory, job)
 
+    def performJobs(self, jobs):
+        """
+        Perform the given batch of jobs right now.
+        """
+        d = JobItem.ultimatelyPerformBatch(self.txnFactory, jobs)
+        d.addCallback(lambda failed: {"failed": failed})
+        return d
+
 
 class LocalQueuer(_BaseQueuer):
     """
@@ -887,6 +2020,12 @@ class NonPerformer(object):
         """
         return succeed(None)
 
+    def performJobs(self, jobs):
+        """
+        Don't perform jobs.
+        """
+        return succeed(None)
+
 
 class NonPerformingQueuer(_BaseQueuer):
     """
@@ -0,0 +1,505 @@
+##
+# Copyright (c) 2017 Apple Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Benchmark for the job queue: jobs are enqueued, claimed by a
+L{ControllerQueue} and performed by fake worker processes, for each
+combination of worker count, job priorities and job weights.
+
+The workers run in this process, but each is connected to the controller over
+AMP on its own UNIX socket pair, so the controller/worker protocol is
+exercised as it is in production.  Jobs are stored in SQLite, or in
+PostgreSQL if C{--postgres} is given a C{psycopg2} connection string (the
+tables are created and dropped by the benchmark).
+
+Run it like this::
+
+    python -m twext.enterprise.jobs.test.bench_jobs --workers=1,4 --jobs=1000
+
+Each scenario is written as one line of JSON, so results can be kept and
+compared between runs to spot regressions.  The results are:
+
+    - C{enqueueRate}: jobs enqueued per second, one job per transaction.
+    - C{jobsPerSecond}: jobs completed per second, from the first job being
+      enqueued to the last one completing.
+    - C{claimToStart}: milliseconds from the controller dispatching a job to a
+      worker to the work starting.
+    - C{enqueueToStart}: milliseconds from a job being committed to its work
+      starting.
+    - C{cpuPerJob}: milliseconds of CPU time used by this process per job.
+      This includes the workers and the database driver, so it is an upper
+      bound on the CPU used by the controller.
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import resource
+import shutil
+import socket
+import sqlite3
+import sys
+import tempfile
+import time
+
+from twisted.internet.defer import inlineCallbacks, returnValue, Deferred, \
+    succeed
+from twisted.internet.task import deferLater, react
+from twisted.python.usage import Options, UsageError
+
+from twext.enterprise.adbapi2 import ConnectionPool
+from twext.enterprise.dal.record import fromTable
+from twext.enterprise.dal.syntax import SchemaSyntax
+from twext.enterprise.ienterprise import DatabaseType, POSTGRES_DIALECT, \
+    SQLITE_DIALECT
+from twext.enterprise.jobs.queue import ControllerQueue, WorkerFactory
+from twext.enterprise.jobs.test.test_jobs import SimpleSchemaHelper, \
+    jobSchema
+from twext.enterprise.jobs.utils import inTransaction
+from twext.enterprise.jobs.workitem import WorkItem, WORK_PRIORITY_LOW, \
+    WORK_PRIORITY_MEDIUM, WORK_PRIORITY_HIGH
+
+
+benchSchemaText = """
+    create table BENCH_WORK_ITEM (
+      WORK_ID integer primary key,
+      JOB_ID integer references JOB
+    );
+"""
+
+# SQLite reuses the largest row ID once that row is deleted, which happens
+# all the time when the queue drains quickly, so insist on new ones.
+sqliteSchemaText = """
+    create table JOB (
+      JOB_ID      integer primary key autoincrement,
+      WORK_TYPE   varchar(255) not null,
+      PRIORITY    integer default 0 not null,
+      WEIGHT      integer default 0 not null,
+      NOT_BEFORE  timestamp not null,
+      IS_ASSIGNED integer default 0 not null,
+      ASSIGNED    timestamp default null,
+      OVERDUE     timestamp default null,
+      FAILED      integer default 0 not null,
+      PAUSE       integer default 0 not null,
+      DEDUP_KEY   varchar(255) default null
+    );
+    create unique index JOB_DEDUP_KEY on JOB(DEDUP_KEY);
+    create table JOB_DEAD (
+      JOB_ID      integer primary key,
+      WORK_TYPE   varchar(255) not null,
+      PRIORITY    integer default 0 not null,
+      WEIGHT      integer default 0 not null,
+      FAILED      integer default 0 not null,
+      DIED        timestamp not null,
+      WORK_DATA   text default null
+    );
+    create table BENCH_WORK_ITEM (
+      WORK_ID integer primary key autoincrement,
+      JOB_ID integer references JOB
+    );
+"""
+
+postgresSchemaText = """
+    create sequence JOB_SEQ;
+    create sequence WORKITEM_SEQ;
+    create table JOB (
+      JOB_ID      integer primary key default nextval('JOB_SEQ'),
+      WORK_TYPE   varchar(255) not null,
+      PRIORITY    integer default 0 not null,
+      WEIGHT      integer default 0 not null,
+      NOT_BEFORE  timestamp not null,
+      IS_ASSIGNED integer default 0 not null,
+      ASSIGNED    timestamp default null,
+      OVERDUE     timestamp default null,
+      FAILED      integer default 0 not null,
+      PAUSE       integer default 0 not null,
+      DEDUP_KEY   varchar(255) default null
+    );
+    create unique index JOB_DEDUP_KEY on JOB(DEDUP_KEY);
+    create table JOB_DEAD (
+      JOB_ID      integer primary key,
+      WORK_TYPE   varchar(255) not null,
+      PRIORITY    integer default 0 not null,
+      WEIGHT      integer default 0 not null,
+      FAILED      integer default 0 not null,
+      DIED        timestamp not null,
+      WORK_DATA   text default null
+    );
+    create table BENCH_WORK_ITEM (
+      WORK_ID integer primary key default nextval('WORKITEM_SEQ'),
+      JOB_ID integer references JOB
+    );
+"""
+
+postgresDropText = """
+    drop table if exists BENCH_WORK_ITEM;
+    drop table if exists JOB_DEAD;
+    drop table if exists JOB;
+    drop sequence if exists WORKITEM_SEQ;
+    drop sequence if exists JOB_SEQ;
+"""
+
+schema = SchemaSyntax(
+    SimpleSchemaHelper().schemaFromString(jobSchema + benchSchemaText)
+)
+
+PRIORITIES = {
+    "low": (WORK_PRIORITY_LOW,),
+    "medium": (WORK_PRIORITY_MEDIUM,),
+    "high": (WORK_PRIORITY_HIGH,),
+    "mixed": (WORK_PRIORITY_LOW, WORK_PRIORITY_MEDIUM, WORK_PRIORITY_HIGH),
+}
+
+MIXED_WEIGHTS = (1, 1, 1, 5, 10)
+
+
+class BenchWorkItem(WorkItem, fromTable(schema.BENCH_WORK_ITEM)):
+    """
+    A L{WorkItem} which does nothing but note when it started.
+    """
+
+    started = {}
+
+    def doWork(self):
+        self.started[self.jobID] = time.time()
+        return succeed(None)
+
+
+class BenchControllerQueue(ControllerQueue):
+    """
+    A L{ControllerQueue} with the batch claim and ready queue sizes under test.
+    """
+
+    def __init__(self, reactor, transactionFactory, batchClaimSize, readyQueueSize):
+        self.batchClaimSize = batchClaimSize
+        self.readyQueueSize = readyQueueSize
+        super(BenchControllerQueue, self).__init__(reactor, transactionFactory)
+
+
+def percentiles(values):
+    """
+    Summarize some times.
+
+    @param values: times, in seconds.
+
+    @return: the 50th and 99th percentile and maximum, in milliseconds.
+    @rtype: C{dict}
+    """
+    if not values:
+        return {"p50": None, "p99": None, "max": None}
+    values = sorted(values)
+
+    def at(percent):
+        return values[min(len(values) - 1, int(len(values) * percent / 100.0))] * 1000
+
+    return {"p50": at(50), "p99": at(99), "max": values[-1] * 1000}
+
+
+def cpuTime():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+class SQLiteDatabase(object):
+    """
+    A fresh SQLite database file for each scenario.  SQLite only allows one
+    writer at a time, so it is used through a single connection.
+    """
+
+    dbtype = DatabaseType(SQLITE_DIALECT, "numeric")
+    name = "sqlite"
+    maxConnections = 1
+
+    def __init__(self):
+        self._directory = tempfile.mkdtemp()
+        self._count = 0
+
+    def create(self):
+        """
+        Create an empty database.
+
+        @return: a 0- or 1-argument callable returning DB-API connections to it.
+        """
+        self._count += 1
+        path = os.path.join(self._directory, "jobs{}.sqlite".format(self._count))
+        seqs = {}
+
+        def connectionFactory(label=None):
+            conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+
+            def nextval(seq):
+                result = seqs[seq] = seqs.get(seq, 0) + 1
+                return result
+
+            conn.create_function("nextval", 1, nextval)
+            return conn
+
+        conn = connectionFactory()
+        conn.executescript(sqliteSchemaText)
+        conn.commit()
+        conn.close()
+        return connectionFactory
+
+    def destroy(self):
+        pass
+
+    def close(self):
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+
+class PostgresDatabase(object):
+    """
+    Fresh tables in an existing PostgreSQL database for each scenario.
+    """
+
+    dbtype = DatabaseType(POSTGRES_DIALECT, "pyformat", ("skip-locked",))
+    name = "postgres"
+    maxConnections = 10
+
+    def __init__(self, dsn):
+        import psycopg2
+        self._connect = lambda label=None: psycopg2.connect(dsn)
+
+    def _execute(self, sql):
+        conn = self._connect()
+        try:
+            cursor = conn.cursor()
+            cursor.execute(sql)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def create(self):
+        self._execute(postgresDropText)
+        self._execute(postgresSchemaText)
+        return self._connect
+
+    def destroy(self):
+        self._execute(postgresDropText)
+
+    def close(self):
+        pass
+
+
+class Scenario(object):
+    """
+    One run of the benchmark.
+    """
+
+    def __init__(self, reactor, database, workers, priorities, weights,
+                 jobs, batchClaimSize, readyQueueSize):
+        self.reactor = reactor
+        self.database = database
+        self.workers = workers
+        self.priorities = priorities
+        self.weights = weights
+        self.jobs = jobs
+        self.batchClaimSize = batchClaimSize
+        self.readyQueueSize = readyQueueSize
+        self.dispatched = {}
+        self.completed = {}
+        self.enqueued = {}
+        self._allDone = Deferred()
+
+    def _priority(self, index):
+        priorities = PRIORITIES[self.priorities]
+        return priorities[index % len(priorities)]
+
+    def _weight(self, index):
+        if self.weights == "mixed":
+            return MIXED_WEIGHTS[index % len(MIXED_WEIGHTS)]
+        return int(self.weights)
+
+    def _performJob(self, performJob, job):
+        """
+        Wraps L{WorkerConnectionPool.performJob} to time the job.
+        """
+        self.dispatched[job.jobID] = time.time()
+
+        def done(result):
+            self.completed[job.jobID] = time.time()
+            if len(self.completed) == self.jobs:
+                self._allDone.callback(None)
+            return result
+
+        return performJob(job).addBoth(done)
+
+    def _connectWorker(self, controller, pool):
+        """
+        Connect a worker to the controller over a UNIX socket pair.
+        """
+        controllerEnd, workerEnd = socket.socketpair()
+        self.reactor.adoptStreamConnection(
+            controllerEnd.fileno(), socket.AF_UNIX,
+            controller.workerListenerFactory()
+        )
+        self.reactor.adoptStreamConnection(
+            workerEnd.fileno(), socket.AF_UNIX,
+            WorkerFactory(pool.connection, lambda protocol: None)
+        )
+        controllerEnd.close()
+        workerEnd.close()
+
+    @inlineCallbacks
+    def run(self):
+        """
+        Run the scenario.
+
+        @return: a L{Deferred} firing with the results.
+        @rtype: L{Deferred} firing C{dict}
+        """
+        BenchWorkItem.started.clear()
+        connectionFactory = self.database.create()
+        pool = ConnectionPool(
+            connectionFactory,
+            maxConnections=self.database.maxConnections,
+            dbtype=self.database.dbtype,
+        )
+        pool.startService()
+
+        controller = BenchControllerQueue(
+            self.reactor, pool.connection, self.batchClaimSize, self.readyQueueSize
+        )
+        performJob = controller.workerPool.performJob
+        controller.workerPool.performJob = lambda job: self._performJob(performJob, job)
+        controller.listenForJobs()
+        controller.startService()
+
+        for _ignore in range(self.workers):
+            self._connectWorker(controller, pool)
+        while len(controller.workerPool.workers) < self.workers:
+            yield deferLater(self.reactor, 0.01, lambda: None)
+
+        try:
+            cpuStart = cpuTime()
+            start = time.time()
+            for index in xrange(self.jobs):
+                work = yield inTransaction(
+                    pool.connection,
+                    lambda txn: BenchWorkItem.makeJob(
+                        txn,
+                        priority=self._priority(index),
+                        weight=self._weight(index),
+                    ),
+                )
+                self.enqueued[work.jobID] = time.time()
+            enqueueTime = time.time() - start
+            yield self._allDone
+            elapsed = time.time() - start
+            cpu = cpuTime() - cpuStart
+        finally:
+            yield controller.stopService()
+            for worker in list(controller.workerPool.workers):
+                worker.transport.loseConnection()
+            yield pool.stopService()
+            self.database.destroy()
+
+        started = BenchWorkItem.started
+        returnValue({
+            "timestamp": start,
+            "database": self.database.name,
+            "workers": self.workers,
+            "priorities": self.priorities,
+            "weights": self.weights,
+            "jobs": self.jobs,
+            "batchClaimSize": self.batchClaimSize,
+            "readyQueueSize": self.readyQueueSize,
+            "enqueueRate": self.jobs / enqueueTime,
+            "jobsPerSecond": self.jobs / elapsed,
+            "claimToStart": percentiles([
+                started[jobID] - self.dispatched[jobID] for jobID in started
+            ]),
+            "enqueueToStart": percentiles([
+                started[jobID] - self.enqueued[jobID] for jobID in started
+            ]),
+            "cpuPerJob": cpu * 1000 / self.jobs,
+        })
+
+
+class BenchOptions(Options):
+    """
+    Command line options for the job queue benchmark.
+    """
+
+    longdesc = "Run each combination of worker count, priorities and weights."
+
+    optParameters = [
+        ["jobs", "n", 500, "Number of jobs per scenario.", int],
+        ["workers", "w", "1,2,4", "Comma-separated worker counts."],
+        ["priorities", "p", "low,mixed",
+         "Comma-separated job priorities: low, medium, high or mixed."],
+        ["weights", "W", "1,5",
+         "Comma-separated job weights: an integer, or mixed."],
+        ["batch-size", "b", 1, "ControllerQueue.batchClaimSize.", int],
+        ["ready-queue", "r", 0, "ControllerQueue.readyQueueSize.", int],
+        ["postgres", None, None,
+         "psycopg2 connection string of a PostgreSQL database to use instead "
+         "of SQLite."],
+        ["output", "o", None, "File to append results to, instead of stdout."],
+    ]
+
+    def postOptions(self):
+        self["workers"] = [int(count) for count in self["workers"].split(",")]
+        self["priorities"] = self["priorities"].split(",")
+        for priority in self["priorities"]:
+            if priority not in PRIORITIES:
+                raise UsageError("Unknown priority: {}".format(priority))
+        self["weights"] = self["weights"].split(",")
+        for weight in self["weights"]:
+            if weight != "mixed" and not weight.isdigit():
+                raise UsageError("Unknown weight: {}".format(weight))
+
+
+@inlineCallbacks
+def runBenchmark(reactor, options):
+    """
+    Run every scenario given by C{options}, writing the results as they come.
+    """
+    if options["postgres"]:
+        database = PostgresDatabase(options["postgres"])
+    else:
+        database = SQLiteDatabase()
+    output = open(options["output"], "a") if options["output"] else sys.stdout
+    try:
+        for workers in options["workers"]:
+            for priorities in options["priorities"]:
+                for weights in options["weights"]:
+                    result = yield Scenario(
+                        reactor, database, workers, priorities, weights,
+                        options["jobs"], options["batch-size"],
+                        options["ready-queue"],
+                    ).run()
+                    output.write(json.dumps(result, sort_keys=True) + "\n")
+                    output.flush()
+    finally:
+        database.close()
+        if output is not sys.stdout:
+            output.close()
+
+
+def main(argv=sys.argv[1:]):
+    options = BenchOptions()
+    try:
+        options.parseOptions(argv)
+    except UsageError as e:
+        print("{}\n{}".format(options, e))
+        sys.exit(1)
+    react(runBenchmark, [options])
+
+
+if __name__ == "__main__":
+    main()
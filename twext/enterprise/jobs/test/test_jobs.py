@@ -19,6 +19,8 @@ Tests for L{twext.enterprise.job.queue}.
 """
 
 import datetime
+from itertools import count
+import time
 
 from zope.interface.verify import verifyObject
 
@@ -29,6 +31,8 @@ from twisted.internet.defer import \
     Deferred, inlineCallbacks, gatherResults, passthru, returnValue, succeed, \
     CancelledError
 from twisted.internet.task import Clock as _Clock
+from twisted.internet.error import ConnectionDone
+from twisted.python.failure import Failure
 from twisted.protocols.amp import Command, AMP, Integer
 from twisted.application.service import Service, MultiService
 
@@ -36,19 +40,25 @@ from twext.enterprise.dal.syntax import SchemaSyntax, Delete
 from twext.enterprise.dal.parseschema import splitSQLString
 from twext.enterprise.dal.record import fromTable
 from twext.enterprise.dal.test.test_parseschema import SchemaTestHelper
+from twext.enterprise.dal.test.test_sqlsyntax import CatchSQL
 from twext.enterprise.fixtures import buildConnectionPool
 from twext.enterprise.fixtures import SteppablePoolHelper
+from twext.enterprise.fixtures import ConnectionPoolHelper, FakeThreadHolder
+from twext.enterprise.fixtures import resultOf
+from twext.enterprise.ienterprise import DatabaseType, ORACLE_DIALECT
 from twext.enterprise.jobs.utils import inTransaction, astimestamp
 from twext.enterprise.jobs.workitem import \
     WorkItem, SingletonWorkItem, \
     WORK_PRIORITY_LOW, WORK_PRIORITY_HIGH, WORK_PRIORITY_MEDIUM, WORK_WEIGHT_5, \
-    WORK_WEIGHT_1, WORK_WEIGHT_10, WORK_WEIGHT_0
+    WORK_WEIGHT_1, WORK_WEIGHT_10, WORK_WEIGHT_0, WORK_WEIGHT_CAPACITY
 from twext.enterprise.jobs.jobitem import \
-    JobItem, JobDescriptor, JobFailedError, JobTemporaryError
+    JobItem, JobDescriptor, JobFailedError, JobTemporaryError, JOB_PARKED
+from twext.enterprise.jobs.notify import \
+    JobListener, localJobNotifier, notifyNewJob, JOB_CHANNEL
 from twext.enterprise.jobs.queue import \
-    WorkerConnectionPool, ControllerQueue, \
+    WorkerConnectionPool, ControllerQueue, ConnectionFromController, \
     LocalPerformer, _IJobPerformer, \
-    NonPerformingQueuer
+    NonPerformingQueuer, _ReadyJob, _ReadyJobs
 
 # TODO: There should be a store-building utility within twext.enterprise.
 try:
@@ -196,7 +206,18 @@ jobSchema = SQL(
       ASSIGNED    timestamp default null,
       OVERDUE     timestamp default null,
       FAILED      integer default 0 not null,
-      PAUSE       integer default 0 not null
+      PAUSE       integer default 0 not null,
+      DEDUP_KEY   varchar(255) default null
+    );
+    create unique index JOB_DEDUP_KEY on JOB(DEDUP_KEY);
+    create table JOB_DEAD (
+      JOB_ID      integer primary key,
+      WORK_TYPE   varchar(255) not null,
+      PRIORITY    integer default 0 not null,
+      WEIGHT      integer default 0 not null,
+      FAILED      integer default 0 not null,
+      DIED        timestamp not null,
+      WORK_DATA   text default null
     );
     """
 )
@@ -248,7 +269,7 @@ try:
             "AGGREGATOR_WORK_ITEM",
             "UPDATE_WORK_ITEM",
         )
-    ] + ["delete from job"]
+    ] + ["delete from job", "delete from job_dead"]
 except SkipTest as e:
     DummyWorkItemTable = object
     DummyWorkSingletonItemTable = object
@@ -579,6 +600,258 @@ class WorkItemTests(TestCase):
         self.assertTrue(job is None)
         self.assertTrue(work is None)
 
+    @inlineCallbacks
+    def test_nextjobs(self):
+        """
+        L{JobItem.nextjobs} returns up to the given number of available jobs,
+        highest priority first, and L{JobItem.assignJobs} assigns them all.
+        """
+        dbpool = buildConnectionPool(self, jobSchema + schemaText)
+        now = datetime.datetime.utcnow()
+        past = now + datetime.timedelta(days=-1)
+        yield self._enqueue(dbpool, 1, 1, past)
+        yield self._enqueue(dbpool, 2, 1, past, priority=WORK_PRIORITY_HIGH)
+        yield self._enqueue(dbpool, 3, 1, past, priority=WORK_PRIORITY_MEDIUM)
+        yield self._enqueue(dbpool, 4, 1, now + datetime.timedelta(days=1))
+
+        @inlineCallbacks
+        def _claim(txn, limit):
+            jobs = yield JobItem.nextjobs(txn, now, WORK_PRIORITY_LOW, limit)
+            yield JobItem.assignJobs(txn, jobs, now, ControllerQueue.queueOverdueTimeout)
+            works = []
+            for job in jobs:
+                self.assertEqual(job.isAssigned, 1)
+                work = yield job.workItem()
+                works.append(work.a)
+            returnValue(works)
+
+        works = yield inTransaction(dbpool.connection, _claim, limit=2)
+        self.assertEqual(works, [2, 3])
+        works = yield inTransaction(dbpool.connection, _claim, limit=2)
+        self.assertEqual(works, [1])
+        works = yield inTransaction(dbpool.connection, _claim, limit=2)
+        self.assertEqual(works, [])
+
+        jobs = yield inTransaction(dbpool.connection, JobItem.all)
+        self.assertEqual(sorted(job.isAssigned for job in jobs), [0, 1, 1, 1])
+
+    @inlineCallbacks
+    def test_nextjobExcludeTypes(self):
+        """
+        L{JobItem.nextjob} and L{JobItem.nextjobs} skip jobs of the excluded
+        work types, and L{JobItem.inFlight} counts assigned jobs by work type.
+        """
+        dbpool = buildConnectionPool(self, jobSchema + schemaText)
+        now = datetime.datetime.utcnow()
+        past = now + datetime.timedelta(days=-1)
+        yield self._enqueue(dbpool, 1, 1, past, priority=WORK_PRIORITY_HIGH)
+        yield self._enqueue(dbpool, 2, 1, past, cl=DummyWorkPauseItem)
+        excluded = [DummyWorkItem.workType()]
+
+        @inlineCallbacks
+        def _claim(txn):
+            job = yield JobItem.nextjob(txn, now, WORK_PRIORITY_LOW, 1, excluded)
+            jobs = yield JobItem.nextjobs(txn, now, WORK_PRIORITY_LOW, 5, excluded)
+            self.assertEqual([job.jobID], [each.jobID for each in jobs])
+            yield job.assign(now, ControllerQueue.queueOverdueTimeout)
+            returnValue(job)
+
+        job = yield inTransaction(dbpool.connection, _claim)
+        self.assertEqual(job.workType, DummyWorkPauseItem.workType())
+
+        inFlight = yield inTransaction(
+            dbpool.connection, JobItem.inFlight,
+            workTypes=[DummyWorkItem.workType(), DummyWorkPauseItem.workType()],
+        )
+        self.assertEqual(inFlight, {DummyWorkPauseItem.workType(): 1})
+
+    @inlineCallbacks
+    def test_parking(self):
+        """
+        When L{JobItem.parkingHorizon} is set, jobs which are paused or not due
+        within it are parked, so that L{JobItem.nextjobs} does not see them,
+        until L{JobItem.promoteParked} or L{JobItem.pauseIt} unparks them.
+        """
+        self.patch(JobItem, "parkingHorizon", 60)
+        dbpool = buildConnectionPool(self, jobSchema + schemaText)
+        now = datetime.datetime.utcnow()
+        later = now + datetime.timedelta(days=1)
+
+        @inlineCallbacks
+        def setup(txn):
+            yield DummyWorkItem.makeJob(txn, jobID=1, workID=1, a=1, b=0, notBefore=now)
+            yield DummyWorkItem.makeJob(txn, jobID=2, workID=2, a=2, b=0, notBefore=later)
+            yield DummyWorkItem.makeJob(txn, jobID=3, workID=3, a=3, b=0, notBefore=now, pause=1)
+        yield inTransaction(dbpool.connection, setup)
+
+        @inlineCallbacks
+        def states(txn):
+            jobs = yield JobItem.all(txn)
+            returnValue(dict((job.jobID, job.isAssigned) for job in jobs))
+
+        results = yield inTransaction(dbpool.connection, states)
+        self.assertEqual(results, {1: 0, 2: JOB_PARKED, 3: JOB_PARKED})
+
+        jobs = yield inTransaction(
+            dbpool.connection,
+            lambda txn: JobItem.nextjobs(txn, later, WORK_PRIORITY_LOW, 10)
+        )
+        self.assertEqual([job.jobID for job in jobs], [1])
+
+        promoted = yield inTransaction(dbpool.connection, JobItem.promoteParked, until=later)
+        self.assertEqual(promoted, [2])
+        results = yield inTransaction(dbpool.connection, states)
+        self.assertEqual(results, {1: 0, 2: 0, 3: JOB_PARKED})
+
+        @inlineCallbacks
+        def unpause(txn):
+            job = yield JobItem.load(txn, 3)
+            yield job.pauseIt(False)
+        yield inTransaction(dbpool.connection, unpause)
+        results = yield inTransaction(dbpool.connection, states)
+        self.assertEqual(results, {1: 0, 2: 0, 3: 0})
+
+    def test_nextjobOracleExcludedTypes(self):
+        """
+        On Oracle, L{JobItem.nextjob} uses the C{next_job} stored procedure
+        when no work types are excluded, and otherwise a query which skips the
+        excluded types, so that jobs of other types are still found.
+        """
+        now = datetime.datetime(2012, 12, 12, 12, 12, 12)
+        txn = CatchSQL(DatabaseType(ORACLE_DIALECT, "numeric"))
+        txn.nextResult([[None]])
+        job = self.successResultOf(JobItem.nextjob(txn, now, WORK_PRIORITY_LOW, 10))
+        self.assertIdentical(job, None)
+        self.assertTrue(txn.execed[0][0].startswith("call next_job"))
+
+        txn = CatchSQL(DatabaseType(ORACLE_DIALECT, "numeric"))
+        txn.nextResult([])
+        job = self.successResultOf(
+            JobItem.nextjob(txn, now, WORK_PRIORITY_LOW, 10, ["LIMITED"])
+        )
+        self.assertIdentical(job, None)
+        [[sql, args]] = txn.execed
+        self.assertIn("WORK_TYPE not in", sql)
+        self.assertIn("LIMITED", args)
+
+    @inlineCallbacks
+    def test_unassignJobs(self):
+        """
+        L{JobItem.unassignJobs} unassigns several assigned jobs at once, and
+        L{JobItem.overduejob} skips the jobs it is told to exclude.
+        """
+        dbpool = buildConnectionPool(self, jobSchema + schemaText)
+        now = datetime.datetime.utcnow()
+
+        @inlineCallbacks
+        def setup(txn):
+            for i in range(1, 4):
+                yield DummyWorkItem.makeJob(txn, jobID=i, workID=i, a=i, b=0, notBefore=now)
+            jobs = yield JobItem.all(txn)
+            yield JobItem.assignJobs(txn, jobs, now, -60)
+        yield inTransaction(dbpool.connection, setup)
+
+        job = yield inTransaction(
+            dbpool.connection,
+            lambda txn: JobItem.overduejob(txn, now, 10, excludeJobIDs=[1, 2])
+        )
+        self.assertEqual(job.jobID, 3)
+
+        yield inTransaction(dbpool.connection, JobItem.unassignJobs, jobIDs=[1, 2, 4])
+
+        @inlineCallbacks
+        def states(txn):
+            jobs = yield JobItem.all(txn)
+            returnValue(dict((job.jobID, (job.isAssigned, job.overdue is None)) for job in jobs))
+
+        results = yield inTransaction(dbpool.connection, states)
+        self.assertEqual(results, {1: (0, True), 2: (0, True), 3: (1, False)})
+
+    @inlineCallbacks
+    def test_dedup(self):
+        """
+        L{WorkItem.makeJob} coalesces a work item with a queued, unassigned one
+        with the same C{dedupAttributes}, returning the queued one.
+        """
+        self.patch(DummyWorkItem, "dedupAttributes", ("a",))
+        dbpool = buildConnectionPool(self, jobSchema + schemaText)
+        now = datetime.datetime.utcnow()
+
+        def makeJob(txn, **kwargs):
+            return DummyWorkItem.makeJob(txn, notBefore=now, **kwargs)
+
+        first = yield inTransaction(dbpool.connection, makeJob, a=1, b=2)
+        second = yield inTransaction(dbpool.connection, makeJob, a=1, b=3)
+        other = yield inTransaction(dbpool.connection, makeJob, a=2, b=3)
+        self.assertEqual(second.jobID, first.jobID)
+        self.assertEqual(second.b, 2)
+        self.assertNotEqual(other.jobID, first.jobID)
+        jobs = yield inTransaction(dbpool.connection, JobItem.all)
+        self.assertEqual(len(jobs), 2)
+
+        # Once assigned, a job no longer absorbs duplicates
+        @inlineCallbacks
+        def assignJob(txn):
+            job = yield JobItem.load(txn, first.jobID)
+            yield job.assign(now, ControllerQueue.queueOverdueTimeout)
+        yield inTransaction(dbpool.connection, assignJob)
+        third = yield inTransaction(dbpool.connection, makeJob, a=1, b=4)
+        self.assertNotEqual(third.jobID, first.jobID)
+
+    @inlineCallbacks
+    def test_dedupPushNotBefore(self):
+        """
+        With C{dedupPushNotBefore} set, coalescing a work item moves the queued
+        job's C{notBefore} later, but never earlier.
+        """
+        self.patch(DummyWorkItem, "dedupAttributes", ("a",))
+        self.patch(DummyWorkItem, "dedupPushNotBefore", True)
+        dbpool = buildConnectionPool(self, jobSchema + schemaText)
+        now = datetime.datetime(2012, 12, 12, 12, 12, 12)
+        later = now + datetime.timedelta(seconds=10)
+
+        def makeJob(txn, notBefore):
+            return DummyWorkItem.makeJob(txn, a=1, b=2, notBefore=notBefore)
+
+        first = yield inTransaction(dbpool.connection, makeJob, notBefore=now)
+        yield inTransaction(dbpool.connection, makeJob, notBefore=later)
+        yield inTransaction(dbpool.connection, makeJob, notBefore=now)
+        jobs = yield inTransaction(dbpool.connection, JobItem.all)
+        self.assertEqual([job.jobID for job in jobs], [first.jobID])
+        self.assertEqual([job.notBefore for job in jobs], [later])
+
+    @inlineCallbacks
+    def test_dedupRace(self):
+        """
+        If a duplicate job is created by another transaction after
+        L{WorkItem.makeJob} looks for one, the unique index on C{DEDUP_KEY}
+        rejects the new job and the duplicate is used instead.
+        """
+        self.patch(DummyWorkItem, "dedupAttributes", ("a",))
+        dbpool = buildConnectionPool(self, jobSchema + schemaText)
+        now = datetime.datetime.utcnow()
+        first = yield inTransaction(
+            dbpool.connection, DummyWorkItem.makeJob, a=1, b=2, notBefore=now
+        )
+
+        realCoalesce = DummyWorkItem._coalesce.im_func
+        missed = []
+
+        def coalesce(cls, transaction, dedupKey, notBefore):
+            if not missed:
+                missed.append(True)
+                return succeed(None)
+            return realCoalesce(cls, transaction, dedupKey, notBefore)
+        self.patch(DummyWorkItem, "_coalesce", classmethod(coalesce))
+
+        second = yield inTransaction(
+            dbpool.connection, DummyWorkItem.makeJob, a=1, b=3, notBefore=now
+        )
+        self.assertEqual(missed, [True])
+        self.assertEqual(second.jobID, first.jobID)
+        jobs = yield inTransaction(dbpool.connection, JobItem.all)
+        self.assertEqual(len(jobs), 1)
+
     @inlineCallbacks
     def test_notsingleton(self):
         """
@@ -756,6 +1029,206 @@ class WorkItemTests(TestCase):
             {"priority": WORK_PRIORITY_MEDIUM, "weight": WORK_WEIGHT_5},
         )
 
+    def test_updateWorkTypeLimits(self):
+        """
+        L{workItem.updateWorkTypes} sets and removes the concurrency and rate
+        limits of work types, ignoring invalid values, and
+        L{workItem.dumpWorkTypes} includes the limits that are set.
+        """
+        buildConnectionPool(self, jobSchema + schemaText)
+        self.patch(UpdateWorkItem, "maxInFlight", None)
+        self.patch(UpdateWorkItem, "rateLimit", None)
+        self.patch(UpdateWorkItem, "maxAttempts", None)
+        self.patch(UpdateWorkItem, "retryBackoff", None)
+
+        WorkItem.updateWorkTypes({
+            "UPDATE_WORK_ITEM": {
+                "maxInFlight": "4",
+                "rateLimit": 50,
+                "maxAttempts": 5,
+                "retryBackoff": "2",
+            },
+        })
+        self.assertEqual(UpdateWorkItem.maxInFlight, 4)
+        self.assertEqual(UpdateWorkItem.rateLimit, 50.0)
+        self.assertEqual(UpdateWorkItem.maxAttempts, 5)
+        self.assertEqual(UpdateWorkItem.retryBackoff, 2.0)
+        self.assertEqual(
+            WorkItem.dumpWorkTypes()["UPDATE_WORK_ITEM"],
+            {"priority": WORK_PRIORITY_MEDIUM, "weight": WORK_WEIGHT_5,
+             "maxInFlight": 4, "rateLimit": 50.0, "maxAttempts": 5,
+             "retryBackoff": 2.0},
+        )
+
+        WorkItem.updateWorkTypes({
+            "UPDATE_WORK_ITEM": {
+                "maxInFlight": -1,
+                "rateLimit": None,
+                "maxAttempts": None,
+                "retryBackoff": None,
+            },
+        })
+        self.assertEqual(UpdateWorkItem.maxInFlight, 4)
+        self.assertEqual(UpdateWorkItem.rateLimit, None)
+        self.assertEqual(UpdateWorkItem.maxAttempts, None)
+        self.assertEqual(UpdateWorkItem.retryBackoff, None)
+        self.assertEqual(
+            WorkItem.dumpWorkTypes()["UPDATE_WORK_ITEM"],
+            {"priority": WORK_PRIORITY_MEDIUM, "weight": WORK_WEIGHT_5,
+             "maxInFlight": 4},
+        )
+
+    @inlineCallbacks
+    def test_retryDelay(self):
+        """
+        L{JobItem.retryDelay} grows linearly with the number of failures by
+        default, and exponentially, up to a maximum and with jitter, when the
+        work type sets C{retryBackoff}.
+        """
+        dbpool = buildConnectionPool(self, jobSchema + schemaText)
+        yield self._enqueue(dbpool, 1, 2)
+
+        @inlineCallbacks
+        def delays(txn, failed):
+            job = (yield JobItem.all(txn))[0]
+            yield job.update(failed=failed)
+            returnValue([job.retryDelay(60, DummyWorkItem) for _ignore in range(20)])
+
+        results = yield inTransaction(dbpool.connection, delays, failed=3)
+        self.assertEqual(set(results), set([240]))
+
+        self.patch(DummyWorkItem, "retryBackoff", 2.0)
+        self.patch(DummyWorkItem, "retryMaxDelay", 1000)
+        results = yield inTransaction(dbpool.connection, delays, failed=3)
+        self.assertEqual(set(results), set([480]))
+        results = yield inTransaction(dbpool.connection, delays, failed=5)
+        self.assertEqual(set(results), set([1000]))
+
+        self.patch(DummyWorkItem, "retryJitter", 0.5)
+        results = yield inTransaction(dbpool.connection, delays, failed=3)
+        self.assertTrue(all(240 <= delay <= 720 for delay in results))
+        self.assertTrue(len(set(results)) > 1)
+
+    @inlineCallbacks
+    def test_deadLetter(self):
+        """
+        Once a job has failed C{maxAttempts} times, L{JobItem.failedToRun}
+        moves it and its work item to the dead-letter table, from which it can
+        be listed, requeued and purged.
+        """
+        self.patch(DummyWorkItem, "maxAttempts", 2)
+        dbpool = buildConnectionPool(self, jobSchema + schemaText)
+        yield self._enqueue(dbpool, 1, 2)
+        # A bystander keeps a higher job ID in use, so that SQLite cannot give
+        # a requeued job the ID of the job it replaces
+        yield self._enqueue(dbpool, 3, 4)
+
+        @inlineCallbacks
+        def fail(txn, jobID):
+            job = yield JobItem.load(txn, jobID)
+            yield job.failedToRun()
+
+        @inlineCallbacks
+        def check(txn):
+            jobs = yield JobItem.all(txn)
+            works = yield DummyWorkItem.all(txn)
+            dead = yield JobItem.deadJobs(txn)
+            returnValue((
+                dict((job.jobID, job) for job in jobs),
+                dict(((work.a, work.b), work) for work in works),
+                dead,
+            ))
+
+        jobs, works, dead = yield inTransaction(dbpool.connection, check)
+        jobID = works[(1, 2)].jobID
+        bystanderID = works[(3, 4)].jobID
+
+        # The first failure is retried
+        yield inTransaction(dbpool.connection, fail, jobID=jobID)
+        jobs, works, dead = yield inTransaction(dbpool.connection, check)
+        self.assertEqual(sorted(jobs), sorted([jobID, bystanderID]))
+        self.assertEqual(jobs[jobID].failed, 1)
+        self.assertEqual(sorted(works), [(1, 2), (3, 4)])
+        self.assertEqual(dead, [])
+
+        # The second is not
+        yield inTransaction(dbpool.connection, fail, jobID=jobID)
+        jobs, works, dead = yield inTransaction(dbpool.connection, check)
+        self.assertEqual(sorted(jobs), [bystanderID])
+        self.assertEqual(sorted(works), [(3, 4)])
+        self.assertEqual(len(dead), 1)
+        self.assertEqual(dead[0].jobID, jobID)
+        self.assertEqual(dead[0].workType, "DUMMY_WORK_ITEM")
+        self.assertEqual(dead[0].failed, 2)
+        deadJobs = yield inTransaction(dbpool.connection, JobItem.deadJobs, workTypes=["UPDATE_WORK_ITEM"])
+        self.assertEqual(deadJobs, [])
+
+        # Requeuing makes a new job, with a new work item
+        requeued = yield inTransaction(dbpool.connection, JobItem.requeueDeadJobs, jobIDs=[jobID])
+        self.assertEqual(len(requeued), 1)
+        jobs, works, dead = yield inTransaction(dbpool.connection, check)
+        newJobID = works[(1, 2)].jobID
+        self.assertEqual(requeued[0].jobID, newJobID)
+        self.assertNotIn(newJobID, (jobID, bystanderID))
+        self.assertEqual(sorted(jobs), sorted([newJobID, bystanderID]))
+        self.assertEqual(jobs[newJobID].failed, 0)
+        self.assertEqual(dead, [])
+
+        # Purging removes dead jobs for good
+        yield inTransaction(dbpool.connection, fail, jobID=newJobID)
+        yield inTransaction(dbpool.connection, fail, jobID=newJobID)
+        purged = yield inTransaction(dbpool.connection, JobItem.purgeDeadJobs)
+        self.assertEqual(purged, [newJobID])
+        jobs, works, dead = yield inTransaction(dbpool.connection, check)
+        self.assertEqual((sorted(jobs), sorted(works), dead), ([bystanderID], [(3, 4)], []))
+
+    @inlineCallbacks
+    def test_deadLetterNonASCII(self):
+        """
+        A work item whose serialized form has C{str} values which are not
+        UTF-8 is moved to the dead-letter table, and is given back exactly as
+        it was serialized when it is requeued.
+        """
+        self.patch(DummyWorkItem, "maxAttempts", 1)
+        dbpool = buildConnectionPool(self, jobSchema + schemaText)
+        yield self._enqueue(dbpool, 1, 2)
+
+        serialize = DummyWorkItem.serialize.im_func
+        deserialize = DummyWorkItem.deserialize.im_func
+        received = []
+
+        def serializeWithNote(self):
+            result = serialize(self)
+            result["note"] = "caf\xe9"
+            return result
+
+        def deserializeWithNote(cls, attrmap):
+            received.append(attrmap)
+            attrmap = dict(attrmap)
+            del attrmap["note"]
+            return deserialize(cls, attrmap)
+
+        self.patch(DummyWorkItem, "serialize", serializeWithNote)
+        self.patch(DummyWorkItem, "deserialize", classmethod(deserializeWithNote))
+
+        @inlineCallbacks
+        def fail(txn):
+            [job] = yield JobItem.all(txn)
+            yield job.failedToRun()
+
+        yield inTransaction(dbpool.connection, fail)
+        dead = yield inTransaction(dbpool.connection, JobItem.deadJobs)
+        self.assertEqual(len(dead), 1)
+
+        requeued = yield inTransaction(
+            dbpool.connection, JobItem.requeueDeadJobs, jobIDs=[dead[0].jobID]
+        )
+        self.assertEqual(len(requeued), 1)
+        self.assertEqual((requeued[0].a, requeued[0].b), (1, 2))
+        [attrmap] = received
+        self.assertEqual(attrmap["note"], "caf\xe9")
+        self.assertIsInstance(attrmap["note"], str)
+
     def test_dumpWorkTypes(self):
         """
         L{workItem.dumpWorkTypes} dumps weight and priority correctly.
@@ -809,6 +1282,145 @@ class WorkItemTests(TestCase):
         )
 
 
+class JobNotificationTests(TestCase):
+    """
+    Committing a transaction which creates jobs notifies job listeners.
+    """
+
+    def setUp(self):
+        self.notified = []
+        localJobNotifier.addListener(self.listener)
+        self.addCleanup(localJobNotifier.removeListener, self.listener)
+        self.paused = False
+
+    def listener(self, jobs=None):
+        self.notified.append(True if jobs is None else jobs)
+
+    @inlineCallbacks
+    def test_notifyOnCommit(self):
+        """
+        L{WorkItem.makeJob} notifies local listeners once, with all the jobs
+        created, when its transaction commits.
+        """
+        dbpool = buildConnectionPool(self, jobSchema + schemaText)
+        txn = dbpool.connection()
+        work1 = yield DummyWorkItem.makeJob(txn, a=1, b=2)
+        work2 = yield DummyWorkItem.makeJob(txn, a=3, b=4)
+        self.assertEqual(self.notified, [])
+        yield txn.commit()
+        self.assertEqual(self.notified, [[work1.job, work2.job]])
+
+    @inlineCallbacks
+    def test_noNotifyOnAbort(self):
+        """
+        Aborting a transaction which created a job does not notify listeners.
+        """
+        dbpool = buildConnectionPool(self, jobSchema + schemaText)
+        txn = dbpool.connection()
+        yield DummyWorkItem.makeJob(txn, a=1, b=2)
+        yield txn.abort()
+        self.assertEqual(self.notified, [])
+
+    def test_postgresNotify(self):
+        """
+        On PostgreSQL, L{notifyNewJob} issues one C{NOTIFY} per transaction.
+        """
+        helper = ConnectionPoolHelper()
+        helper.setUp(self)
+        txn = helper.createTransaction()
+        notifyNewJob(txn, 1)
+        notifyNewJob(txn, 2)
+        resultOf(txn.commit())
+        executions = [
+            sql
+            for cursor in helper.factory.connections[0].cursors
+            for sql, _ignore_args in cursor.allExecutions
+        ]
+        self.assertEqual(executions, ["notify {}".format(JOB_CHANNEL)])
+        self.assertEqual(self.notified, [[1, 2]])
+
+    def _listener(self, notifications):
+        """
+        Create and start a L{JobListener} whose connection receives the given
+        numbers of notifications on successive waits.  Its thread does nothing
+        until L{JobNotificationTests.step} is called.
+        """
+        self.clock = Clock()
+        self.helper = ConnectionPoolHelper()
+        self.helper.setUp(self)
+        self.holders = []
+        listener = JobListener(
+            self.clock, self.helper.factory.connect, self.listener
+        )
+
+        def createHolder():
+            holder = FakeThreadHolder(self)
+            self.holders.append(holder)
+            return holder
+        listener._createHolder = createHolder
+
+        def waitForNotifications(connection, timeout):
+            result = notifications.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+        listener.waitForNotifications = waitForNotifications
+        self.paused = True
+        listener.startService()
+        return listener
+
+    def step(self, delay=0):
+        """
+        Advance the clock and run the work submitted to the listening thread.
+        """
+        self.clock.advance(delay)
+        self.holders[0].flush()
+
+    def test_listener(self):
+        """
+        L{JobListener} issues C{LISTEN} on a dedicated connection, and calls
+        its callback each time notifications are received.
+        """
+        listener = self._listener([0, 2, 0, 1])
+        self.step()
+        connection = self.helper.factory.connections[-1]
+        self.assertEqual(
+            connection.cursors[0].allExecutions,
+            [("listen {}".format(JOB_CHANNEL), ())]
+        )
+        self.step()
+        self.assertEqual(self.notified, [])
+        self.step()
+        self.assertEqual(self.notified, [True])
+        self.step()
+        self.step()
+        self.assertEqual(self.notified, [True, True])
+        listener.stopService()
+        self.holders[0].flush()
+        self.assertTrue(connection.closed)
+        self.assertTrue(self.holders[0].stopped)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_listenerReconnects(self):
+        """
+        If waiting for notifications fails, L{JobListener} closes its
+        connection and listens on a new one after a delay.
+        """
+        listener = self._listener([ZeroDivisionError(), 1])
+        self.step()
+        first = self.helper.factory.connections[-1]
+        self.step()
+        self.assertEqual(len(self.flushLoggedErrors(ZeroDivisionError)), 1)
+        self.assertTrue(first.closed)
+        self.step(listener.reconnectDelay)
+        second = self.helper.factory.connections[-1]
+        self.assertNotIdentical(first, second)
+        self.step()
+        self.assertEqual(self.notified, [True])
+        listener.stopService()
+        self.holders[0].flush()
+
+
 class WorkerConnectionPoolTests(TestCase):
     """
     A L{WorkerConnectionPool} is responsible for managing, in a node's
@@ -816,6 +1428,231 @@ class WorkerConnectionPoolTests(TestCase):
     that are capable of executing queue work.
     """
 
+    class FakeWorker(object):
+        def __init__(self, currentLoad=0):
+            self.currentLoad = currentLoad
+
+    def setUp(self):
+        self.clock = Clock()
+        self.pool = WorkerConnectionPool(maximumLoadPerWorker=10, reactor=self.clock)
+        self.workers = [self.FakeWorker() for _ignore in range(3)]
+        for worker in self.workers:
+            self.pool.addWorker(worker)
+
+    def setLoad(self, worker, load):
+        worker.currentLoad = load
+        self.pool.workerLoadChanged(worker)
+
+    def test_aggregateLoad(self):
+        """
+        L{WorkerConnectionPool.allWorkerLoad},
+        L{WorkerConnectionPool.loadLevel},
+        L{WorkerConnectionPool.availableCapacity} and
+        L{WorkerConnectionPool.hasAvailableCapacity} track the load of the
+        workers as it changes.
+        """
+        self.assertEqual(self.pool.allWorkerLoad(), 0)
+        self.assertEqual(self.pool.availableCapacity(), 30)
+        self.setLoad(self.workers[0], 10)
+        self.setLoad(self.workers[1], 12)
+        self.setLoad(self.workers[2], 5)
+        self.assertEqual(self.pool.allWorkerLoad(), 27)
+        self.assertEqual(self.pool.loadLevel(), 90)
+        self.assertEqual(self.pool.availableCapacity(), 5)
+        self.assertTrue(self.pool.hasAvailableCapacity())
+        self.setLoad(self.workers[2], 10)
+        self.assertFalse(self.pool.hasAvailableCapacity())
+        self.pool.removeWorker(self.workers[1])
+        self.assertEqual(self.pool.allWorkerLoad(), 20)
+        self.assertEqual(self.pool.loadLevel(), 100)
+        self.setLoad(self.workers[0], 0)
+        self.assertEqual(self.pool.availableCapacity(), 10)
+        self.assertTrue(self.pool.hasAvailableCapacity())
+
+    def test_selectLowestLoadWorker(self):
+        """
+        L{WorkerConnectionPool._selectLowestLoadWorker} selects the worker with
+        the lowest load, preferring the one whose load changed least recently
+        when several have the lowest load.
+        """
+        self.setLoad(self.workers[0], 3)
+        self.assertIdentical(
+            self.pool._selectLowestLoadWorker(), self.workers[1]
+        )
+        self.setLoad(self.workers[1], 1)
+        self.setLoad(self.workers[2], 1)
+        self.setLoad(self.workers[1], 1)
+        self.assertIdentical(
+            self.pool._selectLowestLoadWorker(), self.workers[2]
+        )
+        self.pool.removeWorker(self.workers[2])
+        self.assertIdentical(
+            self.pool._selectLowestLoadWorker(), self.workers[1]
+        )
+
+    def test_bestFit(self):
+        """
+        L{WorkerConnectionPool._selectWorkerFor} selects the most loaded
+        worker with room for a job's weight when
+        L{WorkerConnectionPool.bestFit} is set, and the least loaded worker
+        with room otherwise.
+        """
+        self.setLoad(self.workers[0], 8)
+        self.setLoad(self.workers[1], 5)
+        self.assertIdentical(self.pool._selectWorkerFor(2), self.workers[0])
+        self.assertIdentical(self.pool._selectWorkerFor(3), self.workers[1])
+        self.assertIdentical(self.pool._selectWorkerFor(6), self.workers[2])
+        self.assertIdentical(self.pool._selectWorkerFor(20), self.workers[2])
+        self.pool.bestFit = False
+        self.assertIdentical(self.pool._selectWorkerFor(2), self.workers[2])
+        self.setLoad(self.workers[2], 9)
+        self.assertIdentical(self.pool._selectWorkerFor(5), self.workers[1])
+        self.assertIdentical(self.pool._selectWorkerFor(6), None)
+
+    def test_holdUntilRoom(self):
+        """
+        L{WorkerConnectionPool.performJob} holds a job which no worker has room
+        for, without holding up lighter jobs, and dispatches it once a worker
+        has room.
+        """
+        performed = []
+
+        class Worker(self.FakeWorker):
+            def performJob(worker, job):
+                performed.append((worker, job.jobID))
+                worker.currentLoad += job.weight
+                self.pool.workerLoadChanged(worker)
+                return succeed({})
+
+        workers = [Worker(6), Worker(7)]
+        self.pool = WorkerConnectionPool(maximumLoadPerWorker=10, reactor=self.clock)
+        for worker in workers:
+            self.pool.addWorker(worker)
+
+        done = []
+        self.pool.performJob(JobDescriptor(1, 10, "ABC")).addCallback(done.append)
+        self.pool.performJob(JobDescriptor(2, 3, "ABC")).addCallback(done.append)
+        self.assertEqual(performed, [(workers[1], 2)])
+        self.assertEqual(done, [{}])
+        self.assertEqual(self.pool.availableCapacity(), 0)
+        self.assertEqual(
+            self.pool.fragmentation(),
+            {"spare": 4, "largestSpare": 4, "fragmentation": 0.0,
+             "held": 1, "heldWeight": 10}
+        )
+
+        workers[0].currentLoad = 0
+        self.pool.workerLoadChanged(workers[0])
+        self.assertEqual(performed, [(workers[1], 2), (workers[0], 1)])
+        self.assertEqual(done, [{}, {}])
+        self.assertEqual(self.pool.fragmentation()["held"], 0)
+
+    def test_heldJobNotStarved(self):
+        """
+        A held job is not kept waiting forever by a steady stream of lighter
+        jobs: once it has been held for
+        L{WorkerConnectionPool.maximumHoldTime}, later jobs are held behind it
+        until a worker has room for it, and are then dispatched too.
+        """
+        running = []
+        performed = []
+
+        class Worker(self.FakeWorker):
+            def performJob(worker, job):
+                performed.append(job.jobID)
+                worker.currentLoad += job.weight
+                self.pool.workerLoadChanged(worker)
+                d = Deferred()
+                running.append((worker, job, d))
+                return d
+
+        def finishOldest():
+            worker, job, d = running.pop(0)
+            worker.currentLoad -= job.weight
+            self.pool.workerLoadChanged(worker)
+            d.callback({})
+
+        self.pool = WorkerConnectionPool(maximumLoadPerWorker=10, reactor=self.clock)
+        self.pool.bestFit = False
+        for worker in (Worker(), Worker()):
+            self.pool.addWorker(worker)
+        jobIDs = count(1)
+        for _ignore in range(4):
+            self.pool.performJob(JobDescriptor(jobIDs.next(), 2, "ABC"))
+        self.pool.performJob(JobDescriptor(0, 10, "ABC"))
+        self.assertEqual(self.pool.heldJobIDs(), set([0]))
+
+        # Each second, one light job finishes and another arrives, so no
+        # worker is ever idle unless new jobs are held.
+        for _ignore in range(int(self.pool.maximumHoldTime) + 10):
+            if 0 in performed:
+                break
+            self.clock.advance(1)
+            finishOldest()
+            self.pool.performJob(JobDescriptor(jobIDs.next(), 2, "ABC"))
+        self.assertIn(0, performed)
+        self.assertEqual(self.pool.heldJobIDs(), set())
+
+        # Jobs held behind the heavy one were dispatched along with it
+        lastID = jobIDs.next() - 1
+        self.assertEqual(sorted(performed), range(lastID + 1))
+
+    def test_heldDroppedWithLastWorker(self):
+        """
+        When the last worker is removed, L{WorkerConnectionPool.removeWorker}
+        fails the jobs being held with L{CancelledError} and returns their IDs.
+        """
+        for worker in self.workers:
+            self.setLoad(worker, 10)
+        failures = []
+        self.pool.performJob(JobDescriptor(1, 5, "ABC")).addErrback(failures.append)
+        self.pool.performJobs(
+            [JobDescriptor(2, 5, "ABC"), JobDescriptor(3, 5, "ABC")]
+        ).addErrback(failures.append)
+        self.assertEqual(self.pool.fragmentation()["heldWeight"], 10)
+
+        self.assertEqual(self.pool.removeWorker(self.workers[0]), [])
+        self.assertEqual(self.pool.removeWorker(self.workers[1]), [])
+        self.assertEqual(failures, [])
+        self.assertEqual(self.pool.removeWorker(self.workers[2]), [1, 2, 3])
+        self.assertEqual(len(failures), 2)
+        for failure in failures:
+            failure.trap(CancelledError)
+        self.assertEqual(
+            self.pool.fragmentation(),
+            {"spare": 0, "largestSpare": 0, "fragmentation": 0.0,
+             "held": 0, "heldWeight": 0}
+        )
+
+    def test_fragmentation(self):
+        """
+        L{WorkerConnectionPool.fragmentation} reports the fraction of spare
+        capacity which is not available to a single job.
+        """
+        self.setLoad(self.workers[0], 10)
+        self.setLoad(self.workers[1], 6)
+        self.setLoad(self.workers[2], 6)
+        self.assertEqual(
+            self.pool.fragmentation(),
+            {"spare": 8, "largestSpare": 4, "fragmentation": 0.5,
+             "held": 0, "heldWeight": 0}
+        )
+
+    def test_staleEntriesDiscarded(self):
+        """
+        Frequent load changes do not grow the heap of workers without bound,
+        and changes to workers that have been removed are ignored.
+        """
+        for load in range(100):
+            self.setLoad(self.workers[load % 3], load)
+        self.assertTrue(len(self.pool._heap) <= 2 * len(self.workers) + 16)
+        self.pool.removeWorker(self.workers[0])
+        self.setLoad(self.workers[0], 1)
+        self.assertEqual(self.pool.allWorkerLoad(), 97 + 98)
+        self.assertIdentical(
+            self.pool._selectLowestLoadWorker(), self.workers[1]
+        )
+
 
 class ControllerQueueUnitTests(TestCase):
     """
@@ -946,6 +1783,381 @@ class ControllerQueueUnitTests(TestCase):
         # Work item complete
         self.assertTrue(DummyWorkItem.results == {1: 3, 2: 7})
 
+    @inlineCallbacks
+    def test_batchClaim(self):
+        """
+        When L{ControllerQueue.batchClaimSize} is greater than 1,
+        L{ControllerQueue._workCheck} assigns all the due jobs in one batch,
+        and performs them all.
+        """
+        self.patch(ControllerQueue, "batchClaimSize", 10)
+        batches = []
+        realAssignJobs = JobItem.assignJobs
+
+        def assignJobs(txn, jobs, when, overdue):
+            batches.append(len(jobs))
+            return realAssignJobs(txn, jobs, when, overdue)
+        self.patch(JobItem, "assignJobs", staticmethod(assignJobs))
+
+        dbpool, _ignore_qpool, clock, _ignore_performerChosen = self._setupPools()
+        fakeNow = datetime.datetime(2012, 12, 12, 12, 12, 12)
+
+        @transactionally(dbpool.pool.connection)
+        @inlineCallbacks
+        def setup(txn):
+            for a in range(3):
+                yield DummyWorkItem.makeJob(
+                    txn, a=a, b=1, notBefore=fakeNow - datetime.timedelta(seconds=20)
+                )
+        yield setup
+
+        while len(DummyWorkItem.results) != 3:
+            clock.advance(1)
+
+        self.assertEqual(DummyWorkItem.results, {1: 1, 2: 2, 3: 3})
+        self.assertEqual([batch for batch in batches if batch], [3])
+
+    @inlineCallbacks
+    def test_batchPerform(self):
+        """
+        When a L{WorkItem} type is C{batchable}, L{ControllerQueue._workCheck}
+        performs the jobs of that type it claims together in one transaction,
+        and a job which fails is rolled back and rescheduled without affecting
+        the others.
+        """
+        self.patch(ControllerQueue, "batchClaimSize", 10)
+        self.patch(DummyWorkItem, "batchable", True)
+        batches = []
+        realPerformBatch = JobItem.ultimatelyPerformBatch
+
+        def ultimatelyPerformBatch(txnFactory, jobDescriptors):
+            batches.append([job.jobID for job in jobDescriptors])
+            return realPerformBatch(txnFactory, jobDescriptors)
+        self.patch(JobItem, "ultimatelyPerformBatch", staticmethod(ultimatelyPerformBatch))
+
+        dbpool, _ignore_qpool, clock, _ignore_performerChosen = self._setupPools()
+        fakeNow = datetime.datetime(2012, 12, 12, 12, 12, 12)
+
+        @transactionally(dbpool.pool.connection)
+        @inlineCallbacks
+        def setup(txn):
+            # OK, failure, OK, temporary failure
+            for a in (1, -1, 2, -2):
+                yield DummyWorkItem.makeJob(
+                    txn, a=a, b=0, notBefore=fakeNow - datetime.timedelta(seconds=20)
+                )
+        yield setup
+        clock.advance(20 - 12)
+
+        self.assertEqual(batches, [[1, 2, 3, 4]])
+        self.assertEqual(DummyWorkItem.results, {1: 1, 3: 2})
+
+        @transactionally(dbpool.pool.connection)
+        @inlineCallbacks
+        def check(txn):
+            jobs = yield JobItem.all(txn)
+            works = yield DummyWorkItem.all(txn)
+            returnValue((jobs, works))
+
+        jobs, works = yield check
+        self.assertEqual(sorted(job.jobID for job in jobs), [2, 4])
+        self.assertEqual(sorted(work.jobID for work in works), [2, 4])
+        for job in jobs:
+            self.assertEqual(job.isAssigned, 0)
+            self.assertEqual(job.failed, 1)
+            self.assertTrue(job.notBefore > datetime.datetime.utcnow())
+
+    @inlineCallbacks
+    def test_jobNotified(self):
+        """
+        When L{ControllerQueue.listenForJobs} has been called, committing a new
+        job triggers a work check straight away, even when polling has backed
+        off, and idle polling then backs off to the
+        C{queueNotifiedPollingBackoff} interval.
+        """
+        dbpool, qpool, clock, _ignore_performerChosen = self._setupPools()
+        qpool.listenForJobs()
+        qpool._timeOfLastWork = time.time() - 100
+        clock.advance(qpool.queuePollInterval)
+        self.assertEqual(
+            qpool._workCheckCall.getTime() - clock.seconds(),
+            qpool.queueNotifiedPollingBackoff[0][1]
+        )
+
+        fakeNow = datetime.datetime(2012, 12, 12, 12, 12, 12)
+
+        @transactionally(dbpool.pool.connection)
+        def setup(txn):
+            return DummyWorkItem.makeJob(txn, a=1, b=2, notBefore=fakeNow)
+        yield setup
+        self.assertEqual(qpool._workCheckCall.getTime(), clock.seconds())
+
+        clock.advance(0)
+        self.assertEqual(DummyWorkItem.results, {1: 3})
+        yield qpool.stopService()
+
+    @inlineCallbacks
+    def test_claimWithinWorkTypeLimits(self):
+        """
+        L{ControllerQueue._claimJobs} claims no more jobs of a work type than
+        its C{maxInFlight} and C{rateLimit} limits allow.
+        """
+        reactor = MemoryReactorWithClock()
+        cph = SteppablePoolHelper(jobSchema + schemaText)
+        cph.setUp(self)
+        fakeNow = datetime.datetime(2012, 12, 12, 12, 12, 12)
+        reactor.advance(astimestamp(fakeNow))
+        qpool = ControllerQueue(reactor, cph.pool.connection, useWorkerPool=False)
+        self.patch(DummyWorkItem, "maxInFlight", 3)
+        self.patch(DummyWorkItem, "rateLimit", 2)
+
+        @transactionally(cph.pool.connection)
+        @inlineCallbacks
+        def setup(txn):
+            for a in range(5):
+                yield DummyWorkItem.makeJob(
+                    txn, a=a, b=1, notBefore=fakeNow - datetime.timedelta(seconds=20)
+                )
+            yield DummyWorkPauseItem.makeJob(
+                txn, a=10, b=1, notBefore=fakeNow - datetime.timedelta(seconds=20)
+            )
+        yield setup
+
+        def workTypes(jobs):
+            return sorted(job.workType for job in jobs)
+
+        jobs = yield qpool._claimJobs(fakeNow, WORK_PRIORITY_LOW, 10)
+        self.assertEqual(
+            workTypes(jobs),
+            ["DUMMY_WORK_ITEM", "DUMMY_WORK_ITEM", "DUMMY_WORK_PAUSE_ITEM"]
+        )
+
+        # Rate limited
+        jobs = yield qpool._claimJobs(fakeNow, WORK_PRIORITY_LOW, 10)
+        self.assertEqual(jobs, [])
+        reactor.advance(0.5)
+        jobs = yield qpool._claimJobs(fakeNow, WORK_PRIORITY_LOW, 10)
+        self.assertEqual(workTypes(jobs), ["DUMMY_WORK_ITEM"])
+
+        # Concurrency limited
+        reactor.advance(10)
+        jobs = yield qpool._claimJobs(fakeNow, WORK_PRIORITY_LOW, 10)
+        self.assertEqual(jobs, [])
+
+    @inlineCallbacks
+    def test_claimWithinCapacity(self):
+        """
+        L{ControllerQueue._claimJobs} claims no more weight of jobs than the
+        worker pool has room for, leaving the rest unassigned.
+        """
+        reactor = MemoryReactorWithClock()
+        cph = SteppablePoolHelper(jobSchema + schemaText)
+        cph.setUp(self)
+        fakeNow = datetime.datetime(2012, 12, 12, 12, 12, 12)
+        reactor.advance(astimestamp(fakeNow))
+        self.patch(ControllerQueue, "batchClaimSize", 100)
+        qpool = ControllerQueue(reactor, cph.pool.connection)
+
+        class FakeWorker(object):
+            currentLoad = 0
+
+        for _ignore in range(4):
+            qpool.workerPool.addWorker(FakeWorker())
+
+        @transactionally(cph.pool.connection)
+        @inlineCallbacks
+        def setup(txn):
+            for a in range(20):
+                yield DummyWorkItem.makeJob(
+                    txn, a=a, b=1, weight=WORK_WEIGHT_5,
+                    notBefore=fakeNow - datetime.timedelta(seconds=20)
+                )
+        yield setup
+
+        limit = qpool._claimLimit()
+        self.assertEqual(limit, 4 * WORK_WEIGHT_CAPACITY)
+        jobs = yield qpool._claimJobs(fakeNow, WORK_PRIORITY_LOW, limit)
+        self.assertEqual(len(jobs), 4 * WORK_WEIGHT_CAPACITY / WORK_WEIGHT_5)
+
+        @transactionally(cph.pool.connection)
+        def unassigned(txn):
+            return JobItem.query(txn, JobItem.isAssigned == 0)
+        remaining = yield unassigned
+        self.assertEqual(len(remaining), 20 - len(jobs))
+
+    def test_readyJobsOrder(self):
+        """
+        L{_ReadyJobs.take} returns the IDs of due jobs of at least the given
+        priority, highest priority and then earliest first, leaving jobs which
+        are not due or are of an excluded work type.
+        """
+        now = datetime.datetime(2012, 12, 12, 12, 12, 12)
+        earlier = now - datetime.timedelta(seconds=10)
+        later = now + datetime.timedelta(seconds=10)
+        ready = _ReadyJobs(10)
+        ready.add(_ReadyJob(1, "A", WORK_PRIORITY_LOW, earlier))
+        ready.add(_ReadyJob(2, "A", WORK_PRIORITY_HIGH, now))
+        ready.add(_ReadyJob(3, "A", WORK_PRIORITY_HIGH, earlier))
+        ready.add(_ReadyJob(4, "A", WORK_PRIORITY_HIGH, later))
+        ready.add(_ReadyJob(5, "B", WORK_PRIORITY_MEDIUM, earlier))
+        ready.add(_ReadyJob(3, "A", WORK_PRIORITY_HIGH, earlier))
+        self.assertEqual(len(ready), 5)
+
+        self.assertEqual(ready.take(now, WORK_PRIORITY_MEDIUM, 10, ["B"]), [3, 2])
+        self.assertEqual(ready.take(now, WORK_PRIORITY_LOW, 1), [5])
+        self.assertEqual(ready.take(now, WORK_PRIORITY_LOW, 10), [1])
+        self.assertEqual(ready.take(later, WORK_PRIORITY_LOW, 10), [4])
+        self.assertEqual(len(ready), 0)
+
+    def test_readyJobsScan(self):
+        """
+        L{_ReadyJobs.finishScan} replaces the cached jobs with those scanned,
+        keeping any added while the scan was in progress, and no more than the
+        maximum size.
+        """
+        now = datetime.datetime(2012, 12, 12, 12, 12, 12)
+        ready = _ReadyJobs(3)
+        ready.add(_ReadyJob(1, "A", WORK_PRIORITY_LOW, now))
+        ready.startScan()
+        self.assertFalse(ready.needScan)
+        ready.add(_ReadyJob(2, "A", WORK_PRIORITY_LOW, now))
+        ready.finishScan([
+            _ReadyJob(jobID, "A", WORK_PRIORITY_LOW, now)
+            for jobID in (3, 4, 5)
+        ], 100.0)
+        self.assertEqual(ready.lastScan, 100.0)
+        self.assertEqual(ready.take(now, WORK_PRIORITY_LOW, 10), [3, 4, 5])
+
+    @inlineCallbacks
+    def test_claimFromReadyQueue(self):
+        """
+        With a ready queue, L{ControllerQueue._claimJobs} claims jobs it has
+        been told about without querying the job table, only scanning it for
+        jobs created elsewhere every C{readyQueueReconcileInterval} seconds,
+        or when asked to.
+        """
+        reactor = MemoryReactorWithClock()
+        cph = SteppablePoolHelper(jobSchema + schemaText)
+        cph.setUp(self)
+        fakeNow = datetime.datetime(2012, 12, 12, 12, 12, 12)
+        reactor.advance(astimestamp(fakeNow))
+        self.patch(ControllerQueue, "readyQueueSize", 10)
+        qpool = ControllerQueue(reactor, cph.pool.connection, useWorkerPool=False)
+
+        scans = []
+        readyJobs = JobItem.readyJobs.im_func
+
+        def countScans(cls, txn, until, limit):
+            scans.append(until)
+            return readyJobs(cls, txn, until, limit)
+        self.patch(JobItem, "readyJobs", classmethod(countScans))
+
+        @inlineCallbacks
+        def makeJobs(count, notBefore):
+            jobs = []
+            for _ignore in range(count):
+                work = yield inTransaction(
+                    cph.pool.connection,
+                    lambda txn: DummyWorkItem.makeJob(txn, a=1, b=1, notBefore=notBefore)
+                )
+                jobs.append(work.job)
+            returnValue(jobs)
+
+        yield makeJobs(2, fakeNow - datetime.timedelta(seconds=20))
+
+        # The first claim scans for jobs
+        jobs = yield qpool._claimJobs(fakeNow, WORK_PRIORITY_LOW, 10)
+        self.assertEqual(len(jobs), 2)
+        self.assertEqual(len(scans), 1)
+
+        # Nothing more to do, so no transaction at all
+        jobs = yield qpool._claimJobs(fakeNow, WORK_PRIORITY_LOW, 10)
+        self.assertEqual(jobs, [])
+
+        # Jobs reported as committed are claimed without another scan
+        newJobs = yield makeJobs(2, fakeNow - datetime.timedelta(seconds=1))
+        qpool.enqueuedJob(newJobs)
+        jobs = yield qpool._claimJobs(fakeNow, WORK_PRIORITY_LOW, 10)
+        self.assertEqual(
+            sorted(job.jobID for job in jobs),
+            sorted(job.jobID for job in newJobs)
+        )
+        self.assertEqual(len(scans), 1)
+
+        # Jobs created elsewhere are found by the next reconcile scan
+        yield makeJobs(1, fakeNow - datetime.timedelta(seconds=1))
+        jobs = yield qpool._claimJobs(fakeNow, WORK_PRIORITY_LOW, 10)
+        self.assertEqual(jobs, [])
+        reactor.advance(ControllerQueue.readyQueueReconcileInterval)
+        jobs = yield qpool._claimJobs(fakeNow, WORK_PRIORITY_LOW, 10)
+        self.assertEqual(len(jobs), 1)
+        self.assertEqual(len(scans), 2)
+
+        # A notification without the jobs requests a scan
+        yield makeJobs(1, fakeNow - datetime.timedelta(seconds=1))
+        qpool.enqueuedJob()
+        jobs = yield qpool._claimJobs(fakeNow, WORK_PRIORITY_LOW, 10)
+        self.assertEqual(jobs, [])
+        qpool._readyJobs.needScan = True
+        jobs = yield qpool._claimJobs(fakeNow, WORK_PRIORITY_LOW, 10)
+        self.assertEqual(len(jobs), 1)
+        self.assertEqual(len(scans), 3)
+
+    @inlineCallbacks
+    def test_claimFromReadyQueueNotDue(self):
+        """
+        L{ControllerQueue._claimJobs} does not claim a job from the ready queue
+        whose C{notBefore} has been moved into the future by another
+        transaction since it was queued.
+        """
+        reactor = MemoryReactorWithClock()
+        cph = SteppablePoolHelper(jobSchema + schemaText)
+        cph.setUp(self)
+        fakeNow = datetime.datetime(2012, 12, 12, 12, 12, 12)
+        reactor.advance(astimestamp(fakeNow))
+        self.patch(ControllerQueue, "readyQueueSize", 10)
+        qpool = ControllerQueue(reactor, cph.pool.connection, useWorkerPool=False)
+        jobs = yield qpool._claimJobs(fakeNow, WORK_PRIORITY_LOW, 10)
+        self.assertEqual(jobs, [])
+
+        work = yield inTransaction(
+            cph.pool.connection,
+            lambda txn: DummyWorkItem.makeJob(
+                txn, a=1, b=1, notBefore=fakeNow - datetime.timedelta(seconds=1)
+            )
+        )
+        qpool.enqueuedJob([work.job])
+
+        @inlineCallbacks
+        def postpone(txn):
+            job = yield JobItem.load(txn, work.job.jobID)
+            yield job.update(notBefore=fakeNow + datetime.timedelta(seconds=60))
+        yield inTransaction(cph.pool.connection, postpone)
+
+        jobs = yield qpool._claimJobs(fakeNow, WORK_PRIORITY_LOW, 10)
+        self.assertEqual(jobs, [])
+        job = yield inTransaction(
+            cph.pool.connection, lambda txn: JobItem.load(txn, work.job.jobID)
+        )
+        self.assertEqual(job.isAssigned, 0)
+
+    def test_claimLimit(self):
+        """
+        L{ControllerQueue._claimLimit} is L{ControllerQueue.batchClaimSize},
+        reduced to the spare capacity of the worker pool.
+        """
+        class FakeWorker(object):
+            def __init__(self, currentLoad):
+                self.currentLoad = currentLoad
+
+        self.pcp.batchClaimSize = 10
+        self.assertEqual(self.pcp._claimLimit(), 0)
+        self.pcp.workerPool.addWorker(FakeWorker(WORK_WEIGHT_CAPACITY - 2))
+        self.pcp.workerPool.addWorker(FakeWorker(WORK_WEIGHT_CAPACITY + 1))
+        self.assertEqual(self.pcp._claimLimit(), 2)
+        self.pcp.workerPool.addWorker(FakeWorker(0))
+        self.assertEqual(self.pcp._claimLimit(), 10)
+
     @inlineCallbacks
     def test_notBeforeWhenEnqueueing(self):
         """
@@ -1012,6 +2224,23 @@ class ControllerQueueUnitTests(TestCase):
         # Work item complete
         self.assertTrue(DummyWorkItem.results == {1: 12})
 
+    @inlineCallbacks
+    def test_stopServiceDropsHeld(self):
+        """
+        L{ControllerQueue.stopService} fails the jobs its worker pool is
+        holding with L{CancelledError}.
+        """
+        clock = Clock()
+        peerPool = ControllerQueue(clock, None)
+        # Registered by startService, which needs a database.
+        localJobNotifier.addListener(peerPool.jobNotified)
+        held = peerPool.workerPool.performJob(JobDescriptor(1, 1, "ABC"))
+        self.assertNoResult(held)
+        yield peerPool.stopService()
+        self.failureResultOf(held, CancelledError)
+        self.assertEqual(peerPool.workerPool.availableCapacity(), 0)
+        self.assertEqual(peerPool.workerPool.fragmentation()["held"], 0)
+
     def test_workerConnectionPoolPerformJob(self):
         """
         L{WorkerConnectionPool.performJob} performs work by selecting a
@@ -1030,6 +2259,9 @@ class ControllerQueueUnitTests(TestCase):
         worker1, _ignore_trans1 = peer()
         worker2, _ignore_trans2 = peer()
 
+        # Spread jobs between workers rather than packing them
+        peerPool.workerPool.bestFit = False
+
         # Ask the worker to do something.
         worker1.performJob(JobDescriptor(1, 1, "ABC"))
         self.assertEquals(worker1.currentLoad, 1)
@@ -1040,6 +2272,38 @@ class ControllerQueueUnitTests(TestCase):
         self.assertEquals(worker1.currentLoad, 1)
         self.assertEquals(worker2.currentLoad, 1)
 
+    def test_workerConnectionPoolPerformJobs(self):
+        """
+        L{WorkerConnectionPool.performJobs} sends a batch of jobs to one
+        L{ConnectionFromWorker}, which counts each job as assigned but only the
+        heaviest towards its load.
+        """
+        clock = Clock()
+        peerPool = ControllerQueue(clock, None)
+        factory = peerPool.workerListenerFactory()
+
+        def peer():
+            p = factory.buildProtocol(None)
+            t = StringTransport()
+            p.makeConnection(t)
+            return p, t
+
+        worker1, _ignore_trans1 = peer()
+        worker2, _ignore_trans2 = peer()
+
+        # Spread jobs between workers rather than packing them
+        peerPool.workerPool.bestFit = False
+
+        worker1.performJobs([JobDescriptor(1, 3, "ABC"), JobDescriptor(2, 5, "ABC")])
+        self.assertEquals(worker1.currentAssigned, 2)
+        self.assertEquals(worker1.currentLoad, 5)
+        self.assertEquals(worker2.currentLoad, 0)
+
+        peerPool.workerPool.performJobs([JobDescriptor(3, 0, "ABC"), JobDescriptor(4, 0, "ABC")])
+        self.assertEquals(worker1.currentLoad, 5)
+        self.assertEquals(worker2.currentAssigned, 2)
+        self.assertEquals(worker2.currentLoad, 1)
+
     def test_workerPerformJobNoZeroWeight(self):
         """
         L{WorkerConnectionPool.performJob} always uses a weight greater than zero.
@@ -1057,6 +2321,9 @@ class ControllerQueueUnitTests(TestCase):
         worker1, _ignore_trans1 = peer()
         worker2, _ignore_trans2 = peer()
 
+        # Spread jobs between workers rather than packing them
+        peerPool.workerPool.bestFit = False
+
         # Ask the worker to do something.
         worker1.performJob(JobDescriptor(1, 0, "ABC"))
         self.assertEquals(worker1.currentLoad, 1)
@@ -1072,6 +2339,145 @@ class ControllerQueueUnitTests(TestCase):
         self.assertEquals(worker1.currentLoad, 6)
         self.assertEquals(worker2.currentLoad, 1)
 
+    def test_workerHeartbeats(self):
+        """
+        L{ConnectionFromWorker} tracks the jobs in flight on a worker, and
+        L{ControllerQueue._heartbeatCheck} unassigns only those for which no
+        L{JobHeartbeat} has arrived within L{ControllerQueue.heartbeatTimeout}.
+        """
+        clock = Clock()
+        peerPool = ControllerQueue(clock, None)
+        factory = peerPool.workerListenerFactory()
+        worker = factory.buildProtocol(None)
+        worker.makeConnection(StringTransport())
+
+        lost = []
+        peerPool.jobsLost = lambda jobIDs: succeed(lost.extend(jobIDs))
+
+        worker.performJob(JobDescriptor(1, 1, "ABC"))
+        worker.performJob(JobDescriptor(2, 1, "ABC"))
+        self.assertEqual(peerPool._liveJobIDs(), set([1, 2]))
+
+        clock.advance(peerPool.heartbeatTimeout / 2)
+        worker.jobHeartbeat([1, 3])
+        clock.advance(peerPool.heartbeatTimeout / 2 + 1)
+        self.assertEqual(peerPool._liveJobIDs(), set([1]))
+
+        peerPool._heartbeatCheck()
+        self.assertEqual(lost, [2])
+        self.assertEqual(peerPool._liveJobIDs(), set([1]))
+
+    def test_heldJobsLive(self):
+        """
+        L{ControllerQueue._liveJobIDs} includes the jobs being held until a
+        worker has room for them, so that L{ControllerQueue._overdueCheck}
+        does not unassign them.
+        """
+        clock = Clock()
+        peerPool = ControllerQueue(clock, None)
+        factory = peerPool.workerListenerFactory()
+        worker = factory.buildProtocol(None)
+        worker.makeConnection(StringTransport())
+
+        worker.performJob(JobDescriptor(1, 1, "ABC"))
+        peerPool.workerPool.performJob(JobDescriptor(2, WORK_WEIGHT_CAPACITY, "ABC"))
+        self.assertEqual(peerPool.workerPool.heldJobIDs(), set([2]))
+        self.assertEqual(peerPool._liveJobIDs(), set([1, 2]))
+
+    @inlineCallbacks
+    def test_overdueCheckBumpsLiveJobs(self):
+        """
+        L{ControllerQueue._overdueCheck} bumps the overdue value of overdue
+        jobs that a worker is known to be performing, all at once, and then
+        goes on to unassign the overdue jobs behind them, even when the
+        database returns overdue jobs without skipping the live ones (as
+        Oracle's C{overdue_job} stored procedure does).
+        """
+        dbpool = buildConnectionPool(self, jobSchema + schemaText)
+        now = datetime.datetime(2012, 12, 12, 12, 12, 12)
+        clock = Clock()
+        clock.advance(astimestamp(now))
+        peerPool = ControllerQueue(clock, dbpool.connection)
+        peerPool.running = True
+        worker = peerPool.workerListenerFactory().buildProtocol(None)
+        worker.makeConnection(StringTransport())
+
+        @inlineCallbacks
+        def setup(txn):
+            for i in (1, 2):
+                yield DummyWorkItem.makeJob(txn, jobID=i, workID=i, a=i, b=0, notBefore=now)
+            jobs = yield JobItem.all(txn)
+            yield JobItem.assignJobs(txn, jobs, now - datetime.timedelta(seconds=120), 60)
+        yield inTransaction(dbpool.connection, setup)
+        worker.performJob(JobDescriptor(1, 1, "DUMMY_WORK_ITEM"))
+
+        realOverdueJob = JobItem.overduejob.im_func
+
+        def overdueJob(cls, txn, now, rowLimit, excludeJobIDs=()):
+            return realOverdueJob(cls, txn, now, rowLimit)
+        self.patch(JobItem, "overduejob", classmethod(overdueJob))
+
+        yield peerPool._overdueCheck()
+
+        jobs = yield inTransaction(dbpool.connection, JobItem.all)
+        self.assertEqual(
+            [(job.jobID, job.isAssigned, job.overdue) for job in jobs],
+            [
+                (1, 1, now + datetime.timedelta(seconds=peerPool.queueOverdueTimeout)),
+                (2, 0, None),
+            ]
+        )
+
+    def test_workerConnectionLost(self):
+        """
+        When a worker disconnects, the jobs it was performing are passed to
+        L{ControllerQueue.jobsLost} in one go.
+        """
+        clock = Clock()
+        peerPool = ControllerQueue(clock, None)
+        factory = peerPool.workerListenerFactory()
+        worker = factory.buildProtocol(None)
+        worker.makeConnection(StringTransport())
+
+        lost = []
+        peerPool.jobsLost = lambda jobIDs: succeed(lost.extend(jobIDs))
+
+        failures = []
+        for jobID in (1, 2):
+            d = worker.performJob(JobDescriptor(jobID, 1, "ABC"))
+            d.addErrback(failures.append)
+
+        worker.connectionLost(Failure(ConnectionDone()))
+        self.assertEqual(lost, [1, 2])
+        self.assertEqual(len(failures), 2)
+        self.assertEqual(peerPool.workerPool.workers, [])
+
+    def test_workerSendsHeartbeats(self):
+        """
+        L{ConnectionFromController} sends a L{JobHeartbeat} every
+        C{heartbeatInterval} for as long as it is performing jobs, and stops
+        once they are done.
+        """
+        performing = Deferred()
+        self.patch(JobItem, "ultimatelyPerform", staticmethod(lambda txnFactory, job: performing))
+
+        clock = Clock()
+        transport = StringTransport()
+        proto = ConnectionFromController(None, lambda proto: None)
+        proto.reactor = clock
+        proto.makeConnection(transport)
+
+        proto.executeJobHere(JobDescriptor(7, 1, "ABC"))
+        self.assertEqual(transport.value(), "")
+        clock.advance(proto.heartbeatInterval)
+        self.assertIn("JobHeartbeat", transport.value())
+        transport.clear()
+        clock.advance(proto.heartbeatInterval)
+        self.assertIn("JobHeartbeat", transport.value())
+
+        performing.callback(None)
+        self.assertEqual(clock.getDelayedCalls(), [])
+
     def test_poolStartServiceChecksForWork(self):
         """
         L{ControllerQueue.startService} kicks off the idle work-check loop.
@@ -15,8 +15,11 @@
 ##
 
 from datetime import datetime, timedelta
+from hashlib import sha1
 from twext.enterprise.dal.record import SerializableRecord, NoSuchRecord
+from twext.enterprise.dal.syntax import SavepointAction
 from twext.enterprise.jobs.jobitem import JobItem
+from twext.enterprise.jobs.notify import notifyNewJob
 from twext.python.log import Logger
 from twisted.internet.defer import inlineCallbacks, returnValue, succeed
 
@@ -133,23 +136,108 @@ class WorkItem(SerializableRecord):
     @ivar group: If not C{None}, a unique-to-the-database identifier for which
         only one L{WorkItem} will execute at a time.
     @type group: L{unicode} or L{NoneType}
+
+    @cvar maxInFlight: If not C{None}, the maximum number of jobs of this type
+        which may be assigned at once, across all controllers.
+    @type maxInFlight: L{int} or L{NoneType}
+
+    @cvar rateLimit: If not C{None}, the maximum average number of jobs of this
+        type each controller assigns per second, allowing bursts of up to one
+        second's worth.
+    @type rateLimit: L{float} or L{NoneType}
+
+    @cvar dedupAttributes: If not C{None}, the names of the attributes which
+        identify the logical work done by an item: L{WorkItem.makeJob} then
+        coalesces an item with one that is queued, and not yet assigned, with
+        the same values for them, rather than creating another job.
+    @type dedupAttributes: L{tuple} of L{str} or L{NoneType}
+
+    @cvar dedupPushNotBefore: If C{True}, coalescing an item with one that is
+        queued moves the queued job's C{notBefore} forward to that of the new
+        item if it is later, so that a burst of duplicates runs once, after
+        the burst.
+    @type dedupPushNotBefore: L{bool}
+
+    @cvar batchable: If C{True}, jobs of this type which a controller claims
+        together (see C{ControllerQueue.batchClaimSize}) may be sent to a
+        worker in a single L{PerformJobs
+        <twext.enterprise.jobs.queue.PerformJobs>} command and performed in
+        one transaction, each in its own savepoint (see
+        L{JobItem.ultimatelyPerformBatch}).  Only set this for work which is
+        cheap relative to a transaction and does not rely on the transaction
+        being its own.
+    @type batchable: L{bool}
+
+    @cvar maxAttempts: If not C{None}, the number of times a job of this type
+        may fail before it is given up on, and moved with its work item to the
+        dead-letter table (see L{JobItem.kill}).
+    @type maxAttempts: L{int} or L{NoneType}
+
+    @cvar retryBackoff: If not C{None}, the factor by which the delay before
+        a failed job is run again grows with each failure, for exponential
+        backoff.  If C{None}, the delay grows linearly.
+    @type retryBackoff: L{float} or L{NoneType}
+
+    @cvar retryMaxDelay: If not C{None}, the longest delay, in seconds, before
+        a failed job is run again.
+    @type retryMaxDelay: L{float} or L{NoneType}
+
+    @cvar retryJitter: The fraction by which the delay before a failed job is
+        run again is randomly varied, either way.
+    @type retryJitter: L{float}
     """
 
     group = None
     default_priority = WORK_PRIORITY_LOW    # Default - subclasses should override
     default_weight = WORK_WEIGHT_5          # Default - subclasses should override
+    maxInFlight = None                      # No concurrency limit
+    rateLimit = None                        # No rate limit
+    dedupAttributes = None                  # No coalescing of duplicates
+    dedupPushNotBefore = False
+    batchable = False                       # Each job has its own transaction
+    maxAttempts = None                      # Retry failed jobs forever
+    retryBackoff = None                     # Linear backoff for failed jobs
+    retryMaxDelay = None
+    retryJitter = 0.0
     _tableNameMap = {}
 
     @classmethod
     def workType(cls):
         return cls.table.model.name
 
+    @classmethod
+    def dedupKey(cls, kwargs):
+        """
+        Determine the key identifying the logical work done by an item.
+
+        @param kwargs: the attributes of the new work item.
+        @type kwargs: L{dict}
+
+        @return: the key, or C{None} if this work type does not coalesce
+            duplicates.
+        @rtype: L{str} or L{NoneType}
+        """
+        if cls.dedupAttributes is None:
+            return None
+        values = []
+        for name in cls.dedupAttributes:
+            value = kwargs.get(name)
+            if isinstance(value, unicode):
+                value = value.encode("utf-8")
+            values.append(value)
+        return "{}:{}".format(cls.workType(), sha1(repr(values)).hexdigest())
+
     @classmethod
     @inlineCallbacks
     def makeJob(cls, transaction, **kwargs):
         """
         A new work item needs to be created. First we create a Job record, then
-        we create the actual work item related to the job.
+        we create the actual work item related to the job.  Job listeners are
+        notified when the transaction commits.
+
+        If the work type coalesces duplicates (see C{dedupAttributes}) and a
+        matching job is queued but not yet assigned, no new job is created and
+        the queued work item is returned instead.
 
         @param transaction: the transaction to use
         @type transaction: L{IAsyncTransaction}
@@ -176,11 +264,66 @@ class WorkItem(SerializableRecord):
         if "notBefore" not in jobargs:
             jobargs["notBefore"] = datetime.utcnow()
 
-        job = yield JobItem.create(transaction, **jobargs)
+        # Park jobs which are not due soon, or paused
+        isAssigned = JobItem.unassignedState(jobargs["notBefore"], jobargs.get("pause", False))
+        if isAssigned:
+            jobargs["isAssigned"] = isAssigned
+
+        dedupKey = cls.dedupKey(kwargs)
+        if dedupKey is not None:
+            work = yield cls._coalesce(transaction, dedupKey, jobargs["notBefore"])
+            if work is not None:
+                returnValue(work)
+
+            # The unique index on DEDUP_KEY may reject the new job if another
+            # transaction has just created a duplicate, in which case use that
+            jobargs["dedupKey"] = dedupKey
+            savepoint = SavepointAction("WorkItem_makeJob")
+            yield savepoint.acquire(transaction)
+            try:
+                job = yield JobItem.create(transaction, **jobargs)
+            except Exception:
+                yield savepoint.rollback(transaction)
+                work = yield cls._coalesce(transaction, dedupKey, jobargs["notBefore"])
+                if work is None:
+                    raise
+                returnValue(work)
+            else:
+                yield savepoint.release(transaction)
+        else:
+            job = yield JobItem.create(transaction, **jobargs)
 
         kwargs["jobID"] = job.jobID
         work = yield cls.create(transaction, **kwargs)
         work.__dict__["job"] = job
+
+        # Wake up any controllers once this transaction commits
+        yield notifyNewJob(transaction, job)
+        returnValue(work)
+
+    @classmethod
+    @inlineCallbacks
+    def _coalesce(cls, transaction, dedupKey, notBefore):
+        """
+        Find the queued work item with the given dedup key, if there is one,
+        moving its C{notBefore} forward if C{dedupPushNotBefore} is set.
+
+        @return: the work item, with its job, or C{None}.
+        @rtype: L{WorkItem}
+        """
+        jobs = yield JobItem.query(
+            transaction, JobItem.dedupKey == dedupKey, forUpdate=True
+        )
+        if not jobs:
+            returnValue(None)
+        job = jobs[0]
+        works = yield cls.query(transaction, cls.jobID == job.jobID)
+        if not works:
+            returnValue(None)
+        if cls.dedupPushNotBefore and notBefore > job.notBefore:
+            yield job.update(notBefore=notBefore)
+        work = works[0]
+        work.__dict__["job"] = job
         returnValue(work)
 
     @classmethod
@@ -189,14 +332,37 @@ class WorkItem(SerializableRecord):
         workItems = yield cls.query(txn, (cls.jobID == jobID))
         returnValue(workItems)
 
+    @classmethod
+    @inlineCallbacks
+    def loadForJobs(cls, txn, jobIDs):
+        """
+        Load the work items for several jobs with a single query.
+
+        @param jobIDs: the IDs of the jobs
+        @type jobIDs: L{list} of L{int}
+
+        @return: the work item of each job which has exactly one, keyed by job
+            ID.
+        @rtype: L{dict}
+        """
+        workItems = yield cls.query(txn, cls.jobID.In(jobIDs))
+        byJob = {}
+        for workItem in workItems:
+            byJob.setdefault(workItem.jobID, []).append(workItem)
+        returnValue(dict(
+            (jobID, items[0]) for jobID, items in byJob.iteritems() if len(items) == 1
+        ))
+
     @classmethod
     def updateWorkTypes(cls, updates):
         """
-        Update the priority and weight values of each specified work type.
+        Update the priority, weight and limits of each specified work type.
 
         @param updates: a dict whose workType is the work class name, and whose
-            settings is a dict containing one or both of "weight" and "priority"
-            keys and numeric values to change to.
+            settings is a dict containing any of "weight", "priority",
+            "maxInFlight", "rateLimit", "maxAttempts", "retryBackoff" and
+            "retryMaxDelay" keys and numeric values to change to (or C{None} to
+            remove a limit).
         @type updates: L{dict}
         """
 
@@ -243,15 +409,42 @@ class WorkItem(SerializableRecord):
                 "updateWorkTypes: '{workType}' priority: '{priority}' weight: '{weight}' ",
                 workType=workType, priority=priority, weight=weight,
             )
+            for name, kind in (
+                ("maxInFlight", int),
+                ("rateLimit", float),
+                ("maxAttempts", int),
+                ("retryBackoff", float),
+                ("retryMaxDelay", float),
+            ):
+                if name in settings:
+                    limit = settings[name]
+                    try:
+                        if limit is not None:
+                            limit = kind(limit)
+                            if limit < 0:
+                                raise ValueError
+                    except ValueError:
+                        log.error(
+                            "updateWorkTypes: '{workType}' {name} '{limit}' is not valid",
+                            workType=workType, name=name, limit=limit,
+                        )
+                    else:
+                        setattr(workItem, name, limit)
+                        log.info(
+                            "updateWorkTypes: '{workType}' {name}: '{limit}'",
+                            workType=workType, name=name, limit=limit,
+                        )
 
     @classmethod
     def dumpWorkTypes(cls):
         """
-        Dump the priority and weight values of each known work type.
+        Dump the priority and weight values, and any limits, of each known work
+        type.
 
         @return: a dict whose workType is the work class name, and whose
-            settings is a dict containing one or both of "weight" and "priority"
-            keys and numeric values to change to.
+            settings is a dict containing "weight" and "priority" keys, and
+            "maxInFlight", "rateLimit", "maxAttempts", "retryBackoff" and
+            "retryMaxDelay" keys if those limits are set, with numeric values.
         @rtype: L{dict}
         """
 
@@ -261,6 +454,9 @@ class WorkItem(SerializableRecord):
                 "priority": workClass.default_priority,
                 "weight": workClass.default_weight,
             }
+            for name in ("maxInFlight", "rateLimit", "maxAttempts", "retryBackoff", "retryMaxDelay"):
+                if getattr(workClass, name) is not None:
+                    results[workType][name] = getattr(workClass, name)
 
         return results
 
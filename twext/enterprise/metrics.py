@@ -0,0 +1,221 @@
+# -*- test-case-name: twext.enterprise.test.test_metrics -*-
+##
+# Copyright (c) 2017 Apple Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Counters and histograms describing the health of a
+L{twext.enterprise.adbapi2.ConnectionPool}.
+"""
+
+from bisect import bisect_left
+from threading import Lock
+
+__all__ = [
+    "Histogram",
+    "PoolMetrics",
+]
+
+
+# Bucket upper bounds for times, in milliseconds.
+LATENCY_BUCKETS = (
+    1, 2, 5, 10, 20, 50, 100, 200, 500,
+    1000, 2000, 5000, 10000, 30000, 60000,
+)
+
+# Bucket upper bounds for counts of things.
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# The label under which transactions are recorded once the number of
+# distinct labels reaches L{PoolMetrics.maxLabels}.
+OTHER_LABEL = "<other>"
+
+
+class Histogram(object):
+    """
+    A histogram with fixed buckets, cheap enough to update on every
+    transaction.
+
+    @ivar bounds: the inclusive upper bound of each bucket, in ascending
+        order.  Values larger than the last bound are counted in an extra,
+        unbounded, bucket.
+    @type bounds: C{tuple} of C{int}
+
+    @ivar buckets: the number of values recorded in each bucket.
+    @type buckets: C{list} of C{int}
+
+    @ivar count: the number of values recorded.
+    @ivar total: the sum of the values recorded.
+    @ivar maximum: the largest value recorded.
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.buckets = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.maximum = 0
+
+    def record(self, value):
+        """
+        Record a value.
+        """
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.maximum:
+            self.maximum = value
+
+    def percentile(self, percent):
+        """
+        Estimate a percentile of the recorded values.
+
+        @param percent: the percentile to estimate, between 0 and 100.
+
+        @return: the upper bound of the bucket containing the percentile, or
+            L{Histogram.maximum} if it falls in the unbounded bucket.  C{0} if
+            nothing has been recorded.
+        """
+        wanted = self.count * percent / 100.0
+        seen = 0
+        for bound, bucket in zip(self.bounds, self.buckets):
+            seen += bucket
+            if bucket and seen >= wanted:
+                return min(bound, self.maximum)
+        return self.maximum
+
+    def snapshot(self):
+        """
+        @return: the state of this histogram, made up only of simple types so
+            that it can be serialized by AMP, JSON or similar.
+        @rtype: C{dict}
+        """
+        return {
+            "count": self.count,
+            "total": self.total,
+            "max": self.maximum,
+            "p50": self.percentile(50),
+            "p99": self.percentile(99),
+            "buckets": zip(self.bounds + (None,), self.buckets),
+        }
+
+
+class PoolMetrics(object):
+    """
+    The metrics of a L{ConnectionPool}.
+
+    @ivar checkouts: the number of transactions given a connection.
+    @ivar blocked: the number of transactions which had to wait because the
+        pool had reached its maximum number of connections.
+    @ivar reconnects: the number of times a connection was replaced because
+        the first statement of a transaction failed on it.
+    @ivar reaped: the number of idle connections released.
+    @ivar probeFailures: the number of idle connections which failed a
+        liveness check.
+
+    @ivar checkoutWait: how long transactions waited for a connection, in
+        milliseconds.
+    @type checkoutWait: L{Histogram}
+
+    @ivar holdTime: how long transactions held their connection for, from
+        being given one to starting to commit or abort, in milliseconds, keyed
+        by transaction label.
+    @type holdTime: C{dict} of C{str}: L{Histogram}
+
+    @ivar statements: the number of statements executed per transaction.
+    @type statements: L{Histogram}
+
+    @ivar maxLabels: the maximum number of distinct labels tracked in
+        C{holdTime}; transactions with further labels are recorded under
+        L{OTHER_LABEL}.
+    """
+
+    def __init__(self, pool, maxLabels=100):
+        self._pool = pool
+        self._lock = Lock()
+        self.maxLabels = maxLabels
+        self.checkouts = 0
+        self.blocked = 0
+        self.reconnects = 0
+        self.reaped = 0
+        self.probeFailures = 0
+        self.checkoutWait = Histogram()
+        self.holdTime = {}
+        self.statements = Histogram(COUNT_BUCKETS)
+
+    def checkedOut(self, waited):
+        """
+        A transaction has been given a connection.
+
+        @param waited: how long it waited for the connection, in seconds.
+        @type waited: C{float}
+        """
+        self.checkouts += 1
+        self.checkoutWait.record(waited * 1000)
+
+    def released(self, label, held, statements):
+        """
+        A transaction has finished with its connection.
+
+        @param label: the transaction's label.
+        @type label: C{str}
+
+        @param held: how long it held the connection, in seconds.
+        @type held: C{float}
+
+        @param statements: the number of statements it executed.
+        @type statements: C{int}
+        """
+        histogram = self.holdTime.get(label)
+        if histogram is None:
+            if len(self.holdTime) >= self.maxLabels:
+                label = OTHER_LABEL
+            histogram = self.holdTime.get(label)
+            if histogram is None:
+                histogram = self.holdTime[label] = Histogram()
+        histogram.record(held * 1000)
+        self.statements.record(statements)
+
+    def reconnected(self):
+        """
+        A connection has been replaced.  May be called from any thread.
+        """
+        with self._lock:
+            self.reconnects += 1
+
+    def snapshot(self):
+        """
+        @return: the current metrics and pool sizes, made up only of simple
+            types so that they can be serialized by AMP, JSON or similar.
+        @rtype: C{dict}
+        """
+        pool = self._pool
+        return {
+            "free": len(pool._free),
+            "busy": len(pool._busy) + len(pool._finishing),
+            "waiting": len(pool._waiting),
+            "maxConnections": pool.maxConnections,
+            "checkouts": self.checkouts,
+            "blocked": self.blocked,
+            "reconnects": self.reconnects,
+            "reaped": self.reaped,
+            "probeFailures": self.probeFailures,
+            "checkoutWait": self.checkoutWait.snapshot(),
+            "holdTime": dict(
+                (label, histogram.snapshot())
+                for label, histogram in self.holdTime.iteritems()
+            ),
+            "statements": self.statements.snapshot(),
+        }
@@ -0,0 +1,91 @@
+##
+# Copyright (c) 2017 Apple Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Benchmark for streaming query results through the connection-pool AMP
+protocol, comparing one L{Row} command per row with batched L{Rows} commands.
+
+Run it like this::
+
+    python -m twext.enterprise.test.bench_rows [rows-per-query [queries]]
+"""
+
+import sys
+import time
+
+from twext.enterprise.adbapi2 import (
+    ConnectionPoolClient, ConnectionPoolConnection, DEFAULT_ROW_BATCH_SIZE
+)
+from twext.enterprise.fixtures import ConnectionPoolHelper, resultOf
+from twext.enterprise.test.test_adbapi2 import IOPump
+
+
+class _Benchmark(ConnectionPoolHelper):
+    """
+    A L{ConnectionPoolHelper} that can be used outside of a test case.
+    """
+
+    def __init__(self, rowCount):
+        self.cleanups = []
+        self.setUp()
+        self.factory.resultRowCount = rowCount
+
+    def addCleanup(self, f, *a, **kw):
+        self.cleanups.append((f, a, kw))
+
+    def run(self, rowBatchSize, queries):
+        """
+        Execute C{queries} queries over a loopback AMP connection.
+
+        @return: the number of rows received per second.
+        @rtype: C{float}
+        """
+        pump = IOPump(
+            ConnectionPoolClient(dbtype=self.dbtype, rowBatchSize=rowBatchSize),
+            ConnectionPoolConnection(self.pool),
+        )
+        txn = pump.client.newTransaction()
+        pump.flush()
+        received = 0
+        start = time.time()
+        for _ignore in xrange(queries):
+            d = txn.execSQL("select lots")
+            pump.flush()
+            [rows] = resultOf(d)
+            received += len(rows)
+        elapsed = time.time() - start
+        resultOf(txn.commit())
+        pump.flush()
+        return received / elapsed
+
+
+def main(argv=sys.argv[1:]):
+    rowCount = int(argv[0]) if argv else 5000
+    queries = int(argv[1]) if len(argv) > 1 else 20
+    bench = _Benchmark(rowCount)
+    for label, rowBatchSize in [
+        ("Row (unbatched)", None),
+        ("Rows (batch of {})".format(DEFAULT_ROW_BATCH_SIZE),
+         DEFAULT_ROW_BATCH_SIZE),
+    ]:
+        rate = bench.run(rowBatchSize, queries)
+        print("{0:>24}: {1:12.0f} rows/sec".format(label, rate))
+    for f, a, kw in bench.cleanups:
+        f(*a, **kw)
+
+
+if __name__ == "__main__":
+    main()
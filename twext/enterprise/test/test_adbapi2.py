@@ -36,16 +36,25 @@ from twext.enterprise.adbapi2 import ConnectionPoolClient
 from twext.enterprise.adbapi2 import ConnectionPoolConnection
 from twext.enterprise.ienterprise import IAsyncTransaction
 from twext.enterprise.ienterprise import ICommandBlock
+from twext.enterprise.ienterprise import IRowStream
+from twext.enterprise.ienterprise import (
+    DatabaseType, POSTGRES_DIALECT, ORACLE_DIALECT, SQLITE_DIALECT
+)
 from twext.enterprise.adbapi2 import FailsafeException
 from twext.enterprise.adbapi2 import ConnectionPool
+from twext.enterprise.adbapi2 import RoutingConnectionPool
 from twext.enterprise.fixtures import ConnectionPoolHelper
 from twext.enterprise.fixtures import resultOf
 from twext.enterprise.fixtures import ClockWithThreads
+from twext.enterprise.fixtures import ConnectionFactory
 from twext.enterprise.fixtures import FakeConnectionError
 from twext.enterprise.fixtures import RollbackFail
 from twext.enterprise.fixtures import CommitFail
 from twext.enterprise.adbapi2 import Commit
+from twext.enterprise.adbapi2 import Row, Rows, QueryComplete
 from twext.enterprise.adbapi2 import _HookableOperation
+from twext.enterprise.adbapi2 import _ServerPreparer
+from twext.enterprise.dal.syntax import StatementCache
 
 
 class TrashCollector(object):
@@ -693,6 +702,26 @@ class ConnectionPoolTests(ConnectionPoolHelper, TestCase, AssertResultHelper):
         notxn = self.createTransaction()
         self.assertEquals(notxn.dbtype.dialect, TEST_DIALECT)
 
+    def test_propagateStatementCache(self):
+        """
+        Each different type of L{ISQLExecutor} relays the same
+        C{statementCache} attribute, so that every transaction from a pool
+        shares its compiled statements.
+        """
+        normaltxn = self.createTransaction()
+        cache = normaltxn.statementCache
+        self.assertIsInstance(cache, StatementCache)
+        self.assertIdentical(normaltxn.commandBlock().statementCache, cache)
+        self.pauseHolders()
+        extra = []
+        extra.append(self.createTransaction())
+        waitingtxn = self.createTransaction()
+        self.assertIdentical(waitingtxn.statementCache, cache)
+        self.flushHolders()
+        self.pool.stopService()
+        notxn = self.createTransaction()
+        self.assertIdentical(notxn.statementCache, cache)
+
     def test_reConnectWhenFirstExecFails(self):
         """
         Generally speaking, DB-API 2.0 adapters do not provide information
@@ -914,7 +943,7 @@ class ConnectionPoolTests(ConnectionPoolHelper, TestCase, AssertResultHelper):
         self.assertEquals(self.factory.commitFail, True)
         self.assertIdentical(x, None)
         self.assertEquals(len(self.pool._free), 1)
-        self.assertEquals(self.pool._finishing, [])
+        self.assertEquals(len(self.pool._finishing), 0)
         self.assertEquals(len(self.factory.connections), 1)
         self.assertEquals(self.factory.connections[0].closed, False)
 
@@ -973,7 +1002,7 @@ class ConnectionPoolTests(ConnectionPoolHelper, TestCase, AssertResultHelper):
         # disposed of.
         self.assertIdentical(x, None)
         self.assertEquals(len(self.pool._free), 1)
-        self.assertEquals(self.pool._finishing, [])
+        self.assertEquals(len(self.pool._finishing), 0)
         self.assertEquals(len(self.factory.connections), 2)
         self.assertEquals(self.factory.connections[0].closed, True)
         self.assertEquals(self.factory.connections[1].closed, False)
@@ -995,7 +1024,7 @@ class ConnectionPoolTests(ConnectionPoolHelper, TestCase, AssertResultHelper):
         x.trap(self.translateError(CommitFail))
 
         self.assertEquals(len(self.pool._free), 1)
-        self.assertEquals(self.pool._finishing, [])
+        self.assertEquals(len(self.pool._finishing), 0)
         self.assertEquals(len(self.factory.connections), 2)
         self.assertEquals(self.factory.connections[0].closed, True)
         self.assertEquals(self.factory.connections[1].closed, False)
@@ -1081,6 +1110,55 @@ class ConnectionPoolTests(ConnectionPoolHelper, TestCase, AssertResultHelper):
         self.pauseHolders()
         self.test_twoCommandBlocks(self.flushHolders)
 
+    def test_pipelinedCommandBlock(self):
+        """
+        The commands executed on a pipelined L{ICommandBlock} are not executed
+        until the block is ended, and then they are all executed with a single
+        submission to the connection's thread.
+        """
+        txn = self.createTransaction()
+        self.resultOf(txn.execSQL("a"))
+        submitted = []
+        for holder in self.holders:
+            def submit(work, holder=holder, submit=holder.submit):
+                submitted.append(work)
+                return submit(work)
+            holder.submit = submit
+        cb = txn.commandBlock(pipeline=True)
+        b = self.resultOf(cb.execSQL("b"))
+        c = self.resultOf(cb.execSQLMany("c", [[1], [2]]))
+        d = self.resultOf(txn.execSQL("d"))
+        self.assertEquals((b, c, d), ([], [], []))
+        cb.end()
+        e = self.resultOf(txn.execSQL("e"))
+        self.assertEquals(
+            self.factory.connections[0].cursors[0].allExecutions,
+            [("a", []), ("b", []), ("c", [[1], [2]]), ("d", []), ("e", [])]
+        )
+        self.assertEquals(len(b), 1)
+        self.assertEquals(c, [2])
+        self.assertEquals(len(d), 1)
+        self.assertEquals(len(e), 1)
+        # One submission for the block, one each for "d" and "e".
+        self.assertEquals(len(submitted), 3)
+
+    def test_pipelinedCommandBlockFailure(self):
+        """
+        If one command in a pipelined L{ICommandBlock} fails, only its result
+        is a failure; the others are executed as usual.
+        """
+        txn = self.createTransaction()
+        self.resultOf(txn.execSQL("a"))
+        cb = txn.commandBlock(pipeline=True)
+        b = self.resultOf(cb.execSQL("b"))
+        c = self.resultOf(cb.execSQL("c"))
+        self.factory.connections[0].executeWillFail(ZeroDivisionError)
+        cb.end()
+        self.flushHolders()
+        self.assertIsInstance(b[0], Failure)
+        b[0].trap(self.translateError(ZeroDivisionError))
+        self.assertEquals(len(c[0]), 1)
+
     def test_commandBlockEndTwice(self):
         """
         L{CommandBlock.end} will raise L{AlreadyFinishedError} when called more
@@ -1167,6 +1245,71 @@ class ConnectionPoolTests(ConnectionPoolHelper, TestCase, AssertResultHelper):
         self.resultOf(txn.abort())
         self.assertRaises(AlreadyFinishedError, txn.commandBlock)
 
+    def test_execSQLMany(self):
+        """
+        L{IAsyncTransaction.execSQLMany} executes a statement for each set of
+        arguments with a single C{executemany} call, and fires with the number
+        of rows affected.
+        """
+        txn = self.createTransaction()
+        [rowcount] = self.resultOf(
+            txn.execSQLMany("insert me", [[1, 2], [3, 4], [5, 6]])
+        )
+        self.assertEquals(rowcount, 3)
+        self.assertEquals(
+            self.factory.connections[0].cursors[0].allExecutions,
+            [("insert me", [[1, 2], [3, 4], [5, 6]])]
+        )
+        self.assertEquals(self.factory.connections[0].executions, 1)
+
+    def test_execSQLManyInCommandBlock(self):
+        """
+        L{ICommandBlock.execSQLMany} is ordered along with the other statements
+        in its block.
+        """
+        txn = self.createTransaction()
+        self.resultOf(txn.execSQL("a"))
+        cb = txn.commandBlock()
+        self.resultOf(cb.execSQL("b"))
+        self.resultOf(txn.execSQLMany("d", [[1]]))
+        self.resultOf(cb.execSQLMany("c", [[2], [3]]))
+        cb.end()
+        self.resultOf(txn.execSQL("e"))
+        self.assertEquals(
+            self.factory.connections[0].cursors[0].allExecutions,
+            [("a", []), ("b", []), ("c", [[2], [3]]), ("d", [[1]]), ("e", [])]
+        )
+
+    def test_execSQLManyReconnects(self):
+        """
+        If L{IAsyncTransaction.execSQLMany} is the first statement in a
+        transaction and it fails, the connection is re-established and it is
+        tried again, just as with C{execSQL}.
+        """
+        txn = self.createTransaction()
+        self.factory.connections[0].executeWillFail(FakeConnectionError)
+        [rowcount] = self.resultOf(txn.execSQLMany("insert me", [[1]]))
+        self.assertEquals(rowcount, 1)
+        self.assertEquals(len(self.factory.connections), 2)
+        self.assertEquals(self.factory.connections[0].closed, True)
+        self.assertEquals(len(self.flushLoggedErrors(FakeConnectionError)), 1)
+
+    def test_execSQLStreaming(self):
+        """
+        L{IAsyncTransaction.execSQLStreaming} provides the results of a query
+        in batches of at most the given size, followed by an empty batch.
+        """
+        self.factory.resultRowCount = 5
+        txn = self.createTransaction()
+        [stream] = self.resultOf(txn.execSQLStreaming("select", [], 2))
+        verifyObject(IRowStream, stream)
+        sizes = []
+        for _ignore in range(4):
+            [batch] = self.resultOf(stream.nextBatch())
+            sizes.append(len(batch))
+        self.assertEquals(sizes, [2, 2, 1, 0])
+        self.resultOf(txn.commit())
+
     def test_raiseOnZeroRowCount(self):
         """
         L{IAsyncTransaction.execSQL} will return a L{Deferred} failing with the
@@ -1199,6 +1342,659 @@ class ConnectionPoolTests(ConnectionPoolHelper, TestCase, AssertResultHelper):
         self.assertEquals(echo, "some-rows")
 
 
+class WaitingPriorityTests(ConnectionPoolHelper, TestCase):
+    """
+    Tests for L{ConnectionPool.waitingPriorities}.
+    """
+
+    def setUp(self):
+        super(WaitingPriorityTests, self).setUp()
+        self.pool.waitingPriorities = {
+            "jobqueue.workCheck": 10,
+            "jobqueue.": 5,
+        }
+        self.holding = [self.pool.connection("holder") for _ignore in range(2)]
+        for txn in self.holding:
+            self.resultOf(txn.execSQL("hold"))
+
+    def wait(self, label):
+        """
+        Create a transaction which must wait for a connection, and execute a
+        statement in it.  The transaction is kept open until the test ends.
+
+        @return: the result list of the statement.
+        """
+        txn = self.pool.connection(label)
+        self.holding.append(txn)
+        return self.resultOf(txn.execSQL(label))
+
+    def test_priorityFirst(self):
+        """
+        A waiting transaction with a higher priority gets the next free
+        connection ahead of one with a lower priority that was waiting longer.
+        """
+        bulk = self.wait("bulk")
+        check = self.wait("jobqueue.workCheck")
+        self.resultOf(self.holding[0].commit())
+        self.assertEquals(bulk, [])
+        self.assertEquals(len(check), 1)
+        self.resultOf(self.holding[1].commit())
+        self.assertEquals(len(bulk), 1)
+
+    def test_longestPrefix(self):
+        """
+        A label without a priority of its own uses the priority of the longest
+        configured prefix that it starts with.
+        """
+        other = self.wait("jobqueue.inTransaction")
+        check = self.wait("jobqueue.workCheck.failed")
+        bulk = self.wait("bulk")
+        self.resultOf(self.holding[0].commit())
+        self.resultOf(self.holding[1].commit())
+        self.assertEquals((len(check), len(other), len(bulk)), (1, 1, 0))
+
+    def test_samePriorityInOrder(self):
+        """
+        Waiting transactions with the same priority get connections in the
+        order they were created.
+        """
+        first = self.wait("bulk")
+        second = self.wait("bulk")
+        self.resultOf(self.holding[0].commit())
+        self.assertEquals((len(first), len(second)), (1, 0))
+
+    def test_abortWhileWaiting(self):
+        """
+        Aborting a waiting transaction removes it from the waiting queue.
+        """
+        txn = self.pool.connection("jobqueue.workCheck")
+        bulk = self.wait("bulk")
+        self.resultOf(txn.abort())
+        self.assertEquals(len(self.pool._waiting), 1)
+        self.resultOf(self.holding[0].commit())
+        self.assertEquals(len(bulk), 1)
+        self.assertEquals(len(self.pool._waiting), 0)
+
+
+class PoolMetricsTests(ConnectionPoolHelper, TestCase):
+    """
+    Tests for the L{ConnectionPool.metrics} of a pool.
+    """
+
+    def test_checkoutWait(self):
+        """
+        The time a transaction spends waiting for a connection is recorded
+        when it is given one.
+        """
+        metrics = self.pool.metrics
+        a = self.pool.connection()
+        b = self.pool.connection()
+        c = self.pool.connection()
+        self.assertEqual((metrics.checkouts, metrics.blocked), (2, 1))
+        self.clock.advance(0.25)
+        self.resultOf(a.commit())
+        self.assertEqual(metrics.checkouts, 3)
+        self.assertEqual(metrics.checkoutWait.maximum, 250)
+        for txn in b, c:
+            self.resultOf(txn.commit())
+
+    def test_holdTime(self):
+        """
+        The time a transaction holds its connection for, and the number of
+        statements it executes, are recorded when it commits or aborts.
+        """
+        metrics = self.pool.metrics
+        txn = self.pool.connection("one")
+        self.resultOf(txn.execSQL("a"))
+        self.resultOf(txn.execSQLMany("b", [[1], [2]]))
+        self.clock.advance(2)
+        self.resultOf(txn.commit())
+        txn = self.pool.connection("two")
+        self.resultOf(txn.abort())
+        self.assertEqual(sorted(metrics.holdTime), ["one", "two"])
+        self.assertEqual(metrics.holdTime["one"].maximum, 2000)
+        self.assertEqual(metrics.holdTime["two"].maximum, 0)
+        self.assertEqual(metrics.statements.total, 2)
+        self.assertEqual(metrics.statements.count, 2)
+
+    def test_reconnects(self):
+        """
+        Re-connecting after the first statement of a transaction fails is
+        counted.
+        """
+        txn = self.pool.connection()
+        self.factory.connections[0].executeWillFail(ZeroDivisionError)
+        self.resultOf(txn.execSQL("hello"))
+        self.assertEqual(self.pool.metrics.reconnects, 1)
+        self.resultOf(txn.commit())
+        self.flushLoggedErrors(ZeroDivisionError)
+
+
+class PoolSizingTests(ConnectionPoolHelper, TestCase):
+    """
+    Tests for L{ConnectionPool.minConnections},
+    L{ConnectionPool.idleTimeout} and L{ConnectionPool.probeInterval}.
+    """
+
+    minConnections = 1
+    idleTimeout = 60
+    probeInterval = 30
+
+    def test_minConnectionsAtStart(self):
+        """
+        L{ConnectionPool.startService} establishes
+        L{ConnectionPool.minConnections} connections straight away.
+        """
+        self.assertEquals(len(self.factory.connections), 1)
+        self.assertEquals(len(self.pool._free), 1)
+
+    def burst(self):
+        """
+        Use both of the pool's connections at once, then free them.
+        """
+        txns = [self.pool.connection() for _ignore in range(2)]
+        for txn in txns:
+            self.resultOf(txn.execSQL("burst"))
+        for txn in txns:
+            self.resultOf(txn.commit())
+        self.assertEquals(len(self.pool._free), 2)
+
+    def test_reapIdle(self):
+        """
+        Free connections which have not been used for
+        L{ConnectionPool.idleTimeout} seconds are released, down to
+        L{ConnectionPool.minConnections}.
+        """
+        self.burst()
+        self.clock.advance(self.idleTimeout)
+        self.assertEquals(len(self.pool._free), 1)
+        self.assertEquals(
+            [connection.closed for connection in self.factory.connections],
+            [True, False]
+        )
+        self.assertEquals(self.pool.metrics.reaped, 1)
+        self.clock.advance(self.idleTimeout * 10)
+        self.assertEquals(len(self.pool._free), 1)
+
+    def test_mostRecentlyUsedFirst(self):
+        """
+        The most recently used free connection is handed out first, so that
+        the others can become idle for long enough to be released.
+        """
+        self.burst()
+        for _ignore in range(4):
+            self.clock.advance(self.idleTimeout / 4)
+            txn = self.pool.connection()
+            self.resultOf(txn.execSQL("keepalive"))
+            self.resultOf(txn.commit())
+        self.assertEquals(len(self.pool._free), 1)
+        self.assertEquals(self.pool.metrics.reaped, 1)
+
+    def test_probeIdle(self):
+        """
+        Free connections which have not been used for
+        L{ConnectionPool.probeInterval} seconds are checked by executing a
+        trivial statement on them.
+        """
+        [connection] = self.factory.connections
+        self.clock.advance(self.probeInterval)
+        [cursor] = connection.cursors
+        self.assertEquals(cursor.allExecutions, [("select 1", ())])
+        self.assertEquals(len(self.pool._free), 1)
+        self.assertEquals(connection._rollbackCount, 1)
+
+    def test_probedStillReaped(self):
+        """
+        Checking an idle connection does not make it any less idle, so it is
+        still released once it has not been used for
+        L{ConnectionPool.idleTimeout} seconds, before connections used more
+        recently.
+        """
+        self.burst()
+        self.clock.advance(self.probeInterval)
+        self.assertEquals(len(self.pool._busy), 0)
+        self.assertEquals(len(self.pool._free), 2)
+        txn = self.pool.connection()
+        self.resultOf(txn.execSQL("keepalive"))
+        self.resultOf(txn.commit())
+        used = self.pool._free[-1]
+        self.clock.advance(self.idleTimeout - self.probeInterval)
+        self.assertEquals(list(self.pool._free), [used])
+        self.assertEquals(self.pool.metrics.reaped, 1)
+
+    def test_probeFailure(self):
+        """
+        A connection which fails its liveness check is released and, if it is
+        needed to keep L{ConnectionPool.minConnections} connections, replaced.
+        """
+        [connection] = self.factory.connections
+        connection.executeWillFail(ZeroDivisionError)
+        self.clock.advance(self.probeInterval)
+        self.assertEquals(len(self.flushLoggedErrors(ZeroDivisionError)), 1)
+        self.assertEquals(connection.closed, True)
+        self.assertEquals(len(self.factory.connections), 2)
+        self.assertEquals(len(self.pool._free), 1)
+        self.assertEquals(self.pool.metrics.probeFailures, 1)
+
+    def test_probeThenWaiting(self):
+        """
+        A transaction waiting for a connection while it is being checked is
+        given that connection once the check succeeds.
+        """
+        self.burst()
+        self.pauseHolders()
+        self.clock.advance(self.probeInterval)
+        self.assertEquals(len(self.pool._busy), 2)
+        txn = self.pool.connection()
+        result = self.resultOf(txn.execSQL("waiting"))
+        self.assertEquals(result, [])
+        self.flushHolders()
+        self.assertEquals(len(result), 1)
+        self.resultOf(txn.commit())
+
+
+class RoutingConnectionPoolTests(ConnectionPoolHelper, TestCase):
+    """
+    Tests for L{RoutingConnectionPool}.
+    """
+
+    def setUp(self):
+        super(RoutingConnectionPoolTests, self).setUp()
+        self.factories = [ConnectionFactory() for _ignore in range(3)]
+        primary, replicaA, replicaB = [
+            self.makePool(factory) for factory in self.factories
+        ]
+        self.router = RoutingConnectionPool(
+            primary, [replicaA, replicaB], readOnlyLabels=["report."],
+        )
+        self.router.reactor = self.clock
+        self.router.startService()
+        self.addCleanup(self.router.stopService)
+
+    def makePool(self, factory):
+        """
+        Make a L{ConnectionPool} using fake threads and the given factory.
+        """
+        pool = ConnectionPool(factory.connect, maxConnections=2)
+        pool._createHolder = self.makeAHolder
+        pool.reactor = self.clock
+        return pool
+
+    def poolFor(self, txn):
+        """
+        Which of the pools did a transaction come from?
+
+        @return: C{0} for the primary, or C{1} or C{2} for the replicas.
+        """
+        pools = [self.router.primary] + self.router.replicas
+        return pools.index(txn._pool)
+
+    def test_writesToPrimary(self):
+        """
+        Transactions which are not read-only come from the primary pool.
+        """
+        txn = self.router.connection("write")
+        self.assertEquals(self.poolFor(txn), 0)
+        self.assertEquals(txn.readOnly, False)
+
+    def test_leastOutstanding(self):
+        """
+        Read-only transactions come from the replica with the fewest
+        outstanding transactions.
+        """
+        txns = [self.router.connection(readOnly=True) for _ignore in range(3)]
+        self.assertEquals([self.poolFor(txn) for txn in txns], [1, 2, 1])
+        self.assertEquals([txn.readOnly for txn in txns], [True] * 3)
+        self.resultOf(txns[1].commit())
+        txn = self.router.connection(readOnly=True)
+        self.assertEquals(self.poolFor(txn), 2)
+
+    def test_readOnlyLabels(self):
+        """
+        Transactions whose labels start with one of C{readOnlyLabels} are
+        read-only unless told otherwise.
+        """
+        self.assertEquals(
+            self.poolFor(self.router.connection("report.daily")), 1
+        )
+        self.assertEquals(
+            self.poolFor(self.router.connection("report.daily", False)), 0
+        )
+
+    def test_laggingReplicaExcluded(self):
+        """
+        Replicas which are further behind than C{maxReplicaLag}, or whose lag
+        could not be checked, are not used.  If none can be used, read-only
+        transactions come from the primary.
+        """
+        self.router.maxReplicaLag = 5
+        # The fake connections report their ID as the lag.
+        self.factories[1].idcounter = iter([10, 11, 12])
+        self.router._checkLag()
+        self.assertEquals(self.router._lag.values().count(None), 0)
+        self.assertEquals(
+            self.poolFor(self.router.connection(readOnly=True)), 2
+        )
+        [connection] = self.factories[2].connections
+        connection.executeWillFail(ZeroDivisionError)
+        self.factories[2].willFail()
+        self.clock.advance(self.router.lagCheckInterval)
+        self.flushLoggedErrors(ZeroDivisionError, FakeConnectionError)
+        self.assertEquals(
+            self.router._lag[self.router.replicas[1]], None
+        )
+        self.assertEquals(
+            self.poolFor(self.router.connection(readOnly=True)), 0
+        )
+
+    def test_unreadableLag(self):
+        """
+        A replica whose lag check returns something other than a number is not
+        used, its transaction is aborted, the other replicas are still checked,
+        and the next check is still scheduled.
+        """
+        self.router.maxReplicaLag = 5
+        self.factories[1].hasResults = False
+        self.router._checkLag()
+        self.assertEquals(len(self.flushLoggedErrors(IndexError)), 1)
+        self.assertEquals(self.router._lag[self.router.replicas[0]], None)
+        self.assertEquals(self.router._lag[self.router.replicas[1]], 1)
+        [connection] = self.factories[1].connections
+        self.assertEquals(connection._rollbackCount, 1)
+        self.assertNotEquals(self.router._lagCheckCall, None)
+
+
+class RowStreamTests(ConnectionPoolHelper, TestCase):
+    """
+    Tests for the L{IRowStream}s provided by
+    L{_SingleTxn.execSQLStreaming}.
+    """
+
+    def stream(self, batchSize=2):
+        """
+        Execute a streaming query returning 5 rows.
+
+        @return: the transaction, the stream and the cursor it is using.
+        """
+        self.factory.resultRowCount = 5
+        txn = self.createTransaction()
+        self.resultOf(txn.execSQL("first"))
+        [stream] = self.resultOf(txn.execSQLStreaming("select", [], batchSize))
+        return txn, stream, self.factory.connections[0].cursors[-1]
+
+    def test_ownCursor(self):
+        """
+        A streaming query is executed on a cursor of its own, so other
+        statements can be executed in the transaction while it is in progress.
+        """
+        txn, stream, cursor = self.stream()
+        self.assertEquals(len(cursor.allExecutions), 1)
+        self.resultOf(txn.execSQL("other"))
+        [batch] = self.resultOf(stream.nextBatch())
+        self.assertEquals(len(batch), 2)
+
+    def test_closedWhenExhausted(self):
+        """
+        The stream's cursor is closed once all the rows have been fetched.
+        """
+        _ignore_txn, stream, cursor = self.stream()
+        self.resultOf(stream.nextBatch())
+        self.resultOf(stream.nextBatch())
+        self.assertEquals(cursor.closed, False)
+        self.resultOf(stream.nextBatch())
+        self.assertEquals(cursor.closed, True)
+        self.assertEquals(self.resultOf(stream.nextBatch()), [[]])
+
+    def test_close(self):
+        """
+        L{IRowStream.close} closes the stream's cursor, after which no more
+        rows are provided.
+        """
+        _ignore_txn, stream, cursor = self.stream()
+        self.resultOf(stream.close())
+        self.assertEquals(cursor.closed, True)
+        self.assertEquals(self.resultOf(stream.nextBatch()), [[]])
+
+    def test_closedOnCommit(self):
+        """
+        Any streams still open when the transaction ends are closed.
+        """
+        txn, _ignore_stream, cursor = self.stream()
+        self.resultOf(txn.commit())
+        self.assertEquals(cursor.closed, True)
+
+    def test_useAfterCommit(self):
+        """
+        Once the transaction has been committed, even before the stream's
+        cursor has been closed, L{IRowStream.nextBatch} fails with
+        L{AlreadyFinishedError} and L{IRowStream.close} succeeds.
+        """
+        txn, stream, cursor = self.stream()
+        self.pauseHolders()
+        committed = txn.commit()
+        self.assertEquals(cursor.closed, False)
+        self.failureResultOf(stream.nextBatch(), AlreadyFinishedError)
+        self.assertEquals(self.successResultOf(stream.close()), None)
+        self.flushHolders()
+        self.assertEquals(self.resultOf(committed), [None])
+        self.assertEquals(cursor.closed, True)
+
+    def test_fetchOnDemand(self):
+        """
+        Rows are only fetched from the cursor when a batch is asked for.
+        """
+        _ignore_txn, stream, cursor = self.stream()
+        self.assertEquals(cursor.fetched, 0)
+        self.resultOf(stream.nextBatch())
+        self.assertEquals(cursor.fetched, 2)
+
+    def test_serverSideCursor(self):
+        """
+        On PostgreSQL, the query is declared as a server-side cursor, each
+        batch is retrieved from it with C{FETCH}, and it is closed with
+        C{CLOSE} once exhausted.
+        """
+        _ignore_txn, stream, cursor = self.stream()
+        for _ignore in range(3):
+            self.resultOf(stream.nextBatch())
+        self.assertEquals(cursor.allExecutions, [
+            ("declare twext_stream_1 no scroll cursor for select", []),
+            ("fetch forward 2 from twext_stream_1", ()),
+            ("fetch forward 2 from twext_stream_1", ()),
+            ("fetch forward 2 from twext_stream_1", ()),
+            ("close twext_stream_1", ()),
+        ])
+        self.assertEquals(cursor.closed, True)
+
+    def test_serverSideCursorEndedByTransaction(self):
+        """
+        A server-side cursor still open when the transaction ends is left for
+        the end of the transaction to close, without a C{CLOSE} statement.
+        """
+        txn, _ignore_stream, cursor = self.stream()
+        self.resultOf(txn.abort())
+        self.assertEquals(cursor.allExecutions, [
+            ("declare twext_stream_1 no scroll cursor for select", []),
+        ])
+        self.assertEquals(cursor.closed, True)
+
+    def test_plainCursorFallback(self):
+        """
+        On dialects other than PostgreSQL, such as SQLite, the query is
+        executed on a plain cursor and batches are retrieved with
+        C{fetchmany}.
+        """
+        self.pool.dbtype = self.pool.dbtype.copyreplace(dialect=SQLITE_DIALECT)
+        _ignore_txn, stream, cursor = self.stream()
+        self.assertEquals(cursor.allExecutions, [("select", [])])
+        sizes = []
+        for _ignore in range(3):
+            [batch] = self.resultOf(stream.nextBatch())
+            sizes.append(len(batch))
+        self.assertEquals(sizes, [2, 2, 1])
+        self.assertEquals(cursor.allExecutions, [("select", [])])
+        self.assertEquals(cursor.closed, True)
+
+
+class PreparedStatementTests(ConnectionPoolHelper, TestCase):
+    """
+    Tests for L{ConnectionPool} with C{prepareStatements} enabled.
+    """
+
+    prepareStatements = True
+
+    def setDialect(self, dialect, paramstyle):
+        """
+        Re-create the pool with the given dialect and paramstyle.
+        """
+        self.dbtype = DatabaseType(dialect, paramstyle)
+        ConnectionPoolHelper.setUp(self)
+
+    def execute(self, sql, *args):
+        """
+        Execute some SQL in its own transaction and commit it.
+        """
+        txn = self.createTransaction()
+        result = self.resultOf(txn.execSQL(sql, list(args)))
+        self.resultOf(txn.commit())
+        return result
+
+    def test_preparedOncePerConnection(self):
+        """
+        Executing the same SQL in several transactions on a PostgreSQL
+        connection prepares it once, with C{$n} placeholders, and then only
+        C{EXECUTE}s it.
+        """
+        sql = "select * from FOO where BAR = %s and BAZ like '5%%'"
+        self.execute(sql, 1)
+        self.execute(sql, 2)
+        [connection] = self.factory.connections
+        self.assertEquals(connection.prepares, 1)
+        self.assertEquals(
+            connection.cursors[0].allExecutions,
+            [
+                ("prepare twext_prepared_1 as "
+                 "select * from FOO where BAR = $1 and BAZ like '5%'", ()),
+                ("execute twext_prepared_1 (%s)", [1]),
+                ("execute twext_prepared_1 (%s)", [2]),
+            ]
+        )
+
+    def test_numericPlaceholders(self):
+        """
+        Numbered placeholders keep their numbers in the prepared statement, and
+        C{EXECUTE} is given one placeholder per distinct parameter.
+        """
+        self.setDialect(POSTGRES_DIALECT, "numeric")
+        self.execute("update FOO set BAR = :2 where BAZ = :1 or BAR = :2", 3, 4)
+        self.assertEquals(
+            self.factory.connections[0].cursors[0].allExecutions,
+            [
+                ("prepare twext_prepared_1 as "
+                 "update FOO set BAR = $2 where BAZ = $1 or BAR = $2", ()),
+                ("execute twext_prepared_1 (:1, :2)", [3, 4]),
+            ]
+        )
+
+    def test_notPreparable(self):
+        """
+        Statements other than single C{select}, C{insert}, C{update} and
+        C{delete}s are executed without being prepared.
+        """
+        self.execute("create table FOO (BAR integer)")
+        self.execute("delete from FOO; delete from BAR")
+        [connection] = self.factory.connections
+        self.assertEquals(connection.prepares, 0)
+        self.assertEquals(
+            connection.cursors[0].allExecutions,
+            [("create table FOO (BAR integer)", []),
+             ("delete from FOO; delete from BAR", [])]
+        )
+
+    def test_reconnectInvalidates(self):
+        """
+        When a L{_ConnectedTxn} re-connects, statements are prepared again on
+        the new connection.
+        """
+        sql = "select * from FOO"
+        self.execute(sql)
+        self.factory.connections[0].executeWillFail(FakeConnectionError)
+        self.execute(sql)
+        self.assertEquals(len(self.factory.connections), 2)
+        self.assertEquals(self.factory.connections[0].prepares, 1)
+        self.assertEquals(self.factory.connections[1].prepares, 1)
+        self.assertEquals(len(self.flushLoggedErrors(FakeConnectionError)), 1)
+
+    def test_cursorPrepare(self):
+        """
+        On Oracle, each statement is prepared with C{cursor.prepare} on a
+        cursor of its own, which is re-used for later executions.
+        """
+        self.setDialect(ORACLE_DIALECT, "numeric")
+        self.execute("select * from FOO where BAR = :1", 1)
+        [[[_ignore_counter, echo]]] = self.execute(
+            "select * from FOO where BAR = :1", 2
+        )
+        self.assertEquals(echo, "select * from FOO where BAR = :1")
+        [connection] = self.factory.connections
+        self.assertEquals(connection.prepares, 1)
+        self.assertEquals(connection.executions, 2)
+        self.assertEquals(len(connection.cursors), 2)
+        self.assertEquals(connection.cursors[0].allExecutions, [])
+
+    def test_cursorPrepareReconnects(self):
+        """
+        On Oracle, if preparing the first statement in a transaction fails, the
+        connection is re-established and the statement is prepared and executed
+        on the new one, just as if executing it had failed.
+        """
+        self.setDialect(ORACLE_DIALECT, "numeric")
+        self.execute("select * from FOO where BAR = :1", 1)
+        self.factory.connections[0].prepareWillFail(FakeConnectionError)
+        [[[_ignore_counter, echo]]] = self.execute(
+            "select * from FOO where BAZ = :1", 2
+        )
+        self.assertEquals(echo, "select * from FOO where BAZ = :1")
+        self.assertEquals(len(self.factory.connections), 2)
+        self.assertEquals(self.factory.connections[0].prepares, 1)
+        self.assertEquals(self.factory.connections[1].prepares, 1)
+        self.assertEquals(self.factory.connections[1].executions, 1)
+        self.assertEquals(len(self.flushLoggedErrors(FakeConnectionError)), 1)
+
+    def test_simulatedPrepare(self):
+        """
+        On SQLite, statements are executed as usual, relying on the
+        C{sqlite3} module's own statement cache.
+        """
+        self.setDialect(SQLITE_DIALECT, "numeric")
+        self.execute("select * from FOO where BAR = :1", 1)
+        self.execute("select * from FOO where BAR = :1", 2)
+        [connection] = self.factory.connections
+        self.assertEquals(connection.prepares, 0)
+        self.assertEquals(
+            connection.cursors[0].allExecutions,
+            [("select * from FOO where BAR = :1", [1]),
+             ("select * from FOO where BAR = :1", [2])]
+        )
+
+    def test_leastRecentlyUsedDeallocated(self):
+        """
+        When more than the maximum number of statements have been prepared on a
+        connection, the least recently used one is deallocated.
+        """
+        connection = self.factory.willConnectTo()
+        cursor = connection.cursor()
+        preparer = _ServerPreparer(connection, cursor, "qmark", maxPrepared=2)
+        preparer.execute(cursor, "select 1", [])
+        preparer.execute(cursor, "select 2", [])
+        preparer.execute(cursor, "select 1", [])
+        preparer.execute(cursor, "select 3", [])
+        self.assertIn(
+            ("deallocate twext_prepared_2", ()), cursor.allExecutions
+        )
+        self.assertEquals(connection.prepares, 3)
+
+
 class IOPump(object):
     """
     Connect a client and a server.
@@ -1326,6 +2122,20 @@ class NetworkedConnectionPoolTests(NetworkedPoolHelper, ConnectionPoolTests):
         super(NetworkedConnectionPoolTests, self).setDialect(dialect)
         self.pump.client.dbtype = self.pump.client.dbtype.copyreplace(dialect=dialect)
 
+    def test_poolStats(self):
+        """
+        L{ConnectionPoolClient.poolStats} retrieves the metrics of the
+        server's connection pool.
+        """
+        txn = self.createTransaction()
+        self.resultOf(txn.execSQL("a"))
+        stats = self.resultOf(self.pump.client.poolStats())
+        self.pump.flush()
+        [stats] = stats
+        self.assertEqual(stats, self.pool.metrics.snapshot())
+        self.assertEqual((stats["busy"], stats["checkouts"]), (1, 1))
+        self.resultOf(txn.commit())
+
     def test_newTransaction(self):
         """
         L{ConnectionPoolClient.newTransaction} returns a provider of
@@ -1336,6 +2146,59 @@ class NetworkedConnectionPoolTests(NetworkedPoolHelper, ConnectionPoolTests):
         self.pump.flush()
         self.assertEquals(len(self.factory.connections), 1)
 
+    def commandsForRows(self, rowCount):
+        """
+        Execute a statement returning C{rowCount} rows, and return the rows
+        along with the commands the server sent to report them.
+        """
+        self.factory.resultRowCount = rowCount
+        sent = []
+        callRemote = self.pump.server.callRemote
+
+        def recordingCallRemote(command, **kw):
+            sent.append((command, len(kw.get("rows") or ())))
+            return callRemote(command, **kw)
+
+        self.pump.server.callRemote = recordingCallRemote
+        txn = self.createTransaction()
+        [rows] = self.resultOf(txn.execSQL("select lots"))
+        return rows, sent
+
+    def test_rowsBatched(self):
+        """
+        Rows are sent to the client in batches of at most
+        L{ConnectionPoolClient.rowBatchSize}, with the last batch included in
+        L{QueryComplete}.
+        """
+        self.pump.client.rowBatchSize = 100
+        rows, sent = self.commandsForRows(250)
+        self.assertEquals(len(rows), 250)
+        self.assertEquals(
+            sent, [(Rows, 100), (Rows, 100), (QueryComplete, 50)]
+        )
+
+    def test_rowsBatchedExactly(self):
+        """
+        If the number of rows is a multiple of the batch size, the last full
+        batch is included in L{QueryComplete}.
+        """
+        self.pump.client.rowBatchSize = 100
+        rows, sent = self.commandsForRows(200)
+        self.assertEquals(len(rows), 200)
+        self.assertEquals(sent, [(Rows, 100), (QueryComplete, 100)])
+
+    def test_rowsUnbatched(self):
+        """
+        A client which does not specify a C{rowBatchSize}, such as one which
+        predates the L{Rows} command, receives one L{Row} command per row.
+        """
+        self.pump.client.rowBatchSize = None
+        rows, sent = self.commandsForRows(3)
+        self.assertEquals(len(rows), 3)
+        self.assertEquals(
+            sent, [(Row, 0), (Row, 0), (Row, 0), (QueryComplete, 0)]
+        )
+
 
 class HookableOperationTests(TestCase):
     """
@@ -0,0 +1,109 @@
+##
+# Copyright (c) 2017 Apple Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+##
+
+"""
+Tests for L{twext.enterprise.metrics}.
+"""
+
+from twisted.trial.unittest import TestCase
+
+from twext.enterprise.fixtures import ConnectionPoolHelper
+from twext.enterprise.metrics import Histogram, OTHER_LABEL
+
+
+class HistogramTests(TestCase):
+    """
+    Tests for L{Histogram}.
+    """
+
+    def test_record(self):
+        """
+        L{Histogram.record} counts each value in the first bucket whose bound
+        is not less than it, or in the final bucket if it exceeds all bounds.
+        """
+        histogram = Histogram((1, 10))
+        for value in (0, 1, 2, 10, 11, 500):
+            histogram.record(value)
+        self.assertEqual(histogram.buckets, [2, 2, 2])
+        self.assertEqual(histogram.count, 6)
+        self.assertEqual(histogram.total, 524)
+        self.assertEqual(histogram.maximum, 500)
+
+    def test_percentile(self):
+        """
+        L{Histogram.percentile} estimates a percentile as the bound of the
+        bucket containing it, or the maximum value if that is smaller.
+        """
+        histogram = Histogram((1, 10, 100))
+        self.assertEqual(histogram.percentile(50), 0)
+        for value in [1] * 50 + [5] * 45 + [50] * 4 + [1000]:
+            histogram.record(value)
+        self.assertEqual(histogram.percentile(50), 1)
+        self.assertEqual(histogram.percentile(90), 10)
+        self.assertEqual(histogram.percentile(99), 100)
+        self.assertEqual(histogram.percentile(100), 1000)
+
+    def test_snapshot(self):
+        """
+        L{Histogram.snapshot} pairs each bucket with its bound, using C{None}
+        for the unbounded bucket.
+        """
+        histogram = Histogram((1, 10))
+        histogram.record(5)
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot["buckets"], [(1, 0), (10, 1), (None, 0)])
+        self.assertEqual(snapshot["count"], 1)
+        self.assertEqual(snapshot["max"], 5)
+
+
+class PoolMetricsTests(ConnectionPoolHelper, TestCase):
+    """
+    Tests for L{PoolMetrics}.
+    """
+
+    def test_labelLimit(self):
+        """
+        Once L{PoolMetrics.maxLabels} distinct labels have been seen, hold
+        times for transactions with other labels are recorded together.
+        """
+        metrics = self.pool.metrics
+        metrics.maxLabels = 2
+        for label in ["a", "b", "c", "d", "a"]:
+            metrics.released(label, 0.001, 1)
+        self.assertEqual(sorted(metrics.holdTime), sorted(["a", "b", OTHER_LABEL]))
+        self.assertEqual(metrics.holdTime["a"].count, 2)
+        self.assertEqual(metrics.holdTime[OTHER_LABEL].count, 2)
+        self.assertEqual(metrics.statements.count, 5)
+
+    def test_snapshotSizes(self):
+        """
+        L{PoolMetrics.snapshot} reports the current sizes of the pool's free,
+        busy and waiting queues.
+        """
+        txns = [self.pool.connection() for _ignore in range(3)]
+        snapshot = self.pool.metrics.snapshot()
+        self.assertEqual(
+            (snapshot["free"], snapshot["busy"], snapshot["waiting"]),
+            (0, 2, 1)
+        )
+        self.assertEqual(snapshot["maxConnections"], 2)
+        for txn in txns:
+            self.resultOf(txn.commit())
+        snapshot = self.pool.metrics.snapshot()
+        self.assertEqual(
+            (snapshot["free"], snapshot["busy"], snapshot["waiting"]),
+            (2, 0, 0)
+        )
@@ -37,3 +37,31 @@ class TimestampTests(TestCase):
 
         for sqlStr, result in tests:
             self.assertEqual(parseSQLTimestamp(sqlStr), result)
+
+    def test_parseSQLTimestampFraction(self):
+        """
+        L{parseSQLTimestamp} parses fractions of a second of up to six digits.
+        """
+        tests = (
+            ("2012-04-04 12:34:56.5", datetime.datetime(2012, 4, 4, 12, 34, 56, 500000)),
+            ("2012-04-04 12:34:56.000123", datetime.datetime(2012, 4, 4, 12, 34, 56, 123)),
+            (u"2012-04-04 12:34:56.123456", datetime.datetime(2012, 4, 4, 12, 34, 56, 123456)),
+        )
+
+        for sqlStr, result in tests:
+            self.assertEqual(parseSQLTimestamp(sqlStr), result)
+
+    def test_parseSQLTimestampOther(self):
+        """
+        L{parseSQLTimestamp} returns a L{datetime.datetime} unchanged, still
+        accepts anything C{strptime} does, and rejects anything else.
+        """
+        now = datetime.datetime.utcnow()
+        self.assertIdentical(parseSQLTimestamp(now), now)
+        self.assertEqual(
+            parseSQLTimestamp("2012-4-4 12:34:56"),
+            datetime.datetime(2012, 4, 4, 12, 34, 56)
+        )
+        self.assertRaises(ValueError, parseSQLTimestamp, "2012-04-04T12:34:56")
+        self.assertRaises(ValueError, parseSQLTimestamp, "2012-13-04 12:34:56")
+        self.assertRaises(ValueError, parseSQLTimestamp, "2012-04-04 12:34:56\n")
@@ -20,21 +20,52 @@ Utilities for dealing with different databases.
 """
 
 from datetime import datetime
+import re
 
 SQL_TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S.%f"
 
+_SQL_TIMESTAMP = re.compile(
+    r"(\d{4})-(\d\d)-(\d\d) (\d\d):(\d\d):(\d\d)(?:\.(\d{1,6}))?\Z"
+)
+
+# Recently parsed timestamps: many rows share values, such as the NOT_BEFORE
+# of jobs enqueued together
+_timestampCache = {}
+_timestampCacheSize = 1024
+
 
 def parseSQLTimestamp(ts):
     """
-    Parse an SQL timestamp string.
+    Parse an SQL timestamp string, C{YYYY-MM-DD HH:MM:SS} with an optional
+    fraction of a second.  A L{datetime}, as returned by drivers which convert
+    timestamps themselves, is returned as-is.
     """
-    # Handle case where fraction seconds may not be present
-    if not isinstance(ts, datetime):
-        if len(ts) < len(SQL_TIMESTAMP_FORMAT):
-            ts += ".0"
-        return datetime.strptime(ts, SQL_TIMESTAMP_FORMAT)
-    else:
+    if isinstance(ts, datetime):
         return ts
+    try:
+        return _timestampCache[ts]
+    except KeyError:
+        pass
+
+    match = _SQL_TIMESTAMP.match(ts)
+    if match is not None:
+        year, month, day, hour, minute, second, fraction = match.groups()
+        result = datetime(
+            int(year), int(month), int(day),
+            int(hour), int(minute), int(second),
+            int(fraction.ljust(6, "0")) if fraction else 0,
+        )
+    else:
+        # Not the usual format, so leave it to strptime, which may still
+        # accept it, or will at least explain why not.  Handle case where
+        # fraction seconds may not be present.
+        padded = ts + ".0" if len(ts) < len(SQL_TIMESTAMP_FORMAT) else ts
+        result = datetime.strptime(padded, SQL_TIMESTAMP_FORMAT)
+
+    if len(_timestampCache) >= _timestampCacheSize:
+        _timestampCache.clear()
+    _timestampCache[ts] = result
+    return result
 
 
 def mapOracleOutputType(column):